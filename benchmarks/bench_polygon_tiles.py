@@ -0,0 +1,66 @@
+"""Benchmark tiled, parallel vectorisation of a WOfS summary.
+
+Runs the make_polygons vectorisation stage on a synthetic summary raster
+with 1 to N worker processes and checks that every run gives the same
+polygons.
+
+    python benchmarks/bench_polygon_tiles.py --size 6000 --max-workers 8
+
+Geoscience Australia
+2021
+"""
+
+import os
+import time
+
+import click
+
+from dea_waterbodies import waterbody_polygon_functions as wpf
+
+from synthetic import SUMMARY_TRANSFORM, synthetic_wofs_summary
+
+
+def vectorise(wet_frequency, count_clear, tile_size, n_workers):
+    windows = wpf.tile_windows(wet_frequency.shape, tile_size)
+    tiles = ((wet_frequency[rows, cols], count_clear[rows, cols],
+              0.1, 128, (rows.start, cols.start))
+             for rows, cols in windows)
+    tile_polygons = list(wpf.parallel_map(wpf.vectorise_tile, tiles,
+                                          n_workers))
+    return wpf.merge_tiles(tile_polygons, windows, SUMMARY_TRANSFORM)
+
+
+@click.command()
+@click.option('--size', type=int, default=4000,
+              help='Width and height of the synthetic raster in pixels.')
+@click.option('--waterbodies', type=int, default=2000,
+              help='Number of synthetic waterbodies.')
+@click.option('--tile-size', type=int, default=1000,
+              help='Tile size in pixels.')
+@click.option('--max-workers', type=int, default=os.cpu_count(),
+              help='Largest number of workers to try.')
+def main(size, waterbodies, tile_size, max_workers):
+    wet_frequency, count_clear = synthetic_wofs_summary(
+        (size, size), n_waterbodies=waterbodies)
+
+    n_workers = 1
+    baseline = None
+    print('workers  seconds  speedup  polygons')
+    while n_workers <= max_workers:
+        start = time.perf_counter()
+        polygons = vectorise(wet_frequency, count_clear, tile_size,
+                             n_workers)
+        elapsed = time.perf_counter() - start
+        if baseline is None:
+            baseline = (elapsed, polygons)
+        else:
+            assert len(polygons) == len(baseline[1])
+            assert polygons.geom_equals_exact(baseline[1], 0).all(), \
+                f'{n_workers} workers gave different polygons'
+        print(f'{n_workers:7d}  {elapsed:7.2f}  '
+              f'{baseline[0] / elapsed:7.2f}  {len(polygons):8d}')
+        n_workers *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Benchmark regularising many waterbody time series at once.
+
+Regularises synthetic series onto a monthly (or daily, or seasonal) grid
+with dea_waterbodies.regularise, and times a per-series pandas
+implementation on a sample of the series to compare against.
+
+    python benchmarks/bench_regularise.py --series 300000 --freq M
+
+Geoscience Australia
+2021
+"""
+
+import time
+
+import click
+import numpy as np
+import pandas as pd
+
+from dea_waterbodies import regularise
+
+from synthetic import synthetic_observations
+
+PANDAS_FREQ = {'D': 'D', 'M': 'MS', 'S': 'QS-DEC'}
+
+
+def pandas_regularise(ids, times, values, freq, how, max_gap):
+    """Regularise one series at a time with pandas."""
+    table = pd.DataFrame({'id': ids, 'time': times, 'value': values})
+    max_gap = pd.Timedelta(max_gap)
+    result = {}
+    for uid, series in table.dropna().groupby('id'):
+        series = series.set_index('time').value.sort_index()
+        series = series[~series.index.duplicated()]
+        if how == 'mean':
+            regular = series.resample(PANDAS_FREQ[freq]).mean()
+        else:
+            grid = pd.date_range(series.index[0].to_period(
+                freq[0]).start_time, series.index[-1],
+                freq=PANDAS_FREQ[freq])
+            regular = series.reindex(series.index.union(grid)).interpolate(
+                'time', limit_area='inside').reindex(grid)
+        result[uid] = regular
+    return result
+
+
+@click.command()
+@click.option('--series', type=int, default=300000,
+              help='Number of synthetic series.')
+@click.option('--observations', type=int, default=100,
+              help='Mean number of observations per series.')
+@click.option('--freq', type=click.Choice(regularise.FREQUENCIES),
+              default='M', help='Grid frequency.')
+@click.option('--how', type=click.Choice(['mean', 'interpolate']),
+              default='interpolate')
+@click.option('--max-gap', type=str, default='180D',
+              help='Longest gap to interpolate across.')
+@click.option('--sample', type=int, default=1000,
+              help='Number of series to time the pandas loop on.')
+def main(series, observations, freq, how, max_gap, sample):
+    ids, times, values = synthetic_observations(series, observations)
+    print(f'{series} series, {len(ids)} observations')
+
+    start = time.perf_counter()
+    uids, grid, regular = regularise.regularise(
+        ids, times, values, freq=freq, how=how, max_gap=max_gap,
+        dtype='float32')
+    elapsed = time.perf_counter() - start
+    print(f'vectorised: {elapsed:.2f} s for {regular.shape} '
+          f'({regular.nbytes / 2 ** 20:.0f} MiB)')
+
+    in_sample = ids < sample
+    start = time.perf_counter()
+    pandas_regularise(ids[in_sample], times[in_sample], values[in_sample],
+                      freq, how, max_gap)
+    elapsed_pandas = time.perf_counter() - start
+    per_series = elapsed_pandas / min(sample, series)
+    print(f'pandas loop: {elapsed_pandas:.2f} s for {min(sample, series)} '
+          f'series, about {per_series * series:.0f} s for all '
+          f'({per_series * series / elapsed:.0f}x slower)')
+    print(f'grid {grid[0]} to {grid[-1]}, '
+          f'{np.isnan(regular).mean():.1%} missing')
+
+
+if __name__ == '__main__':
+    main()
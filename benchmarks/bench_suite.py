@@ -0,0 +1,316 @@
+"""Offline benchmarks of the waterbodies pipeline stages.
+
+Times drilling (generate_wb_timeseries and drill) against a FakeDatacube
+across polygon sizes and numbers of timesteps, chunk allocation
+(alloc_chunks), shape loading (get_shapes), and the make_polygons stages
+on synthetic data. Stages whose dependencies aren't installed are skipped.
+
+Results are saved to benchmarks/results/ named by time and commit, and
+compared with the latest earlier result from the same kind of machine, so
+regressions between commits show up:
+
+    python benchmarks/bench_suite.py --quick
+    python benchmarks/bench_suite.py --stages drill,alloc_chunks
+    python benchmarks/bench_suite.py --compare benchmarks/results/<file>.json
+
+Geoscience Australia
+2021
+"""
+
+from contextlib import contextmanager
+import datetime
+import functools
+import itertools
+import json
+import math
+import os
+from pathlib import Path
+import platform
+import subprocess
+import tempfile
+import time
+
+import click
+import numpy as np
+
+from fake_datacube import FakeDatacube
+from synthetic import synthetic_wofs_summary
+
+HERE = Path(__file__).parent.resolve()
+RESULTS_DIR = HERE / 'results'
+
+# A corner of Canberra in EPSG:3577 to put drilled polygons at.
+ORIGIN = (1550000, -3950000)
+
+# Side lengths of drilled square polygons, in metres: a farm dam, a small
+# reservoir, and a large reservoir.
+POLYGON_SIDES = [100, 1000, 5000]
+
+# Numbers of WOfLs to drill.
+TIMESTEPS = [100, 800]
+
+STAGES = {}
+
+
+def stage(func):
+    """Register a benchmark stage.
+
+    A stage takes quick (bool) and a working directory, and yields
+    (name, function) pairs to time.
+    """
+    STAGES[func.__name__] = func
+    return func
+
+
+@contextmanager
+def patched(module, name, value):
+    old = getattr(module, name)
+    setattr(module, name, value)
+    try:
+        yield
+    finally:
+        setattr(module, name, old)
+
+
+def square(side: float):
+    from shapely.geometry import box
+    return box(ORIGIN[0], ORIGIN[1], ORIGIN[0] + side, ORIGIN[1] + side)
+
+
+def drill_cases(quick: bool):
+    sides = POLYGON_SIDES[:2] if quick else POLYGON_SIDES
+    timesteps = TIMESTEPS[:1] if quick else TIMESTEPS
+    return itertools.product(sides, timesteps)
+
+
+@stage
+def generate_wb_timeseries(quick, workdir):
+    from shapely.geometry import mapping
+    import dea_waterbodies.waterbody_timeseries_functions as wtf
+    config = {
+        'output_dir': str(workdir / 'timeseries'), 'crs': 'EPSG:3577',
+        'id_field': 'UID', 'time_span': 'CUSTOM',
+        'start_dt': '1987-01-01', 'end_date': '2021-01-01',
+        'include_uncertainty': False, 'wofls': 'ga_ls_wo_3',
+    }
+    for side, n_timesteps in drill_cases(quick):
+        shapes = {'geometry': mapping(square(side)),
+                  'properties': {'UID': 'r3dp84s8n'}}
+        fake = functools.partial(FakeDatacube, n_timesteps=n_timesteps)
+
+        def run(shapes=shapes, fake=fake):
+            with patched(wtf, 'Datacube', fake):
+                wtf.generate_wb_timeseries(shapes, config)
+
+        yield f'{side}m_{n_timesteps}t', run
+
+
+@stage
+def drill(quick, workdir):
+    from dea_waterbodies.drill import Driller
+    for side, n_timesteps in drill_cases(quick):
+        driller = Driller(dc=FakeDatacube(n_timesteps=n_timesteps))
+        polygon = square(side)
+        yield f'{side}m_{n_timesteps}t', functools.partial(
+            driller.drill, polygon, ('1987', '2020'))
+
+
+def synthetic_polygons(n: int, seed: int = 0):
+    """Squares with lognormal areas scattered around ORIGIN."""
+    import geopandas as gp
+    from shapely.geometry import box
+    from dea_waterbodies.uids import assign_uids
+    rng = np.random.default_rng(seed)
+    sides = np.sqrt(rng.lognormal(9, 2, n)).clip(25, 20000)
+    span = 100 * math.sqrt(n) * 1000
+    xs = ORIGIN[0] + rng.uniform(0, span, n)
+    ys = ORIGIN[1] + rng.uniform(0, span, n)
+    polygons = gp.GeoDataFrame(
+        {'STATE': rng.choice(['ACT', 'NSW', 'VIC'], n)},
+        geometry=[box(x, y, x + s, y + s) for x, y, s in zip(xs, ys, sides)],
+        crs='EPSG:3577')
+    polygons['area'] = polygons.area
+    return assign_uids(polygons)
+
+
+@stage
+def alloc_chunks(quick, workdir):
+    from dea_waterbodies.make_chunks import PolygonContext, alloc_chunks
+    for n in [10000] if quick else [10000, 100000]:
+        rng = np.random.default_rng(0)
+        contexts = [PolygonContext(area, f'r{i:08d}', 'ACT')
+                    for i, area in enumerate(rng.lognormal(9, 2, n))]
+        yield f'{n}', lambda contexts=contexts: alloc_chunks(
+            list(contexts), 64)
+
+
+@stage
+def get_shapes(quick, workdir):
+    from dea_waterbodies.make_time_series import get_shapes
+    for n in [2000] if quick else [2000, 20000]:
+        path = workdir / f'polygons_{n}.shp'
+        polygons = synthetic_polygons(n)
+        polygons.to_file(path)
+        config = {'output_dir': str(workdir / 'timeseries'),
+                  'missing_only': False, 'shape_file': str(path),
+                  'filter_state': 'ACT'}
+        ids = list(polygons.UID[::2])
+        yield f'{n}', functools.partial(get_shapes, config, ids, 'UID')
+
+
+@stage
+def make_polygons(quick, workdir):
+    import geopandas as gp
+    from shapely.geometry import LineString
+    from dea_waterbodies import waterbody_polygon_functions as wpf
+    from bench_polygon_tiles import vectorise
+
+    size = 2000 if quick else 6000
+    wet_frequency, count_clear = synthetic_wofs_summary(
+        (size, size), n_waterbodies=size // 2)
+    yield f'vectorise_{size}px', functools.partial(
+        vectorise, wet_frequency, count_clear, 1000, 1)
+
+    polygons = vectorise(wet_frequency, count_clear, 1000, 1)
+    polygons['perimeter'] = polygons.length
+    polygons['pp_test'] = (polygons.area * 4 * math.pi
+                           / polygons.perimeter ** 2)
+    yield f'split_{len(polygons)}', functools.partial(
+        wpf.split_large_polygons, polygons, pp_thresh=0.005, erode=100,
+        dilate=125)
+
+    rng = np.random.default_rng(0)
+    x0, y0, x1, y1 = polygons.total_bounds
+    lines = [LineString(np.cumsum(rng.normal(0, 200, (50, 2)), axis=0)
+                        + rng.uniform((x0, y0), (x1, y1)))
+             for _ in range(size // 4)]
+    rivers_path = workdir / 'rivers.gpkg'
+    gp.GeoDataFrame(geometry=lines, crs=polygons.crs).to_file(rivers_path)
+    yield f'rivers_{len(polygons)}', functools.partial(
+        wpf.filter_rivers, polygons, rivers_path, tile_size=20000)
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+            capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=HERE, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('+dirty' if dirty.strip() else '')
+
+
+def machine() -> str:
+    """Results are only comparable on the same kind of machine."""
+    return f'{platform.machine()}-{os.cpu_count()}cpu-{platform.system()}'
+
+
+def latest_result(commit: str, machine_: str) -> Path or None:
+    """The most recent saved result from another commit on this machine."""
+    candidates = []
+    for path in RESULTS_DIR.glob('*.json'):
+        with open(path) as f:
+            result = json.load(f)
+        if result['machine'] == machine_ and result['commit'] != commit:
+            candidates.append((result['date'], path))
+    return max(candidates)[1] if candidates else None
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> [str]:
+    """Print a comparison table and return the names of regressions."""
+    regressions = []
+    print(f'\nCompared with {baseline["commit"]} ({baseline["date"]}):')
+    for name, seconds in results.items():
+        before = baseline['results'].get(name)
+        if seconds is None or before is None:
+            continue
+        ratio = seconds / before
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f'{name:45s} {before:8.3f} {seconds:8.3f} {ratio:6.2f}x{flag}')
+    return regressions
+
+
+def run_stage(stage_name: str, quick: bool, workdir: Path,
+              repeat: int) -> dict:
+    """Time each case of a stage, keeping the fastest of repeat runs."""
+    results = {}
+    for case_name, run in STAGES[stage_name](quick, workdir):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        name = f'{stage_name}/{case_name}'
+        results[name] = min(times)
+        print(f'{name:45s} {min(times):8.3f} s')
+    return results
+
+
+@click.command()
+@click.option('--stages', default=','.join(STAGES),
+              help='Comma-separated stages to run. Default all of '
+              f'{", ".join(STAGES)}.')
+@click.option('--quick', is_flag=True,
+              help='Run smaller cases only.')
+@click.option('--repeat', type=int, default=3,
+              help='Times to run each case. The fastest run is kept.')
+@click.option('--compare', 'compare_path', type=click.Path(exists=True),
+              default=None,
+              help='Result file to compare with. Defaults to the latest '
+              'saved result from another commit on this machine.')
+@click.option('--threshold', type=float, default=1.25,
+              help='Flag cases that are this many times slower than the '
+              'baseline.')
+@click.option('--save/--no-save', default=True,
+              help='Save results to benchmarks/results.')
+@click.option('--fail-on-regression', is_flag=True,
+              help='Exit with an error if any case regressed.')
+def main(stages, quick, repeat, compare_path, threshold, save,
+         fail_on_regression):
+    commit = git_commit()
+    results = {}
+    skipped = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for stage_name in stages.split(','):
+            try:
+                stage_results = run_stage(stage_name, quick, Path(workdir),
+                                          repeat)
+            except ImportError as e:
+                # Dependencies are often imported lazily, so this can
+                # happen while running too.
+                skipped[stage_name] = str(e)
+                print(f'{stage_name:45s} skipped: {e}')
+                continue
+            results.update(stage_results)
+
+    record = {
+        'commit': commit, 'machine': machine(), 'quick': quick,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'results': results, 'skipped': skipped,
+    }
+    if compare_path is None:
+        compare_path = latest_result(commit, record['machine'])
+    regressions = []
+    if compare_path is not None:
+        with open(compare_path) as f:
+            regressions = compare(results, json.load(f), threshold)
+    if save:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        stamp = record['date'].replace(':', '').replace('-', '')
+        path = RESULTS_DIR / f'{stamp}-{commit}.json'
+        with open(path, 'w') as f:
+            json.dump(record, f, indent=2)
+        print(f'\nSaved results to {path}')
+    if regressions and fail_on_regression:
+        raise click.ClickException(
+            f'{len(regressions)} cases regressed: {", ".join(regressions)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""A stand-in for datacube.Datacube that makes up WOfLs.
+
+FakeDatacube.load returns WOfL bit flag cubes on the requested geobox, like
+a real datacube does, but synthesised on the fly: a waterbody that fills
+and empties with the seasons, sea and terrain shadow flags, clouds, and
+the stripes of Landsat 7 scenes after its scan line corrector failed.
+This needs the datacube and xarray packages, but not a database or any
+data, so drills can be benchmarked anywhere.
+
+    import dea_waterbodies.waterbody_timeseries_functions as wtf
+    wtf.Datacube = functools.partial(FakeDatacube, n_timesteps=200)
+
+Geoscience Australia
+2021
+"""
+
+from types import SimpleNamespace
+import uuid
+import zlib
+
+import numpy as np
+import pandas as pd
+
+# WOfL bit flags.
+NODATA = 1
+SEA = 4
+TERRAIN_SHADOW = 8
+CLOUD_SHADOW = 32
+CLOUD = 64
+WET = 128
+
+# Landsat 7's scan line corrector failed on this date.
+SLC_OFF = np.datetime64('2003-05-31')
+
+# Sensor operating periods.
+SENSORS = {
+    'ls5': ('1986-01-01', '2011-11-18'),
+    'ls7': ('1999-05-28', '2022-04-06'),
+    'ls8': ('2013-04-11', '2100-01-01'),
+}
+
+# Footprint of every fake dataset: all of Australia in EPSG:3577.
+EXTENT = (-2000000, -5000000, 2500000, -1000000)
+
+
+def synthetic_times(n_timesteps: int, start='1987-01-01', end='2021-01-01',
+                    seed: int = 0) -> (np.ndarray, np.ndarray):
+    """Make observation times and the sensor of each.
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray)
+        Sorted unique datetime64[ns] times, and sensor names.
+    """
+    rng = np.random.default_rng(seed)
+    start = np.datetime64(start, 's').astype('int64')
+    end = np.datetime64(end, 's').astype('int64')
+    days = np.unique(rng.integers(start // 86400, end // 86400, n_timesteps))
+    # Overpasses are mid-morning local time, around midnight UTC.
+    times = (days * 86400 + rng.integers(-3600, 3600, len(days))).astype(
+        'datetime64[s]').astype('datetime64[ns]')
+    sensors = np.empty(len(times), dtype=object)
+    for i, time in enumerate(times):
+        available = [name for name, (first, last) in SENSORS.items()
+                     if np.datetime64(first) <= time <= np.datetime64(last)]
+        sensors[i] = available[i % len(available)]
+    return times, sensors
+
+
+def _blobs(rng, shape, scale: int, fraction: float) -> np.ndarray:
+    """Smooth random blobs covering about fraction of shape."""
+    coarse = rng.uniform(size=(shape[0] // scale + 2, shape[1] // scale + 2))
+    rows = np.arange(shape[0]) / scale
+    cols = np.arange(shape[1]) / scale
+    r0, c0 = rows.astype(int), cols.astype(int)
+    fr, fc = (rows - r0)[:, None], (cols - c0)[None, :]
+    field = (coarse[r0][:, c0] * (1 - fr) * (1 - fc)
+             + coarse[r0 + 1][:, c0] * fr * (1 - fc)
+             + coarse[r0][:, c0 + 1] * (1 - fr) * fc
+             + coarse[r0 + 1][:, c0 + 1] * fr * fc)
+    return field > np.quantile(field, 1 - fraction)
+
+
+def synthetic_wofls(shape: (int, int), times: np.ndarray,
+                    sensors: np.ndarray, seed: int = 0) -> np.ndarray:
+    """Make a (time, y, x) cube of WOfL bit flags.
+
+    Arguments
+    ---------
+    shape : (int, int)
+        Shape of each WOfL.
+
+    times : np.ndarray
+        datetime64 time of each WOfL.
+
+    sensors : np.ndarray
+        Sensor of each WOfL, e.g. 'ls7'.
+
+    seed : int
+        Random seed.
+    """
+    rng = np.random.default_rng(seed)
+    n_rows, n_cols = shape
+    yy, xx = np.mgrid[0:n_rows, 0:n_cols]
+    # An elliptical basin, deepest in the middle.
+    depth = 1 - np.hypot((yy + 0.5) / n_rows * 2 - 1,
+                         (xx + 0.5) / n_cols * 2 - 1)
+    # Sea down the left edge, and a hillside that shades the top rows in
+    # winter.
+    sea = xx < max(1, n_cols // 20)
+    hillside = yy < max(1, n_rows // 10)
+
+    wofls = np.empty((len(times), n_rows, n_cols), dtype='uint8')
+    years = (times.astype('datetime64[D]').astype('int64') / 365.25) % 1
+    for i, (year, sensor) in enumerate(zip(years, sensors)):
+        level = 0.5 + 0.4 * np.sin(2 * np.pi * year)
+        wofl = np.where(depth > 1 - level, WET, 0).astype('uint8')
+        wofl[sea] |= SEA
+        # Southern hemisphere winter.
+        if 0.4 < year < 0.7:
+            wofl[hillside] |= TERRAIN_SHADOW
+        if rng.uniform() < 0.4:
+            cloud = _blobs(rng, shape, max(2, n_rows // 8),
+                           rng.uniform(0.05, 0.8))
+            shadow = np.roll(cloud, (2, 3), axis=(0, 1)) & ~cloud
+            wofl[shadow] = CLOUD_SHADOW
+            wofl[cloud] = CLOUD
+        if sensor == 'ls7' and times[i] >= SLC_OFF:
+            offset = rng.integers(0, 30)
+            stripes = (xx + 0.25 * yy + offset) % 30 < 5
+            wofl[stripes] = NODATA
+        wofls[i] = wofl
+    return wofls
+
+
+def _time_bounds(time) -> (np.datetime64, np.datetime64):
+    """Datacube-style time range: ('2020', '2021') covers all of 2021."""
+    if time is None:
+        return np.datetime64('1900-01-01'), np.datetime64('2200-01-01')
+    if isinstance(time, (str, pd.Timestamp, np.datetime64)):
+        time = (time, time)
+    start, end = time
+    start = pd.Period(str(start)).start_time.to_datetime64()
+    end = pd.Period(str(end)).end_time.to_datetime64()
+    return start, end
+
+
+class FakeDatacube:
+    """Looks enough like datacube.Datacube to drill WOfLs.
+
+    Arguments
+    ---------
+    app : str
+        Ignored.
+
+    n_timesteps : int
+        Number of WOfLs between start and end.
+
+    start, end : str
+        Time range of the fake WOfLs.
+
+    seed : int
+        Random seed.
+    """
+
+    def __init__(self, app=None, n_timesteps: int = 200,
+                 start: str = '1987-01-01', end: str = '2021-01-01',
+                 seed: int = 0, **kwargs):
+        self.times, self.sensors = synthetic_times(n_timesteps, start, end,
+                                                   seed=seed)
+        self.seed = seed
+        self.n_loads = 0
+        self.n_searches = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def _select(self, time) -> np.ndarray:
+        start, end = _time_bounds(time)
+        return np.flatnonzero((self.times >= start) & (self.times <= end))
+
+    def find_datasets(self, product=None, time=None, geopolygon=None,
+                      **kwargs) -> list:
+        """One fake dataset per time, covering all of Australia."""
+        from datacube.utils import geometry
+        self.n_searches += 1
+        extent = geometry.box(*EXTENT, crs='EPSG:3577')
+        return [SimpleNamespace(
+                    id=uuid.UUID(int=int(i) + 1), extent=extent,
+                    crs=extent.crs, center_time=self.times[i],
+                    sensor=self.sensors[i])
+                for i in self._select(time)]
+
+    def load(self, product=None, geopolygon=None, time=None,
+             output_crs=None, resolution=None, datasets=None, **kwargs):
+        """Synthesise WOfLs on the geobox covering geopolygon."""
+        import xarray as xr
+        from datacube.utils.geometry import GeoBox
+        self.n_loads += 1
+        if datasets is not None:
+            selected = np.unique(np.searchsorted(
+                self.times, [d.center_time for d in datasets]))
+        else:
+            selected = self._select(time)
+        if not len(selected):
+            return xr.Dataset()
+        geobox = GeoBox.from_geopolygon(geopolygon, resolution=resolution,
+                                        crs=output_crs or geopolygon.crs)
+        times = self.times[selected]
+        # Seed from the time and location so repeated loads agree.
+        seed = zlib.crc32(
+            f'{self.seed} {times[0]} {geobox.extent.wkt}'.encode())
+        water = synthetic_wofls(geobox.shape, times, self.sensors[selected],
+                                seed=seed)
+        coords = geobox.xr_coords(with_crs=True)
+        return xr.Dataset(
+            {'water': (('time', 'y', 'x'), water,
+                       {'nodata': NODATA, 'units': '1', 'crs': geobox.crs})},
+            coords=dict(coords, time=times),
+            attrs={'crs': geobox.crs})
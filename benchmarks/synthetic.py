@@ -0,0 +1,88 @@
+"""Synthetic stand-ins for DEA data, for benchmarking without a datacube.
+
+Geoscience Australia
+2021
+"""
+
+from affine import Affine
+import numpy as np
+
+# A WOfS-like Albers grid: 25 m pixels.
+SUMMARY_TRANSFORM = Affine(25, 0, 1500000, 0, -25, -3900000)
+
+
+def synthetic_wofs_summary(shape=(4000, 4000), n_waterbodies=400,
+                           seed=0) -> (np.ndarray, np.ndarray):
+    """Make a fake WOfS summary with blob-shaped waterbodies.
+
+    Arguments
+    ---------
+    shape : (int, int)
+        Raster shape in pixels.
+
+    n_waterbodies : int
+        Number of blobs to add.
+
+    seed : int
+        Random seed.
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray)
+        Wet frequency (like wofs_filtered_summary) and count_clear, with
+        nan for no-data.
+    """
+    rng = np.random.default_rng(seed)
+    wet_frequency = np.zeros(shape, dtype='float32')
+    for _ in range(n_waterbodies):
+        radius = rng.lognormal(2, 0.8)
+        cy = rng.uniform(0, shape[0])
+        cx = rng.uniform(0, shape[1])
+        y0, y1 = max(0, int(cy - 3 * radius)), min(shape[0],
+                                                   int(cy + 3 * radius) + 1)
+        x0, x1 = max(0, int(cx - 3 * radius)), min(shape[1],
+                                                   int(cx + 3 * radius) + 1)
+        if y0 >= y1 or x0 >= x1:
+            continue
+        yy, xx = np.mgrid[y0:y1, x0:x1]
+        blob = rng.uniform(0.2, 1) * np.exp(
+            -((yy - cy) ** 2 + (xx - cx) ** 2) / radius ** 2)
+        np.maximum(wet_frequency[y0:y1, x0:x1], blob,
+                   out=wet_frequency[y0:y1, x0:x1])
+    # Speckle, so that there are lots of little polygons too.
+    wet_frequency += rng.normal(0, 0.02, shape).astype('float32')
+    np.clip(wet_frequency, 0, 1, out=wet_frequency)
+
+    count_clear = rng.normal(200, 60, shape).astype('float32')
+    np.clip(count_clear, 0, None, out=count_clear)
+    # A strip of no-data down one side.
+    wet_frequency[:, :shape[1] // 50] = np.nan
+    count_clear[:, :shape[1] // 50] = np.nan
+    return wet_frequency, count_clear
+
+
+def synthetic_observations(n_series=1000, n_observations=100,
+                           start='1987-01-01', end='2021-01-01',
+                           seed=0) -> (np.ndarray, np.ndarray, np.ndarray):
+    """Make a fake long table of irregular waterbody observations.
+
+    Each series has roughly n_observations at random times, with a
+    seasonal wet percentage, some of them NaN like cloudy observations.
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray, np.ndarray)
+        Integer series IDs, datetime64[ns] times and values, in random
+        order.
+    """
+    rng = np.random.default_rng(seed)
+    start = np.datetime64(start, 's').astype('int64')
+    end = np.datetime64(end, 's').astype('int64')
+    counts = rng.poisson(n_observations, n_series)
+    ids = np.repeat(np.arange(n_series), counts)
+    times = rng.integers(start, end, len(ids))
+    phase = rng.uniform(0, 2 * np.pi, n_series)[ids]
+    values = 50 + 40 * np.sin(times / (365.25 * 86400) * 2 * np.pi + phase)
+    values += rng.normal(0, 5, len(ids))
+    values[rng.uniform(size=len(ids)) < 0.1] = np.nan
+    return ids, times.astype('datetime64[s]').astype('datetime64[ns]'), values
@@ -0,0 +1,334 @@
+"""Drill WOfLs for arbitrary polygons in memory.
+
+generate_wb_timeseries writes each waterbody's time series to a CSV. For
+interactive use and services, drill returns the time series of any polygon
+directly instead. A Driller keeps a Datacube session open between drills,
+and caches dataset searches and polygon masks, so repeated drills of
+nearby or identical polygons are fast:
+
+    >>> from dea_waterbodies.drill import drill
+    >>> drill(polygon, ('2020-01', '2020-12'), 'ga_ls_wo_3')
+
+Geoscience Australia
+2021
+"""
+
+from collections import OrderedDict
+import logging
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# WOfL bit flag values that count as wet and dry. Other flags (cloud,
+# terrain shadow, no data...) are invalid. Sea and low solar angle
+# observations are still valid.
+WET_VALUES = (128, 132, 136, 140)
+DRY_VALUES = (0, 4, 8, 12)
+
+# Default CRS of drilled polygons.
+DEFAULT_CRS = 'EPSG:3577'
+
+# Dataset searches are done over tiles of this size in metres (in
+# EPSG:3577), so that drills of nearby polygons share searches.
+SEARCH_TILE_SIZE = 50000
+
+# Polygons smaller than this in either dimension (in CRS units) are not
+# masked, as the mask would be empty. Matches generate_wb_timeseries.
+MIN_MASK_SIZE = 25.3
+
+# Output columns.
+COLUMNS = ['Observation Date', 'Wet pixel percentage', 'Wet pixel count',
+           'Invalid pixel count']
+
+
+class LRUCache:
+    """A thread-safe dict that forgets its least recently used items."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def __len__(self):
+        return len(self._items)
+
+
+def count_wofl_pixels(water: np.ndarray, mask: np.ndarray = None):
+    """Count wet, dry and total pixels in each WOfL.
+
+    Arguments
+    ---------
+    water : np.ndarray
+        (time, y, x) WOfL bit flags.
+
+    mask : np.ndarray, optional
+        (y, x) boolean mask of pixels to count. Defaults to all pixels.
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray, int)
+        Wet and dry pixel counts at each time, and the number of pixels
+        counted at each time.
+    """
+    if mask is not None:
+        water = water[:, mask]
+    water = water.reshape(len(water), -1)
+    wet = np.isin(water, WET_VALUES).sum(axis=1)
+    dry = np.isin(water, DRY_VALUES).sum(axis=1)
+    return wet, dry, water.shape[1]
+
+
+def summarise_wofl_counts(times, wet, dry, total: int,
+                          max_invalid_percent: float = 10):
+    """Turn wet and dry pixel counts into a waterbody time series.
+
+    Arguments
+    ---------
+    times : array_like
+        Time of each count.
+
+    wet, dry : np.ndarray
+        Wet and dry pixel counts.
+
+    total : int
+        Total number of pixels in the waterbody.
+
+    max_invalid_percent : float
+        Times with at least this percentage of invalid pixels have NaN
+        values. 10 by default, or 100 to keep all but entirely invalid
+        times, like UNCERTAINTY = True.
+
+    Returns
+    -------
+    pd.DataFrame
+        With COLUMNS, one row per time.
+    """
+    import pandas as pd
+    wet = np.asarray(wet)
+    invalid = total - wet - np.asarray(dry)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        wet_percent = np.round(wet / total * 100, 1)
+        invalid_percent = invalid / total * 100
+    if not total:
+        invalid_percent = np.full(len(wet), 100.0)
+    valid = invalid_percent < max_invalid_percent
+    return pd.DataFrame({
+        COLUMNS[0]: np.asarray(times, dtype='datetime64[ns]'),
+        COLUMNS[1]: np.where(valid, wet_percent, np.nan),
+        COLUMNS[2]: np.where(valid, wet, np.nan),
+        COLUMNS[3]: np.where(valid, invalid, np.nan),
+    })
+
+
+def _search_tiles(bounds) -> [(float, float, float, float)]:
+    """Tiles of SEARCH_TILE_SIZE covering some EPSG:3577 bounds."""
+    size = SEARCH_TILE_SIZE
+    x0, y0 = np.floor(np.asarray(bounds[:2]) / size).astype(int)
+    x1, y1 = np.floor(np.asarray(bounds[2:]) / size).astype(int)
+    return [(x * size, y * size, (x + 1) * size, (y + 1) * size)
+            for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+class Driller:
+    """Drills WOfLs for polygons, reusing a Datacube session and caches.
+
+    Arguments
+    ---------
+    dc : datacube.Datacube, optional
+        Datacube to load from. One is opened when first needed if not
+        given.
+
+    search_cache_size : int
+        Number of dataset searches to cache.
+
+    mask_cache_size : int
+        Number of polygon masks to cache.
+    """
+
+    def __init__(self, dc=None, search_cache_size: int = 256,
+                 mask_cache_size: int = 1024):
+        self._dc = dc
+        self._dc_lock = threading.Lock()
+        self.search_cache = LRUCache(search_cache_size)
+        self.mask_cache = LRUCache(mask_cache_size)
+
+    @property
+    def dc(self):
+        with self._dc_lock:
+            if self._dc is None:
+                from datacube import Datacube
+                self._dc = Datacube(app='Polygon drill')
+            return self._dc
+
+    def _search_tile(self, product: str, time_range, tile):
+        key = (product, tuple(time_range), tile)
+        datasets = self.search_cache.get(key)
+        if datasets is None:
+            from datacube.utils import geometry
+            from dea_waterbodies.waterbody_timeseries_functions import (
+                get_dataset_maturity)
+            query = {'product': product, 'time': tuple(time_range),
+                     'geopolygon': geometry.box(*tile, crs=DEFAULT_CRS)}
+            dataset_maturity = get_dataset_maturity(product)
+            if dataset_maturity:
+                query['dataset_maturity'] = dataset_maturity
+            datasets = self.dc.find_datasets(**query)
+            self.search_cache.put(key, datasets)
+        return datasets
+
+    def search(self, product: str, time_range, geom) -> list:
+        """Find the datasets of product intersecting a polygon.
+
+        Searches are cached by tile, so nearby polygons share searches.
+
+        Arguments
+        ---------
+        product : str
+            WOfL product name.
+
+        time_range : (str, str)
+            Start and end dates.
+
+        geom : datacube.utils.geometry.Geometry
+            Polygon to search.
+        """
+        tiles = _search_tiles(geom.to_crs(DEFAULT_CRS).boundingbox)
+        datasets = {}
+        for tile in tiles:
+            for dataset in self._search_tile(product, time_range, tile):
+                datasets[dataset.id] = dataset
+        # Tiles are bigger than the polygon, so filter to datasets that
+        # actually intersect it.
+        projected = {}
+        found = []
+        for dataset in datasets.values():
+            crs = dataset.extent.crs
+            if crs not in projected:
+                projected[crs] = geom.to_crs(crs)
+            if dataset.extent.intersects(projected[crs]):
+                found.append(dataset)
+        return found
+
+    def load(self, product: str, datasets: list, geom):
+        """Load WOfLs for a polygon from some datasets."""
+        from dea_waterbodies.waterbody_timeseries_functions import (
+            get_resolution, wofls_fuser)
+        return self.dc.load(
+            product=product, datasets=datasets, geopolygon=geom,
+            output_crs=str(geom.crs), resolution=get_resolution(product),
+            resampling='nearest', measurements=['water'],
+            group_by='solar_day', fuse_func=wofls_fuser)
+
+    def mask(self, geom, geobox) -> np.ndarray or None:
+        """Rasterise a polygon onto a geobox, or None if it's too small."""
+        bbox = geom.boundingbox
+        if bbox.width <= MIN_MASK_SIZE or bbox.height <= MIN_MASK_SIZE:
+            return None
+        key = (geom.wkt, str(geom.crs), geobox.shape, tuple(geobox.affine),
+               str(geobox.crs))
+        mask = self.mask_cache.get(key)
+        if mask is None:
+            import rasterio.features
+            mask = rasterio.features.geometry_mask(
+                [geom.to_crs(geobox.crs)], out_shape=geobox.shape,
+                transform=geobox.affine, all_touched=False, invert=True)
+            self.mask_cache.put(key, mask)
+        return mask
+
+    def drill(self, geometry, time_range, product: str = 'ga_ls_wo_3',
+              crs=DEFAULT_CRS, max_invalid_percent: float = 10,
+              as_records: bool = False):
+        """Get the wet area time series of a polygon.
+
+        Arguments
+        ---------
+        geometry : shapely geometry or dict or Geometry
+            Polygon to drill, as a shapely geometry, a GeoJSON geometry, or
+            a datacube Geometry (which has its own CRS).
+
+        time_range : (str, str)
+            Start and end dates.
+
+        product : str
+            WOfL product name. Default ga_ls_wo_3.
+
+        crs : str
+            CRS of geometry. Default EPSG:3577.
+
+        max_invalid_percent : float
+            Times with at least this percentage of invalid pixels have NaN
+            values. Default 10.
+
+        as_records : bool
+            Return a NumPy record array instead of a DataFrame.
+
+        Returns
+        -------
+        pd.DataFrame or np.recarray
+            With COLUMNS, one row per solar day.
+        """
+        from datacube.utils import geometry as dc_geometry
+        if not isinstance(geometry, dc_geometry.Geometry):
+            if hasattr(geometry, '__geo_interface__'):
+                geometry = geometry.__geo_interface__
+            geometry = dc_geometry.Geometry(geometry, crs=crs)
+        datasets = self.search(product, time_range, geometry)
+        logger.debug(f'Found {len(datasets)} datasets')
+        if datasets:
+            wofl = self.load(product, datasets, geometry)
+        if not datasets or not len(wofl.attrs):
+            times = np.array([], dtype='datetime64[ns]')
+            wet = dry = np.array([], dtype=int)
+            total = 0
+        else:
+            mask = self.mask(geometry, wofl.geobox)
+            wet, dry, total = count_wofl_pixels(wofl.water.values, mask)
+            times = wofl.time.values
+        series = summarise_wofl_counts(
+            times, wet, dry, total, max_invalid_percent=max_invalid_percent)
+        if as_records:
+            return series.to_records(index=False)
+        return series
+
+
+_default_driller = None
+_default_driller_lock = threading.Lock()
+
+
+def default_driller() -> Driller:
+    """Get the Driller shared by calls to drill in this process."""
+    global _default_driller
+    with _default_driller_lock:
+        if _default_driller is None:
+            _default_driller = Driller()
+        return _default_driller
+
+
+def drill(geometry, time_range, product: str = 'ga_ls_wo_3', **kwargs):
+    """Get the wet area time series of a polygon.
+
+    Uses a Driller shared by all calls in this process, so the Datacube
+    session and caches stay warm. See Driller.drill for arguments.
+    """
+    return default_driller().drill(geometry, time_range, product=product,
+                                   **kwargs)
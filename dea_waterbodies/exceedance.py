@@ -0,0 +1,221 @@
+"""Find when waterbodies first and last exceed wet area thresholds.
+
+For each waterbody and each threshold, we find the first and last quarter
+(JFM/AMJ/JAS/OND) in which the wet pixel percentage reached the threshold.
+This is a proxy for the construction date of built waterbodies. All
+thresholds are found at once in a vectorised pass over a long table of all
+time series, and the results are appended to the waterbody polygons.
+
+Quarters are labelled by the day before they start, so JFM 2020 is
+2019-12-31. This matches the labels from
+notebooks/IdentifyTimeWaterbodyExceedsXpc.ipynb.
+
+Geoscience Australia
+2021
+"""
+
+import logging
+import os
+import sys
+
+import click
+import numpy as np
+
+import dea_waterbodies
+from dea_waterbodies.make_snapshot import NODATA
+
+logger = logging.getLogger(__name__)
+
+
+def quarter_labels(times: np.ndarray) -> np.ndarray:
+    """Label the quarter of each time by the day before the quarter starts.
+
+    Arguments
+    ---------
+    times : np.ndarray
+        Times as datetime64, or int64 nanoseconds since the epoch.
+
+    Returns
+    -------
+    np.ndarray of str
+        Dates as YYYY-MM-DD.
+    """
+    months = np.asarray(times).astype('datetime64[ns]').astype(
+        'datetime64[M]').astype('int64')
+    starts = (months - months % 3).astype('datetime64[M]')
+    return (starts.astype('datetime64[D]') - 1).astype(str)
+
+
+def _first_exceedances(codes: np.ndarray, values: np.ndarray,
+                       n_groups: int, thresholds: [float]) -> np.ndarray:
+    """Find the first value at least each threshold in each group.
+
+    codes must be sorted, and values is in the order to search within
+    each group.
+
+    Returns
+    -------
+    np.ndarray
+        (n_groups, n_thresholds) indices into values, or -1 if no value in
+        the group reaches the threshold.
+    """
+    groups = np.arange(n_groups)
+    ends = np.searchsorted(codes, groups, side='right')
+    result = np.full((n_groups, len(thresholds)), -1)
+    if not len(values):
+        return result
+    # Offset each group so that a running maximum over all groups never
+    # carries over from one group to the next. The running maximum is then
+    # sorted, and the first value reaching a threshold in a group is where
+    # the threshold would be inserted.
+    low = values.min()
+    span = values.max() - low + 1
+    running = np.maximum.accumulate(values - low + codes * span)
+    for i, threshold in enumerate(thresholds):
+        targets = max(threshold - low, 0) + groups * span
+        found = np.searchsorted(running, targets, side='left')
+        result[:, i] = np.where(found < ends, found, -1)
+    return result
+
+
+def exceedance_times(ids: np.ndarray, times: np.ndarray, values: np.ndarray,
+                     thresholds: [float]):
+    """Find the first and last quarters each waterbody exceeds thresholds.
+
+    Arguments
+    ---------
+    ids : np.ndarray
+        Waterbody ID of each observation.
+
+    times : np.ndarray
+        Time of each observation, as datetime64 or int64 nanoseconds.
+
+    values : np.ndarray
+        Wet pixel percentage of each observation. NaNs are ignored.
+
+    thresholds : [float]
+        Wet pixel percentages to reach.
+
+    Returns
+    -------
+    pd.DataFrame
+        Indexed by waterbody ID, with columns First<threshold>% and
+        Last<threshold>% holding quarter labels (see quarter_labels), or
+        NODATA as a string if the threshold is never reached.
+    """
+    import pandas as pd
+    values = np.asarray(values, dtype=float)
+    valid = ~np.isnan(values)
+    values = values[valid]
+    times = np.asarray(times).astype('datetime64[ns]').astype(
+        'int64')[valid]
+    codes, unique_ids = pd.factorize(np.asarray(ids)[valid], sort=True)
+
+    columns = {}
+    for name, direction in [('First', 1), ('Last', -1)]:
+        order = np.lexsort((direction * times, codes))
+        found = _first_exceedances(codes[order], values[order],
+                                   len(unique_ids), thresholds)
+        labels = quarter_labels(times[order])
+        for i, threshold in enumerate(thresholds):
+            column = np.full(len(unique_ids), str(NODATA), dtype=object)
+            hit = found[:, i] >= 0
+            column[hit] = labels[found[hit, i]]
+            columns[f'{name}{threshold:g}%'] = column
+    return pd.DataFrame(columns, index=pd.Index(unique_ids))
+
+
+def read_long_table(path: str, n_workers: int = 1):
+    """Read all time series as (ids, times, values) arrays.
+
+    Arguments
+    ---------
+    path : str
+        A directory of waterbody time series CSVs, or a Parquet table with
+        UID, Observation Date and Wet pixel percentage columns.
+
+    n_workers : int
+        Number of processes to read CSVs with.
+    """
+    import pandas as pd
+    if str(path).rstrip('/').endswith('.parquet'):
+        table = pd.read_parquet(
+            path, columns=['UID', 'Observation Date', 'Wet pixel percentage'])
+        times = pd.to_datetime(table['Observation Date'], utc=True)
+        times = np.asarray(times.dt.tz_convert(None), dtype='datetime64[ns]')
+        return (table['UID'].values, times,
+                table['Wet pixel percentage'].values)
+
+    from dea_waterbodies.make_snapshot import list_timeseries
+    from dea_waterbodies.seasonal import read_long_timeseries
+    paths = list_timeseries(path)
+    logger.info(f'Reading {len(paths)} time series with {n_workers} '
+                'workers')
+    return read_long_timeseries(paths, n_workers=n_workers)
+
+
+@click.command()
+@click.option('--shapefile', type=click.Path(), required=True,
+              help='Path to the waterbody polygons to append to.')
+@click.option('--timeseries', type=click.Path(), required=True,
+              help='Directory of waterbody time series CSVs, or a Parquet '
+              'table of all time series.')
+@click.option('--output', type=click.Path(), required=True,
+              help='Path to write the appended polygons to.')
+@click.option('--thresholds', type=str, default='50',
+              help='Comma-separated wet pixel percentage thresholds, '
+              'e.g. 10,50,90. Default 50.')
+@click.option('--n-workers', type=int, default=None,
+              help='Number of processes to read time series CSVs with. '
+              'Defaults to the number of CPUs.')
+@click.option('-v', '--verbose', count=True)
+@click.version_option(version=dea_waterbodies.__version__)
+def main(shapefile, timeseries, output, thresholds, n_workers, verbose):
+    """Append when waterbodies first and last exceed wet thresholds."""
+    import geopandas as gp
+    from dea_waterbodies.make_snapshot import guess_id_field
+
+    # Set up logging.
+    loggers = [logging.getLogger(name)
+               for name in logging.root.manager.loggerDict
+               if not name.startswith('fiona')
+               and not name.startswith('sqlalchemy')
+               and not name.startswith('boto')]
+    stdout_hdlr = logging.StreamHandler(sys.stdout)
+    for logger_ in loggers:
+        if verbose == 0:
+            logging.basicConfig(level=logging.WARNING)
+        elif verbose == 1:
+            logging.basicConfig(level=logging.INFO)
+        elif verbose == 2:
+            logging.basicConfig(level=logging.DEBUG)
+        else:
+            raise click.ClickException('Maximum verbosity is -vv')
+        logger_.addHandler(stdout_hdlr)
+
+    try:
+        thresholds = [float(t) for t in thresholds.split(',')]
+    except ValueError:
+        raise click.ClickException(f'Invalid --thresholds: {thresholds}')
+    n_workers = n_workers or os.cpu_count()
+
+    polygons = gp.read_file(shapefile)
+    id_field = guess_id_field(polygons.columns)
+    ids, times, values = read_long_table(timeseries, n_workers=n_workers)
+    exceedances = exceedance_times(ids, times, values, thresholds)
+    logger.info(f'Found exceedances of {thresholds} for '
+                f'{len(exceedances)} waterbodies')
+
+    # Re-running replaces existing exceedance attributes.
+    polygons = polygons.drop(
+        columns=[c for c in exceedances.columns if c in polygons.columns])
+    polygons = polygons.merge(exceedances, left_on=id_field,
+                              right_index=True, how='left')
+    for column in exceedances.columns:
+        polygons[column] = polygons[column].fillna(str(NODATA))
+    logger.info(f'Writing appended polygons to {output}')
+    polygons.to_file(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Skip observations that can't cover a waterbody before loading them.
+
+A WOfL observation only counts towards a waterbody's time series if few
+enough of its pixels are invalid. Many solar days barely touch the
+waterbody, for example at the edge of a scene, and loading them is wasted
+work. The valid-data footprints of the datasets of a solar day show how
+much of the waterbody that day can possibly cover, so days that can't
+reach the threshold can be skipped without reading any pixels.
+
+Footprints are polygons, so they can't see Landsat 7 SLC-off stripes or
+cloud, and are grown by a pixel before comparing so that the estimate of
+coverage is never too low. Skipping a day therefore never changes a time
+series: the day would have been discarded anyway.
+
+Geoscience Australia
+2021
+"""
+
+import logging
+import math
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def footprint_coverage(datasets: list, geom, resolution=None) -> float:
+    """Most of a polygon that some datasets could cover, from 0 to 1.
+
+    Arguments
+    ---------
+    datasets : [datacube.model.Dataset]
+        Datasets whose footprints (extents) to union.
+
+    geom : datacube.utils.geometry.Geometry
+        Polygon to cover.
+
+    resolution : (float, float), optional
+        Pixel size. Footprints are grown by a pixel's diagonal, so that
+        pixels partly in a footprint count as covered.
+
+    Returns
+    -------
+    float
+        1 if any dataset has no footprint.
+    """
+    from shapely.geometry import shape
+    from shapely.ops import unary_union
+    polygon = shape(geom.__geo_interface__)
+    if not polygon.area:
+        return 1.0
+    footprints = []
+    for dataset in datasets:
+        if dataset.extent is None:
+            return 1.0
+        footprints.append(
+            shape(dataset.extent.to_crs(geom.crs).__geo_interface__))
+    footprint = unary_union(footprints)
+    if resolution is not None:
+        footprint = footprint.buffer(math.hypot(*resolution))
+    return min(footprint.intersection(polygon).area / polygon.area, 1.0)
+
+
+def filter_solar_days(datasets: list, geom, max_invalid_percent: float,
+                      resolution=None) -> (list, np.ndarray, np.ndarray):
+    """Drop the solar days that can't cover enough of a polygon.
+
+    Arguments
+    ---------
+    datasets : [datacube.model.Dataset]
+        Datasets to be loaded, grouped by solar day.
+
+    geom : datacube.utils.geometry.Geometry
+        Waterbody polygon.
+
+    max_invalid_percent : float
+        Days with at least this percentage of invalid pixels are
+        discarded, like unknown_percent_threshold.
+
+    resolution : (float, float), optional
+        Pixel size of the load.
+
+    Returns
+    -------
+    ([datacube.model.Dataset], np.ndarray, np.ndarray)
+        Datasets of the days that may cover the polygon, and the times of
+        the kept and skipped days, as dc.load labels them.
+    """
+    from datacube import Datacube
+    from datacube.api.query import query_group_by
+    if not datasets:
+        empty = np.array([], dtype='datetime64[ns]')
+        return [], empty, empty
+    grouped = Datacube.group_datasets(
+        datasets, query_group_by(group_by='solar_day'))
+    kept = []
+    kept_times = []
+    skipped = []
+    for time, day in zip(grouped.time.values, grouped.values):
+        coverage = footprint_coverage(day, geom, resolution)
+        if (1 - coverage) * 100 >= max_invalid_percent:
+            skipped.append(time)
+        else:
+            kept.extend(day)
+            kept_times.append(time)
+    if skipped:
+        logger.debug(f'Skipping {len(skipped)}/{len(grouped)} solar days '
+                     'that cannot cover the polygon')
+    return (kept, np.array(kept_times, dtype='datetime64[ns]'),
+            np.array(skipped, dtype='datetime64[ns]'))
@@ -0,0 +1,357 @@
+"""Keep a table of the latest state of every waterbody.
+
+generate_wb_timeseries knows the newest valid observation of each
+waterbody it processes, so it records it in a latest-state table as it
+goes. Current conditions can then be read from one small table instead of
+every waterbody's full time series.
+
+The table is a directory, locally or on S3. Each worker process buffers
+its updates and writes them to a new uniquely named shard every
+FLUSH_EVERY updates, every FLUSH_SECONDS from a background thread, and
+when it exits. Workers never write to the same file, shards are never
+rewritten, and readers never see a half-written shard. A worker killed
+without warning, say by the OOM killer, loses at most FLUSH_SECONDS of
+updates; waterbodies-ts also flushes before acknowledging queue messages
+and exits cleanly on SIGTERM. read_latest_state merges the table and all
+shards.
+
+Shards pile up, so once a run has finished, waterbodies-compact-state
+folds them into a single latest_state.csv. Shards written during
+compaction are kept for the next compaction. Concurrent compactions
+start again rather than overwrite each other's tables, but object stores
+can't lock, so run one compaction at a time.
+
+Geoscience Australia
+2021
+"""
+
+import atexit
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import fcntl
+import itertools
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import uuid
+
+import click
+import fsspec
+
+import dea_waterbodies
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ['UID', 'Observation Date', 'Wet pixel percentage',
+           'Wet pixel count', 'Pixel count', 'Updated']
+
+TABLE_NAME = 'latest_state.csv'
+
+SHARD_PREFIX = 'shard-'
+
+LOCK_NAME = '.compact.lock'
+
+# A writer writes a shard after this many updates, or after this many
+# seconds since it last wrote one, whichever comes first.
+FLUSH_EVERY = 500
+FLUSH_SECONDS = 60
+
+# Times to start compacting again if another compaction changes the table.
+COMPACT_ATTEMPTS = 5
+
+# One writer per state directory per process.
+_WRITERS = {}
+
+# Depth of the compaction locks this process holds, by lock file.
+_LOCKS_HELD = {}
+
+
+def _write_atomic(path: str, table):
+    """Write a CSV so that readers see either the old or the new file."""
+    fs, fs_path = fsspec.core.url_to_fs(path)
+    if 'file' in fs.protocol:
+        os.makedirs(os.path.dirname(fs_path), exist_ok=True)
+        tmp_path = f'{fs_path}.{uuid.uuid4().hex}.tmp'
+        table.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, fs_path)
+    else:
+        # Object stores replace objects atomically.
+        with fs.open(fs_path, 'w') as f:
+            table.to_csv(f, index=False)
+
+
+def _version(info: dict):
+    """Something that changes whenever a file is rewritten."""
+    return (info.get('size'), info.get('ETag'), info.get('mtime'),
+            info.get('LastModified'))
+
+
+class LatestStateWriter:
+    """Record the latest state of waterbodies processed by this process.
+
+    Arguments
+    ---------
+    path : str
+        Latest-state directory. May be an S3 URI.
+    """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        self.prefix = (f'{SHARD_PREFIX}{socket.gethostname()}-{os.getpid()}-'
+                       f'{uuid.uuid4().hex[:8]}')
+        self.records = {}
+        self.shard_paths = []
+        self._sequence = itertools.count()
+        self._flushed = time.monotonic()
+        # The background thread flushes too.
+        self._lock = threading.RLock()
+
+    def update(self, uid: str, date: str, wet_percentage: float,
+               wet_count: int, pixel_count: int):
+        """Record the latest valid observation of a waterbody."""
+        updated = datetime.now(timezone.utc).strftime(
+            '%Y-%m-%dT%H:%M:%S.%fZ')
+        with self._lock:
+            self.records[uid] = [uid, date, wet_percentage, wet_count,
+                                 pixel_count, updated]
+            if (len(self.records) >= FLUSH_EVERY
+                    or time.monotonic() - self._flushed >= FLUSH_SECONDS):
+                self.flush()
+
+    def flush(self):
+        """Write the updates since the last flush to a new shard."""
+        import pandas as pd
+        with self._lock:
+            self._flushed = time.monotonic()
+            if not self.records:
+                return
+            name = f'{self.prefix}-{next(self._sequence):06d}.csv'
+            shard_path = os.path.join(self.path, name)
+            _write_atomic(shard_path,
+                          pd.DataFrame(list(self.records.values()),
+                                       columns=COLUMNS))
+            self.shard_paths.append(shard_path)
+            self.records = {}
+
+
+def state_writer(path: str) -> LatestStateWriter:
+    """Get this process's writer for a latest-state directory."""
+    key = (str(path), os.getpid())
+    if key not in _WRITERS:
+        if not any(pid == os.getpid() for _, pid in _WRITERS):
+            atexit.register(flush_writers)
+            threading.Thread(target=_flush_periodically, daemon=True,
+                             name='latest-state-flush').start()
+        _WRITERS[key] = LatestStateWriter(path)
+    return _WRITERS[key]
+
+
+def flush_writers():
+    """Write the buffered updates of this process's writers."""
+    for (_, pid), writer in list(_WRITERS.items()):
+        if pid == os.getpid():
+            writer.flush()
+
+
+def flush_on_sigterm():
+    """Exit cleanly on SIGTERM, so that buffered updates are written.
+
+    PBS and Kubernetes send SIGTERM before killing a job, and Python skips
+    atexit when killed by a signal it doesn't handle.
+    """
+    signal.signal(signal.SIGTERM, _exit_on_signal)
+
+
+def _exit_on_signal(signum, frame):
+    sys.exit(128 + signum)
+
+
+def _flush_periodically():
+    """Flush every FLUSH_SECONDS, even if a worker stops updating."""
+    while True:
+        time.sleep(FLUSH_SECONDS)
+        try:
+            flush_writers()
+        except Exception:
+            # The next update or flush tries again.
+            logger.exception('Could not write latest state')
+
+
+def _list_state_files(path: str) -> (fsspec.AbstractFileSystem, dict):
+    fs, fs_path = fsspec.core.url_to_fs(str(path))
+    try:
+        listing = fs.ls(fs_path, detail=True)
+    except FileNotFoundError:
+        listing = []
+    files = {}
+    for info in listing:
+        name = os.path.basename(info['name'].rstrip('/'))
+        if name == TABLE_NAME or (name.startswith(SHARD_PREFIX)
+                                  and name.endswith('.csv')):
+            files[info['name']] = info
+    return fs, files
+
+
+def _read_tables(fs: fsspec.AbstractFileSystem, files: dict) -> list:
+    import pandas as pd
+    tables = []
+    for name in sorted(files):
+        try:
+            with fs.open(name, 'r') as f:
+                tables.append(pd.read_csv(f, dtype={'UID': str}))
+        except FileNotFoundError:
+            # Compacted away since listing, so it's in the table now.
+            logger.debug(f'Skipping {name}, which has been removed')
+    return tables
+
+
+def _merge(tables: list):
+    """Keep the most recently updated record of each waterbody."""
+    import pandas as pd
+    if not tables:
+        return pd.DataFrame(columns=COLUMNS)
+    state = pd.concat(tables, ignore_index=True)
+    state = state.sort_values('Updated', kind='stable')
+    state = state.drop_duplicates('UID', keep='last')
+    return state.sort_values('UID').reset_index(drop=True)[COLUMNS]
+
+
+def read_latest_state(path: str):
+    """Read the latest state of all waterbodies.
+
+    Arguments
+    ---------
+    path : str
+        Latest-state directory. May be an S3 URI.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per waterbody with the columns in COLUMNS, sorted by UID.
+    """
+    fs, files = _list_state_files(path)
+    return _merge(_read_tables(fs, files))
+
+
+@contextmanager
+def _compaction_lock(path: str):
+    """Stop local compactions of a directory from running at once.
+
+    The lock is reentrant, so a process already compacting a directory
+    can compact it again.
+    """
+    fs, fs_path = fsspec.core.url_to_fs(path)
+    if 'file' not in fs.protocol:
+        yield
+        return
+    lock_path = os.path.join(os.path.abspath(fs_path), LOCK_NAME)
+    if _LOCKS_HELD.get(lock_path):
+        _LOCKS_HELD[lock_path] += 1
+        try:
+            yield
+        finally:
+            _LOCKS_HELD[lock_path] -= 1
+        return
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        _LOCKS_HELD[lock_path] = 1
+        try:
+            yield
+        finally:
+            _LOCKS_HELD[lock_path] = 0
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _unchanged(files: dict, current: dict) -> bool:
+    """Whether the table and shards read are all still as they were.
+
+    Shards written since listing don't count, as compaction keeps them.
+    """
+    return all(name in current and _version(current[name]) == _version(info)
+               for name, info in files.items())
+
+
+def compact_latest_state(path: str):
+    """Fold all shards into a single latest-state table.
+
+    Shards written while compacting are kept. If another compaction
+    rewrites the table in the meantime, this one starts again rather than
+    overwrite it with an older merge.
+
+    Arguments
+    ---------
+    path : str
+        Latest-state directory. May be an S3 URI.
+
+    Returns
+    -------
+    pd.DataFrame
+        The compacted latest state.
+    """
+    path = str(path)
+    flush_writers()
+    with _compaction_lock(path):
+        for _ in range(COMPACT_ATTEMPTS):
+            fs, files = _list_state_files(path)
+            state = _merge(_read_tables(fs, files))
+            _, current = _list_state_files(path)
+            if _unchanged(files, current):
+                break
+            logger.info('Latest state changed by another compaction, '
+                        'starting again')
+        else:
+            raise RuntimeError(
+                f'Could not compact {path}: other compactions keep changing '
+                'it')
+        _write_atomic(os.path.join(path, TABLE_NAME), state)
+
+        _, after = _list_state_files(path)
+        removed = 0
+        for name, info in files.items():
+            if os.path.basename(name) == TABLE_NAME:
+                continue
+            if name in after and _version(after[name]) == _version(info):
+                fs.rm(name)
+                removed += 1
+    logger.info(f'Compacted {removed} shards into {len(state)} waterbodies')
+    return state
+
+
+@click.command()
+@click.argument('path', type=click.Path())
+@click.option('-v', '--verbose', count=True)
+@click.version_option(version=dea_waterbodies.__version__)
+def main(path, verbose):
+    """Fold the shards of a latest-state directory into one table.
+
+    Run this once the waterbodies-ts jobs writing to PATH have finished.
+    """
+    # Set up logging.
+    loggers = [logging.getLogger(name)
+               for name in logging.root.manager.loggerDict
+               if not name.startswith('fiona')
+               and not name.startswith('sqlalchemy')
+               and not name.startswith('boto')]
+    stdout_hdlr = logging.StreamHandler(sys.stdout)
+    for logger_ in loggers:
+        if verbose == 0:
+            logging.basicConfig(level=logging.WARNING)
+        elif verbose == 1:
+            logging.basicConfig(level=logging.INFO)
+        elif verbose == 2:
+            logging.basicConfig(level=logging.DEBUG)
+        else:
+            raise click.ClickException('Maximum verbosity is -vv')
+        logger_.addHandler(stdout_hdlr)
+
+    state = compact_latest_state(path)
+    click.echo(f'{len(state)} waterbodies in {path}')
+
+
+if __name__ == "__main__":
+    main()
@@ -17,8 +17,8 @@ import uuid
 
 import click
 import fsspec
-import geopandas as gpd
-from osgeo import ogr
+
+from dea_waterbodies.uids import uid_paths
 
 logger = logging.getLogger(__name__)
 
@@ -69,6 +69,7 @@ def get_polygon_context(path, extent_area=True):
         raise ValueError('If not extent_area then path must be to a DBF.')
 
     if not extent_area:
+        from osgeo import ogr
         # Can't use pathlib here in case we have an S3 URI instead of a local one.
         dbf_name = path.split('/')[-1]
         dbf_stem = dbf_name.split('.')[0]
@@ -87,6 +88,7 @@ def get_polygon_context(path, extent_area=True):
                         i.GetField('state'))
                         for i in layer]
     else:
+        import geopandas as gpd
         shp = gpd.read_file(path)
         area_ids = []
         for i, poly in shp.iterrows():
@@ -103,8 +105,7 @@ def get_polygon_context(path, extent_area=True):
 
 def construct_path(output_path: str, uid: str):
     """Construct the path to a waterbody CSV."""
-    # TODO(MatthewJA): Move this somewhere more general.
-    return os.path.join(output_path, uid[:4], uid)
+    return str(uid_paths(output_path, [uid])[0])
 
 
 def filter_polygons_by_context(
@@ -119,8 +120,8 @@ def filter_polygons_by_context(
     # Now filter to see if the output file already exists.
     if missing_only:
         missing_filtered = []
-        for context in state_filtered:
-            path = construct_path(output_path, context.uid)
+        paths = uid_paths(output_path, [c.uid for c in state_filtered])
+        for context, path in zip(state_filtered, paths):
             try:
                 with fsspec.open(path, 'r') as _:
                     # This exists!
@@ -6,17 +6,29 @@ Geoscience Australia - 2021
     Matthew Alger
 """
 
+import json
+import logging
 from pathlib import Path
 import math
-from typing import Container, Tuple
+from typing import TYPE_CHECKING, Container, Tuple
+
+from affine import Affine
 
 import geopandas as gp
 import pandas as pd
-import geohash as gh
-import datacube
-import numpy as np
-import rioxarray  # noqa: F401
-from dea_tools.spatial import xr_vectorize, xr_rasterize
+from shapely.geometry import LineString
+
+from dea_waterbodies.uids import assign_uids
+from dea_waterbodies.waterbody_polygon_functions import (
+    dirty_windows, filter_rivers, fingerprint_tile, merge_tiles, parallel_map,
+    query_pairs, read_manifest, run_stage, splice_polygons,
+    split_large_polygons, tile_key, tile_windows, vectorise_tile,
+    windows_region, write_manifest)
+
+if TYPE_CHECKING:
+    import datacube
+
+logger = logging.getLogger(__name__)
 
 
 # Sydney, Melbourne, Brisbane, Broadbeach, Surfers, Adelaide, Perth
@@ -30,36 +42,17 @@ BBOX_MENINDEE = (141.93057, -32.74068, 142.93699, -32.03379)
 URBAN_SA3_PATH = Path(__file__).parent / 'urban_sa3.geojson'
 
 
-def main(
-        bbox: Tuple[int] = BBOX_MENINDEE,
-        crs: str = 'EPSG:4326',
-        minimum_wet_percentage_detection: float = 0.1,
-        minimum_wet_percentage_extent: float = 0.05,
-        min_area_m2: int = 3125,
-        max_area_m2: int = 5000000000,
-        min_valid_observations: int = 128,
-        apply_min_valid_observations_first: bool = True,
-        urban_mask: bool = True,
-        sa3_urban_areas: Container[int] = DEFAULT_SA3_URBAN,
-        sa3_filepath: Path = Path('SA3_2016_AUST.shp'),
-        handle_large_polygons: str = 'nothing',
-        pp_thresh: float = 0.005,
-        base_filename: str = 'waterbodies',
-        output_path: Path = Path('_wb_outputs/'),
-        ):
-    minimum_wet_percentage = [minimum_wet_percentage_extent,
-                              minimum_wet_percentage_detection]
-    xlim = bbox[::2]
-    ylim = bbox[1::2]
-
-    # Load WOfS.
-    # Set up the datacube to get DEA data.
-    dc = datacube.Datacube(app='WaterbodyPolygons')
+def load_wofs(dc: 'datacube.Datacube', xlim: Tuple[float], ylim: Tuple[float],
+              crs: str):
+    """Lazily load the WOfS summaries for a region.
 
+    Returns
+    -------
+    (xr.Dataset, xr.Dataset)
+        wofs_summary with no-data set to nan, and wofs_filtered_summary.
+    """
     # Some query parameters.
     dask_chunks = {'x': 3000, 'y': 3000, 'time': 1}
-    # Resolution of WOfS, which changes depending on which collection you use.
-    resolution = (-25, 25)
 
     # Then load the WOfS summary of clear/wet observations:
     wofs_ = dc.load('wofs_summary', x=xlim, y=ylim, dask_chunks=dask_chunks)
@@ -71,62 +64,72 @@ def main(
     wofs_filtered_summary = dc.load(
         'wofs_filtered_summary', x=xlim, y=ylim,
         crs=crs, dask_chunks=dask_chunks).isel(time=0)
-
-    # Filter pixels with at least min_valid_observations times.
-    wofs_valid_filtered = wofs.count_clear >= min_valid_observations
-
-    # Initial polygon detection.
-    for threshold in minimum_wet_percentage:
-        # Remove any pixels that are wet < AtLeastThisWet% of the time
-        wofs_filtered = wofs_filtered_summary.wofs_filtered_summary > threshold
-
-        # Now find pixels that meet both the minimum valid observations
-        # and wetness percentage criteria
-
-        # Change all zeros to NaN to create a nan/1 mask layer
-        # Pixels == 1 now represent our water bodies
-        if apply_min_valid_observations_first:
-            wofs_filtered = wofs_filtered.where(
-                wofs_filtered & wofs_valid_filtered)
-        else:
-            wofs_filtered = wofs_filtered.where(wofs_filtered)
-
-        # Vectorise the raster.
-        polygons = xr_vectorize((wofs_filtered == 1).values, crs='EPSG:3577',
-                                transform=wofs_filtered_summary.rio.transform()
-                                )
-        polygons = polygons[polygons.attribute == 1].reset_index(drop=True)
-
-        # Combine any overlapping polygons
-        polygons = polygons.geometry.buffer(0).unary_union
-
-        # Turn the combined multipolygon back into a geodataframe
-        polygons = gp.GeoDataFrame(
-            geometry=[poly for poly in polygons])
-        # We need to add the crs back onto the dataframe
-        polygons.crs = 'EPSG:3577'
-
-        # Calculate the area of each polygon again now that overlapping
-        # polygons have been merged
-        polygons['area'] = polygons.area
-
-        # Save the polygons to a shapefile
-        filename = output_path / f'{base_filename}_raw_{threshold}.shp'
-        polygons.to_file(filename)
-
-    # Make sure we are using the detection threshold not the extent threshold.
-    assert threshold == minimum_wet_percentage[1]
-    assert minimum_wet_percentage[1] == max(minimum_wet_percentage)
-    polygons = gp.read_file(
-        output_path / f'{base_filename}_raw_{minimum_wet_percentage[1]}.shp')
+    return wofs, wofs_filtered_summary
+
+
+def vectorise_wofs(wofs, wofs_filtered_summary, threshold: float,
+                   min_valid_observations: int,
+                   apply_min_valid_observations_first: bool,
+                   tile_size: int = 3000,
+                   n_workers: int = 1) -> gp.GeoDataFrame:
+    """Find polygons of pixels wet more often than a threshold.
+
+    The summary is thresholded and vectorised in tiles, which can run in
+    parallel, and then polygons crossing tile seams are merged. The output
+    doesn't depend on n_workers.
+    """
+    import rioxarray  # noqa: F401
+    wet_frequency = wofs_filtered_summary.wofs_filtered_summary
+    windows = tile_windows(wet_frequency.shape, tile_size)
+
+    def tiles():
+        # Only load the data for a tile when it's about to be processed.
+        for rows, cols in windows:
+            # Remove any pixels that are wet < AtLeastThisWet% of the time,
+            # and optionally pixels without min_valid_observations.
+            tile_count_clear = None
+            if apply_min_valid_observations_first:
+                tile_count_clear = wofs.count_clear[rows, cols].values
+            yield (wet_frequency[rows, cols].values, tile_count_clear,
+                   threshold, min_valid_observations,
+                   (rows.start, cols.start))
+
+    tile_polygons = list(parallel_map(vectorise_tile, tiles(), n_workers))
+    return merge_tiles(tile_polygons, windows,
+                       wofs_filtered_summary.rio.transform(),
+                       crs='EPSG:3577')
+
+
+def filter_detected_polygons(
+        polygons: gp.GeoDataFrame,
+        dc: 'datacube.Datacube',
+        wofs,
+        xlim: Tuple[float],
+        ylim: Tuple[float],
+        min_area_m2: int,
+        max_area_m2: int,
+        urban_mask: bool,
+        sa3_urban_areas: Container[int],
+        sa3_filepath: Path,
+        query_crs: str = None) -> gp.GeoDataFrame:
+    """Remove polygons that are too small, too big, ocean, or urban.
+
+    xlim and ylim are the extent of wofs in query_crs, which defaults to
+    the datacube default of EPSG:4326.
+    """
+    from dea_tools.spatial import xr_rasterize
+    # Resolution of WOfS, which changes depending on which collection you use.
+    resolution = (-25, 25)
 
     # Filter polygons by size.
     polygons = polygons[
-        (polygons['area'] >= min_area_m2) & (polygons['area'] <= max_area_m2)]
+        (polygons['area'] >= min_area_m2) & (polygons['area'] <= max_area_m2)
+    ].copy()
 
     # Load the coastline.
+    query = {'crs': query_crs} if query_crs else {}
     coastline = dc.load('geodata_coast_100k', output_crs='EPSG:3577', x=xlim,
-                        y=ylim, resolution=resolution)
+                        y=ylim, resolution=resolution, **query)
 
     # Mark any polygon that intersects with the sea as ocean.
     # Set up a column to fill the raster with.
@@ -151,13 +154,14 @@ def main(
         city_overlay = gp.overlay(polygons, cbds.to_crs('EPSG:3577'))
         polygons = polygons[
             ~polygons.polygon_idx.isin(city_overlay.polygon_idx)]
+    return polygons
+
 
-    # Combine detected polygons with their maximum extent boundaries.
-    # Note that this assumes that the thresholds have been correctly entered
-    # into the 'minimum_wet_percentage' variable, with the extent threshold
-    # listed first.
-    lower_threshold = gp.read_file(
-        output_path / f'{base_filename}_raw_{minimum_wet_percentage[0]}.shp')
+def merge_extent(polygons: gp.GeoDataFrame,
+                 lower_threshold: gp.GeoDataFrame,
+                 max_area_m2: int) -> gp.GeoDataFrame:
+    """Combine detected polygons with their maximum extent boundaries."""
+    lower_threshold = lower_threshold.copy()
     lower_threshold['area'] = pd.to_numeric(lower_threshold.area)
     # Filter out those pesky huge polygons
     lower_threshold = lower_threshold.loc[
@@ -182,11 +186,12 @@ def main(
     polygons['area'] = polygons.area
     polygons['perimeter'] = polygons.length
     polygons['pp_test'] = polygons.area * 4 * math.pi / polygons.perimeter ** 2
+    return polygons
 
-    # Dump the merged polygons to a file:
-    polygons.to_file(output_path / f'{base_filename}_merged.shp')
 
-    # Split large polygons.
+def handle_large(polygons: gp.GeoDataFrame, handle_large_polygons: str,
+                 pp_thresh: float, n_workers: int = 1) -> gp.GeoDataFrame:
+    """Split large polygons."""
     if handle_large_polygons == 'erode-dilate-v1':
         needs_buffer = polygons[polygons.pp_test <= pp_thresh]
         unbuffered = needs_buffer.buffer(-50)
@@ -204,76 +209,330 @@ def main(
         # the polygons instead.
 
     if handle_large_polygons == 'erode-dilate-v2':
-        splittable = polygons[polygons.pp_test <= pp_thresh]
-        if len(splittable) >= 1:
-            unbuffered = splittable.buffer(-100)
-            buffered = unbuffered.buffer(125)
-            subtracted = gp.overlay(splittable, gp.GeoDataFrame(
-                geometry=[buffered.unary_union], crs=splittable.crs),
-                how='difference').explode().reset_index(drop=True)
-            resubtracted = gp.overlay(
-                splittable, subtracted, how='difference'
-                ).explode().reset_index(drop=True)
-
-            # Assign each chopped-off bit of the polygon to its nearest big
-            # neighbour.
-            unassigned = np.ones(len(subtracted), dtype=bool)
-            recombined = []
-            for i, poly in resubtracted.iterrows():
-                mask = (subtracted.exterior.intersects(poly.geometry.exterior)
-                        & unassigned)
-                neighbours = subtracted[mask]
-                unassigned[mask] = False
-                poly = poly.geometry.union(neighbours.unary_union)
-                recombined.append(poly)
-
-            # All remaining polygons are not part of a big polygon.
-            results = pd.concat([gp.GeoDataFrame(geometry=recombined),
-                                subtracted[unassigned],
-                                polygons[polygons.pp_test > pp_thresh]],
-                                ignore_index=True)
-
-            polygons = results.explode().reset_index(drop=True)
+        polygons = split_large_polygons(polygons, pp_thresh=pp_thresh,
+                                        erode=100, dilate=125,
+                                        n_workers=n_workers)
 
     if handle_large_polygons == 'nothing':
         print('Not splitting large polygons')
 
-    if not apply_min_valid_observations_first:
-        polygons['one_idx'] = range(1, len(polygons) + 1)
-        polygon_mask = xr_rasterize(polygons, wofs, attribute_col='one_idx')
-        counts = []
-        for i in polygons.one_idx:
-            mask = polygon_mask == i
-            count = wofs.count_clear.values[mask].max()
-            counts.append(count)
-        polygons['n_valid_observations'] = counts
-        polygons = polygons[
-            polygons.n_valid_observations >= min_valid_observations]
-
-    # Generate a unique ID for each polygon.
-    # We need to convert from Albers coordinates to lat/lon, in order to
-    # generate the geohash
-    polygons_4326 = polygons.to_crs(epsg=4326)
-
-    # Generate a geohash for the centroid of each polygon
-    polygons_4326['UID'] = polygons_4326.apply(
-        lambda x: gh.encode(x.geometry.centroid.y,
-                            x.geometry.centroid.x, precision=9), axis=1)
+    return polygons
+
+
+def filter_valid_observations(polygons: gp.GeoDataFrame, wofs,
+                              min_valid_observations: int
+                              ) -> gp.GeoDataFrame:
+    """Remove polygons without enough clear observations."""
+    from dea_tools.spatial import xr_rasterize
+    polygons = polygons.copy()
+    polygons['one_idx'] = range(1, len(polygons) + 1)
+    polygon_mask = xr_rasterize(polygons, wofs, attribute_col='one_idx')
+    counts = []
+    for i in polygons.one_idx:
+        mask = polygon_mask == i
+        count = wofs.count_clear.values[mask].max()
+        counts.append(count)
+    polygons['n_valid_observations'] = counts
+    return polygons[
+        polygons.n_valid_observations >= min_valid_observations]
+
+
+def tile_fingerprints(wofs, wofs_filtered_summary, thresholds: [float],
+                      min_valid_observations: int, tile_size: int = 3000,
+                      n_workers: int = 1) -> dict:
+    """Fingerprint the thresholded masks of each tile of the summary."""
+    wet_frequency = wofs_filtered_summary.wofs_filtered_summary
+    windows = tile_windows(wet_frequency.shape, tile_size)
+    tiles = ((wet_frequency[rows, cols].values,
+              wofs.count_clear[rows, cols].values,
+              thresholds, min_valid_observations)
+             for rows, cols in windows)
+    fingerprints = parallel_map(fingerprint_tile, tiles, n_workers)
+    return {tile_key(w): f for w, f in zip(windows, fingerprints)}
+
+
+def _pixel_window(bounds: (float, float, float, float), transform: Affine,
+                  shape: (int, int), pad: int) -> (slice, slice):
+    """The window of pixels covering some bounds, padded and clipped."""
+    inverse = ~transform
+    minx, miny, maxx, maxy = bounds
+    cols, rows = zip(*[inverse * (x, y) for x in (minx, maxx)
+                       for y in (miny, maxy)])
+    row_start = max(0, int(math.floor(min(rows))) - pad)
+    row_stop = min(shape[0], int(math.ceil(max(rows))) + pad)
+    col_start = max(0, int(math.floor(min(cols))) - pad)
+    col_stop = min(shape[1], int(math.ceil(max(cols))) + pad)
+    return slice(row_start, row_stop), slice(col_start, col_stop)
+
+
+def _window_edges(window: (slice, slice), transform: Affine,
+                  shape: (int, int)) -> gp.GeoSeries:
+    """Sides of a window that are inside the raster, as lines in CRS."""
+    rows, cols = window
+    corners = {
+        'top': [(cols.start, rows.start), (cols.stop, rows.start)],
+        'bottom': [(cols.start, rows.stop), (cols.stop, rows.stop)],
+        'left': [(cols.start, rows.start), (cols.start, rows.stop)],
+        'right': [(cols.stop, rows.start), (cols.stop, rows.stop)],
+    }
+    inside = {
+        'top': rows.start > 0,
+        'bottom': rows.stop < shape[0],
+        'left': cols.start > 0,
+        'right': cols.stop < shape[1],
+    }
+    return gp.GeoSeries([
+        LineString([transform * p for p in corners[side]])
+        for side in corners if inside[side]], crs='EPSG:3577')
+
+
+def update_polygons(pipeline, existing: gp.GeoDataFrame, wofs,
+                    wofs_filtered_summary, old_fingerprints: dict,
+                    new_fingerprints: dict, tile_size: int = 3000,
+                    pad: int = 8) -> gp.GeoDataFrame or None:
+    """Regenerate polygons only where the summary tiles changed.
+
+    Arguments
+    ---------
+    pipeline : callable
+        Makes polygons from (wofs, wofs_filtered_summary, xlim, ylim,
+        query_crs, checkpoint_dir).
+
+    existing : gp.GeoDataFrame
+        Polygons from the previous run, with UID and WB_ID.
+
+    wofs, wofs_filtered_summary : xr.Dataset
+        The new WOfS summaries.
+
+    old_fingerprints, new_fingerprints : dict
+        Tile fingerprints from the previous run and for the new summaries.
+
+    tile_size : int
+        Tile size used for the fingerprints.
+
+    pad : int
+        Pixels of context to load around the regenerated area. This should
+        be more than the erode-dilate distance.
+
+    Returns
+    -------
+    gp.GeoDataFrame, or None if nothing changed.
+    """
+    import rioxarray  # noqa: F401
+    transform = wofs_filtered_summary.rio.transform()
+    shape = wofs_filtered_summary.wofs_filtered_summary.shape
+    windows = tile_windows(shape, tile_size)
+    dirty = dirty_windows(old_fingerprints, new_fingerprints, windows)
+    if not dirty:
+        return None
+    logger.info(f'Regenerating {len(dirty)} of {len(windows)} tiles')
+    region = windows_region(dirty, transform).to_crs(existing.crs)
+
+    # Regenerate the dirty tiles along with all of any existing polygon
+    # that reaches into them.
+    _, hits = query_pairs(existing.geometry, region)
+    to_cover = pd.concat([region, existing.geometry.iloc[hits]])
+    window = _pixel_window(to_cover.to_crs('EPSG:3577').total_bounds,
+                           transform, shape, pad)
+    while True:
+        rows, cols = window
+        (x0, y0), (x1, y1) = (transform * (cols.start, rows.start),
+                              transform * (cols.stop, rows.stop))
+        polygons = pipeline(
+            wofs.isel(y=rows, x=cols),
+            wofs_filtered_summary.isel(y=rows, x=cols),
+            (min(x0, x1), max(x0, x1)), (min(y0, y1), max(y0, y1)),
+            'EPSG:3577', None)
+        _, new_idx = query_pairs(polygons.geometry, region.to_crs(
+            polygons.crs))
+        # Polygons touching the edge of the window might continue past it,
+        # in which case we need a bigger window.
+        edge_idx, _ = query_pairs(_window_edges(window, transform, shape),
+                                  polygons.geometry.iloc[new_idx])
+        if not len(edge_idx):
+            break
+        window = _pixel_window(
+            polygons.geometry.iloc[new_idx].total_bounds,
+            transform, shape, tile_size)
+        logger.info(f'Growing regeneration window to {window}')
+
+    return splice_polygons(existing, polygons, region)
 
-    # Check that our unique ID is in fact unique
-    assert polygons_4326['UID'].is_unique
 
-    # Make an arbitrary numerical ID for each polygon. We will first sort the
-    # dataframe by geohash so that polygons close to each other are numbered
-    # similarly
-    sorted_polygons = polygons_4326.sort_values(by=['UID']).reset_index()
-    sorted_polygons['WB_ID'] = sorted_polygons.index
+def main(
+        bbox: Tuple[int] = BBOX_MENINDEE,
+        crs: str = 'EPSG:4326',
+        minimum_wet_percentage_detection: float = 0.1,
+        minimum_wet_percentage_extent: float = 0.05,
+        min_area_m2: int = 3125,
+        max_area_m2: int = 5000000000,
+        min_valid_observations: int = 128,
+        apply_min_valid_observations_first: bool = True,
+        urban_mask: bool = True,
+        sa3_urban_areas: Container[int] = DEFAULT_SA3_URBAN,
+        sa3_filepath: Path = Path('SA3_2016_AUST.shp'),
+        rivers_path: Path = None,
+        rivers_where: str = None,
+        handle_large_polygons: str = 'nothing',
+        pp_thresh: float = 0.005,
+        base_filename: str = 'waterbodies',
+        output_path: Path = Path('_wb_outputs/'),
+        n_workers: int = 1,
+        checkpoint: bool = False,
+        incremental: bool = False,
+        tile_size: int = 3000,
+        ):
+    """Make waterbody polygons.
+
+    The stages are chained in memory. If checkpoint is True, the output of
+    each stage is also written to a GeoParquet file in output_path, keyed
+    by the parameters that stage depends on. Reruns then resume from the
+    latest checkpoint that is still valid, so changing e.g. pp_thresh only
+    reruns the stages after the merge.
+
+    With n_workers > 1, the summary is vectorised tile by tile and large
+    polygons are split on a pool of n_workers processes. The output is the
+    same as with one worker.
+
+    If rivers_path is given, polygons intersecting the river lines in that
+    file (optionally selected by the SQL rivers_where) are removed after
+    the size, ocean and urban filters. The river lines are read tile by
+    tile, in parallel.
+
+    If incremental is True, each tile of the summary is fingerprinted and
+    the fingerprints are kept next to the outputs. On the next incremental
+    run, only tiles whose thresholded masks changed (and their neighbours)
+    are regenerated and spliced into the existing polygons, which keep
+    their UIDs where their geometry didn't change.
+    """
+    # Note that this assumes that the thresholds have been correctly entered,
+    # with the extent threshold lower than the detection threshold.
+    assert minimum_wet_percentage_extent <= minimum_wet_percentage_detection
+    xlim = bbox[::2]
+    ylim = bbox[1::2]
+    checkpoint_dir = output_path if checkpoint else None
 
-    # The step above creates an 'index' column, which we don't actually want,
-    # so drop it.
-    sorted_polygons.drop(labels='index', axis=1, inplace=True)
+    # Load WOfS.
+    # Set up the datacube to get DEA data. These imports are slow, so
+    # they're done here rather than when the module is imported.
+    import datacube
+    import rioxarray  # noqa: F401
+    dc = datacube.Datacube(app='WaterbodyPolygons')
+    wofs, wofs_filtered_summary = load_wofs(dc, xlim, ylim, crs)
+
+    # Parameters each stage depends on, including those of upstream stages.
+    load_params = {
+        'bbox': list(bbox),
+        'crs': crs,
+        'min_valid_observations': min_valid_observations,
+        'apply_min_valid_observations_first':
+            apply_min_valid_observations_first,
+    }
+    detection_params = dict(load_params,
+                            threshold=minimum_wet_percentage_detection)
+    extent_params = dict(load_params, threshold=minimum_wet_percentage_extent)
+    filtered_params = dict(
+        detection_params,
+        min_area_m2=min_area_m2,
+        max_area_m2=max_area_m2,
+        urban_mask=urban_mask,
+        sa3_urban_areas=list(sa3_urban_areas) if urban_mask else None,
+        sa3_filepath=str(sa3_filepath) if urban_mask else None)
+    rivers_params = filtered_params
+    if rivers_path is not None:
+        rivers_params = dict(filtered_params, rivers_path=str(rivers_path),
+                             rivers_where=rivers_where)
+    merged_params = dict(rivers_params, extent=extent_params)
+    split_params = dict(merged_params,
+                        handle_large_polygons=handle_large_polygons,
+                        pp_thresh=pp_thresh)
+
+    def pipeline(wofs, wofs_filtered_summary, xlim, ylim, query_crs,
+                 checkpoint_dir):
+        """Make polygons for some WOfS summary data."""
+        def stage(name, params, compute):
+            return run_stage(name, compute, params,
+                             checkpoint_dir=checkpoint_dir,
+                             base_filename=base_filename)
+
+        # Each stage only asks for its inputs if its own checkpoint is
+        # missing.
+        def raw(threshold, params):
+            return stage(f'raw_{threshold}', params, lambda: vectorise_wofs(
+                wofs, wofs_filtered_summary, threshold,
+                min_valid_observations, apply_min_valid_observations_first,
+                tile_size=tile_size, n_workers=n_workers))
+
+        def filtered():
+            return stage('filtered', filtered_params,
+                         lambda: filter_detected_polygons(
+                             raw(minimum_wet_percentage_detection,
+                                 detection_params),
+                             dc, wofs, xlim, ylim, min_area_m2, max_area_m2,
+                             urban_mask, sa3_urban_areas, sa3_filepath,
+                             query_crs=query_crs))
+
+        def rivers():
+            if rivers_path is None:
+                return filtered()
+            return stage('rivers', rivers_params, lambda: filter_rivers(
+                filtered(), rivers_path, where=rivers_where,
+                n_workers=n_workers))
+
+        def merged():
+            return stage('merged', merged_params, lambda: merge_extent(
+                rivers(),
+                raw(minimum_wet_percentage_extent, extent_params),
+                max_area_m2))
+
+        def split():
+            return stage('split', split_params, lambda: handle_large(
+                merged(), handle_large_polygons, pp_thresh,
+                n_workers=n_workers))
+
+        def valid():
+            if apply_min_valid_observations_first:
+                return split()
+            return stage('valid', split_params,
+                         lambda: filter_valid_observations(
+                             split(), wofs, min_valid_observations))
+
+        return valid()
+
+    manifest_path = output_path / f'{base_filename}_tiles.json'
+    manifest = read_manifest(manifest_path) if incremental else None
+    if incremental:
+        fingerprints = tile_fingerprints(
+            wofs, wofs_filtered_summary,
+            [minimum_wet_percentage_extent, minimum_wet_percentage_detection],
+            min_valid_observations, tile_size=tile_size, n_workers=n_workers)
+    if manifest is not None and manifest['params'] != json.loads(
+            json.dumps(split_params, default=str)):
+        logger.info('Parameters changed since the last run, so '
+                    'regenerating all polygons')
+        manifest = None
+
+    if manifest is not None:
+        existing = gp.read_file(output_path / f'{base_filename}.shp')
+        polygons = update_polygons(
+            pipeline, existing, wofs, wofs_filtered_summary,
+            manifest['tiles'], fingerprints, tile_size=tile_size)
+        if polygons is None:
+            logger.info('No WOfS summary tiles changed')
+            return
+    else:
+        polygons = pipeline(wofs, wofs_filtered_summary, xlim, ylim, None,
+                            checkpoint_dir)
+
+        # Generate a unique ID for each polygon from the geohash of its
+        # centroid, then make an arbitrary numerical ID for each polygon. The
+        # polygons are sorted by geohash so that polygons close to each other
+        # are numbered similarly.
+        polygons = assign_uids(polygons)
 
     polygons.to_file(output_path / f'{base_filename}.shp',
                      driver='ESRI Shapefile')
     polygons.to_file(output_path / f'{base_filename}.geojson',
                      driver='GeoJSON')
+    if incremental:
+        write_manifest(manifest_path, fingerprints, split_params)
@@ -0,0 +1,365 @@
+"""Make a snapshot of waterbody conditions on some dates.
+
+For each snapshot date, we find the valid observation nearest to that date
+in every waterbody time series, and append its date and wet percentage to
+the waterbody polygons as attributes. Observations more than 45 days from
+the snapshot date are ignored.
+
+The time series are read by a pool of workers and the results gathered in
+memory, so the polygons are joined and written out exactly once.
+
+**Required inputs**
+
+a config file which contains the filename of the shapefile to append to
+(SHAPEFILE), the directory containing the waterbody time series
+(TIMESERIES_DIR), the output directory and filename (SNAPSHOT_DIR and
+SNAPSHOT_SHAPEFILE) and optionally a comma-separated list of dates
+(DATES). If no dates are given, the date of the latest WOfL in the
+datacube is used.
+
+Geoscience Australia
+2021
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import configparser
+from datetime import datetime, timedelta
+from functools import partial
+import logging
+import os
+from pathlib import Path
+import sys
+
+import click
+import numpy as np
+
+import dea_waterbodies
+
+logger = logging.getLogger(__name__)
+
+# Observations further than this from a snapshot date are ignored.
+MAX_DAYS = 45
+
+# Value for waterbodies with no observation near a snapshot date.
+NODATA = -999
+
+# Number of time series each worker reads per job.
+CHUNK_SIZE = 256
+
+
+def process_config(config_file: Path) -> dict:
+    config = configparser.ConfigParser()
+    config_dict = {}
+    config.read(config_file)
+    keys = {
+        'SHAPEFILE': 'shape_file',
+        'SNAPSHOT_DIR': 'snapshot_dir',
+        'SNAPSHOT_SHAPEFILE': 'snapshot_shapefile',
+        'TIMESERIES_DIR': 'timeseries_dir',
+    }
+    for key, param in keys.items():
+        if key in config['DEFAULT'].keys():
+            config_dict[param] = config['DEFAULT'][key].strip()
+
+    if 'DATES' in config['DEFAULT'].keys():
+        config_dict['dates'] = parse_dates(config['DEFAULT']['DATES'])
+    else:
+        config_dict['dates'] = None
+
+    return config_dict
+
+
+def parse_dates(dates: str) -> [str]:
+    """Parse a comma-separated list of YYYYMMDD dates."""
+    dates = [d.strip() for d in dates.split(',') if d.strip()]
+    for date in dates:
+        # Raises a ValueError if the date is malformed.
+        datetime.strptime(date, '%Y%m%d')
+    return dates
+
+
+def latest_wofl_date(product: str = 'wofs_albers') -> str:
+    """Get the date of the latest WOfL in the datacube, as YYYYMMDD."""
+    import datacube
+    dc = datacube.Datacube(app='waterbodies-snapshot')
+    current_time = datetime.now()
+    start_time = current_time - timedelta(days=MAX_DAYS)
+    datasets = dc.find_datasets(
+        product=product, time=(start_time.strftime('%Y-%m-%d'),
+                               current_time.strftime('%Y-%m-%d')))
+    if not datasets:
+        raise ValueError(
+            f'No {product} datasets in the last {MAX_DAYS} days')
+    latest = max(dataset.center_time for dataset in datasets)
+    logger.info(f'Latest WOfL in datacube is {latest}')
+    return latest.strftime('%Y%m%d')
+
+
+def list_timeseries(timeseries_dir: str) -> [str]:
+    """List all time series CSVs under a directory, which may be on S3."""
+    import fsspec
+    fs, _, (root,) = fsspec.get_fs_token_paths(timeseries_dir)
+    paths = fs.glob(root.rstrip('/') + '/**/*.csv')
+    return sorted(fs.unstrip_protocol(p) for p in paths)
+
+
+def guess_id_field(columns: [str]) -> str:
+    """Guess which column of the waterbody polygons holds their IDs."""
+    for guess in ['UID', 'WB_ID', 'FID', 'FID_1']:
+        if guess in columns:
+            return guess
+    return 'ID'
+
+
+def uid_from_path(path: str) -> str or int:
+    """Get the waterbody ID from a time series path.
+
+    Numeric IDs are returned as ints, for joining to older shapefiles that
+    use integer IDs.
+    """
+    uid = os.path.splitext(os.path.basename(path))[0]
+    try:
+        return int(uid)
+    except ValueError:
+        return uid
+
+
+def dates_to_ns(dates: [str]) -> np.ndarray:
+    """Convert YYYYMMDD dates to int64 nanoseconds since the epoch (UTC)."""
+    return np.array([f'{d[:4]}-{d[4:6]}-{d[6:]}' for d in dates],
+                    dtype='datetime64[ns]').view('int64')
+
+
+def read_timeseries(path: str):
+    """Read the valid observations of a time series.
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray)
+        Sorted observation times as int64 nanoseconds since the epoch (UTC),
+        and the wet pixel percentage at each time.
+    """
+    import pandas as pd
+    observations = pd.read_csv(
+        path, usecols=['Observation Date', 'Wet pixel percentage']).dropna()
+    times = pd.to_datetime(observations['Observation Date'], utc=True)
+    times = np.asarray(times.dt.tz_convert(None), dtype='datetime64[ns]')
+    times = times.view('int64')
+    percentages = observations['Wet pixel percentage'].values.astype(float)
+    order = np.argsort(times, kind='stable')
+    return times[order], percentages[order]
+
+
+def nearest_observations(times: np.ndarray, targets: np.ndarray,
+                         max_days: int = MAX_DAYS) -> np.ndarray:
+    """Find the observation nearest each target time.
+
+    Ties go to the later observation, like pandas' nearest lookup.
+
+    Arguments
+    ---------
+    times : np.ndarray
+        Sorted observation times as int64.
+
+    targets : np.ndarray
+        Target times as int64, in the same units as times (nanoseconds).
+
+    max_days : int
+        Observations at least this many days from a target don't count.
+
+    Returns
+    -------
+    np.ndarray
+        Index into times for each target, or -1 if there is no observation
+        within max_days.
+    """
+    targets = np.asarray(targets, dtype='int64')
+    if not len(times):
+        return np.full(targets.shape, -1)
+    right = np.searchsorted(times, targets)
+    left = np.maximum(right - 1, 0)
+    right = np.minimum(right, len(times) - 1)
+    left_distance = np.abs(targets - times[left])
+    right_distance = np.abs(times[right] - targets)
+    nearest = np.where(left_distance < right_distance, left, right)
+    distance = np.minimum(left_distance, right_distance)
+    max_distance = np.timedelta64(max_days, 'D').astype('timedelta64[ns]')
+    return np.where(distance < max_distance.astype('int64'), nearest, -1)
+
+
+def snapshot_timeseries(path: str, dates: [str]) -> dict:
+    """Find the observations nearest some dates in one time series.
+
+    The series is read once, and all dates are looked up at once.
+
+    Arguments
+    ---------
+    path : str
+        Path to a waterbody time series CSV.
+
+    dates : [str]
+        Snapshot dates as YYYYMMDD.
+
+    Returns
+    -------
+    dict
+        Maps each date to the nearest observation time (as a string) and
+        Pc + date to its wet pixel percentage, or NODATA if there is no
+        valid observation within MAX_DAYS.
+    """
+    import pandas as pd
+    snapshot = {}
+    for date in dates:
+        snapshot[date] = NODATA
+        snapshot[f'Pc{date}'] = NODATA
+    try:
+        times, percentages = read_timeseries(path)
+    except (OSError, ValueError) as e:
+        logger.warning(f'Could not read {path}: {e}')
+        return snapshot
+
+    nearest = nearest_observations(times, dates_to_ns(dates))
+    for date, i in zip(dates, nearest):
+        if i < 0:
+            logger.debug(f'No observation in snapshot range for {path} '
+                         f'for date {date}')
+            continue
+        snapshot[date] = str(pd.Timestamp(times[i], tz='UTC'))
+        snapshot[f'Pc{date}'] = float(percentages[i])
+    return snapshot
+
+
+def make_snapshot(paths: [str], dates: [str], id_field: str,
+                  n_workers: int = 1):
+    """Snapshot many time series.
+
+    Arguments
+    ---------
+    paths : [str]
+        Paths to waterbody time series CSVs, named by waterbody ID.
+
+    dates : [str]
+        Snapshot dates as YYYYMMDD.
+
+    id_field : str
+        Name of the ID column in the output.
+
+    n_workers : int
+        Number of processes to read time series with. Default 1.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per time series, with the ID, and for each date, the date
+        of the nearest observation and its wet pixel percentage.
+    """
+    import pandas as pd
+    extract = partial(snapshot_timeseries, dates=dates)
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            chunksize = max(1, min(CHUNK_SIZE, len(paths) // n_workers))
+            snapshots = list(executor.map(extract, paths,
+                                          chunksize=chunksize))
+    else:
+        snapshots = [extract(path) for path in paths]
+
+    columns = [id_field]
+    for date in dates:
+        columns += [date, f'Pc{date}']
+    snapshot = pd.DataFrame(snapshots, columns=columns[1:])
+    snapshot.insert(0, id_field, [uid_from_path(p) for p in paths])
+    return snapshot
+
+
+def join_snapshot(polygons, snapshot, id_field: str, dates: [str]):
+    """Join a snapshot to waterbody polygons."""
+    # Re-running a snapshot for a date replaces its columns.
+    polygons = polygons.drop(
+        columns=[c for c in snapshot.columns
+                 if c != id_field and c in polygons.columns])
+    polygons = polygons.merge(snapshot, on=id_field, how='left')
+    for date in dates:
+        # Observation dates are strings, except NODATA.
+        polygons[date] = polygons[date].where(
+            polygons[date].isna(), polygons[date].astype(str))
+        polygons[f'Pc{date}'] = polygons[f'Pc{date}'].astype(float)
+    return polygons
+
+
+@click.command()
+@click.argument('config', type=click.Path())
+@click.option('--dates', type=str, default=None,
+              help='Comma-separated snapshot dates as YYYYMMDD. Overrides '
+              'DATES in the config. If no dates are given, the date of the '
+              'latest WOfL in the datacube is used.')
+@click.option('--n-workers', type=int, default=None,
+              help='Number of processes to read time series with. Defaults '
+              'to the number of CPUs.')
+@click.option('--wofls', default='wofs_albers',
+              help='Which WOfLs product to find the latest date from.')
+@click.option('-v', '--verbose', count=True)
+@click.version_option(version=dea_waterbodies.__version__)
+def main(config, dates, n_workers, wofls, verbose):
+    """Append the waterbody conditions on some dates to a shapefile."""
+    import geopandas as gp
+
+    # Set up logging.
+    loggers = [logging.getLogger(name)
+               for name in logging.root.manager.loggerDict
+               if not name.startswith('fiona')
+               and not name.startswith('sqlalchemy')
+               and not name.startswith('boto')]
+    stdout_hdlr = logging.StreamHandler(sys.stdout)
+    for logger_ in loggers:
+        if verbose == 0:
+            logging.basicConfig(level=logging.WARNING)
+        elif verbose == 1:
+            logging.basicConfig(level=logging.INFO)
+        elif verbose == 2:
+            logging.basicConfig(level=logging.DEBUG)
+        else:
+            raise click.ClickException('Maximum verbosity is -vv')
+        logger_.addHandler(stdout_hdlr)
+
+    config_dict = process_config(config)
+    missing = [key for key in ['shape_file', 'snapshot_dir',
+                               'snapshot_shapefile', 'timeseries_dir']
+               if key not in config_dict]
+    if missing:
+        raise click.ClickException(
+            f'Config {config} is missing {", ".join(missing).upper()}')
+    if dates:
+        try:
+            config_dict['dates'] = parse_dates(dates)
+        except ValueError as e:
+            raise click.ClickException(f'Invalid --dates: {e}')
+    if not config_dict['dates']:
+        config_dict['dates'] = [latest_wofl_date(wofls)]
+    dates = config_dict['dates']
+    n_workers = n_workers or os.cpu_count()
+    logger.info(f'Appending shapefile with nearest values to {dates}')
+
+    # If we've already made a snapshot, add to it.
+    output_shapefile = os.path.join(config_dict['snapshot_dir'],
+                                    config_dict['snapshot_shapefile'])
+    shape_file = config_dict['shape_file']
+    if os.path.isfile(output_shapefile):
+        logger.info(f'Appending to existing snapshot {output_shapefile}')
+        shape_file = output_shapefile
+    polygons = gp.read_file(shape_file)
+    id_field = guess_id_field(polygons.columns)
+    logger.info(f'The index we will use is {id_field}')
+
+    paths = list_timeseries(config_dict['timeseries_dir'])
+    logger.info(f'Reading {len(paths)} time series with {n_workers} '
+                'workers')
+    snapshot = make_snapshot(paths, dates, id_field, n_workers=n_workers)
+    snapshot.to_csv(f'{output_shapefile}{dates[0]}.csv', index=False)
+
+    polygons = join_snapshot(polygons, snapshot, id_field, dates)
+    logger.info(f'Writing appended shapefile {output_shapefile}')
+    polygons.to_file(output_shapefile)
+
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,7 @@ Geoscience Australia - 2021
 
 import configparser
 import logging
+import os
 from pathlib import Path
 import re
 import sys
@@ -92,9 +93,40 @@ def process_config(config_file: Path) -> dict:
     else:
         config_dict['wofls'] = 'wofs_albers'
 
+    if 'LATEST_STATE' in config['DEFAULT'].keys():
+        config_dict['latest_state'] = config['DEFAULT']['LATEST_STATE']
+
+    if 'METRICS' in config['DEFAULT'].keys():
+        config_dict['metrics'] = config['DEFAULT']['METRICS']
+
+    if 'SEARCH_CACHE' in config['DEFAULT'].keys():
+        config_dict['search_cache'] = config['DEFAULT']['SEARCH_CACHE']
+
+    if 'EXTRA_OUTPUTS' in config['DEFAULT'].keys():
+        # One output directory and validity threshold per line.
+        config_dict['extra_outputs'] = [
+            tuple(line.rsplit(maxsplit=1))
+            for line in config['DEFAULT']['EXTRA_OUTPUTS'].splitlines()
+            if line.strip()]
+
+    if 'WOFL_CACHE' in config['DEFAULT'].keys():
+        config_dict['wofl_cache'] = config['DEFAULT']['WOFL_CACHE']
+
+    if 'WOFL_CACHE_SIZE' in config['DEFAULT'].keys():
+        config_dict['wofl_cache_size'] = float(
+            config['DEFAULT']['WOFL_CACHE_SIZE'])
+
     return config_dict
 
 
+def _normalise_dir(path) -> str:
+    """A directory path that's the same however it's written."""
+    path = str(path)
+    if '://' in path:
+        return path.rstrip('/')
+    return os.path.abspath(path)
+
+
 def get_crs(shapefile_path):
     from datacube.utils import geometry
     import fiona
@@ -124,6 +156,7 @@ def get_shapes(config_dict: dict,
                wb_ids: [str] or None,
                id_field: str) -> [dict]:
     import fiona
+    from dea_waterbodies.uids import uid_paths
     output_dir = config_dict['output_dir']
 
     # If missing_only, remove waterbodies that already exist.
@@ -135,10 +168,10 @@ def get_shapes(config_dict: dict,
         # TODO(MatthewJA): Use Paths earlier on and don't convert here.
         # TODO(MatthewJA): Why doesn't this break with S3 paths?
         output_dir = Path(config_dict['output_dir'])
+        out_paths = uid_paths(output_dir, wb_ids)
         missing_list = []
-        for id_ in wb_ids:
-            out_path = output_dir / id_[:4] / f'{id}.csv'
-            if out_path.exists():
+        for id_, out_path in zip(wb_ids, out_paths):
+            if Path(out_path).exists():
                 continue
 
             missing_list.append(id_)
@@ -170,6 +203,24 @@ def get_shapes(config_dict: dict,
     return filtered_shapes
 
 
+def make_plan(shapes: [dict], config_dict: dict, plan_path: str,
+              walltime: float):
+    """Write a plan for some waterbodies and print a summary."""
+    from dea_waterbodies import plan
+
+    coefficients = None
+    metrics_path = config_dict.get('metrics')
+    if (metrics_path and Path(metrics_path).exists()
+            and not metrics_path.endswith('.prom')):
+        coefficients = plan.fit_coefficients(metrics_path)
+        logger.info(f'Fitted runtime coefficients {coefficients}')
+    logger.info(f'Planning {len(shapes)} waterbodies')
+    table = plan.plan(shapes, config_dict, coefficients=coefficients)
+    table.to_csv(plan_path, index=False)
+    recommendation = plan.recommend(table, walltime)
+    click.echo(plan.format_plan(table, recommendation))
+
+
 @click.command()
 @click.argument('ids', required=False, default='')
 @click.option('--config', '-c', type=click.Path(), default=None,
@@ -218,6 +269,13 @@ def get_shapes(config_dict: dict,
               'output timeseries. if you specify --no-mask-obs then you will '
               'only filter out timesteps with 100% invalid pixels. You will '
               'also record the number invalid pixels per timestep.')
+@click.option('--extra-output', multiple=True, default=None,
+              type=(click.Path(), click.FloatRange(0, 100, min_open=True)),
+              help='Output directory and percentage of invalid pixels at '
+              'which to discard timesteps, for another time series made '
+              'from the same data, e.g. --extra-output uncertainty/ 100. '
+              'Time series with a threshold of 100 include the invalid '
+              'pixel count, like --no-mask-obs. Can be repeated.')
 @click.option('--all/--some', default=False,
               help='Option to run a subset of the polygons in '
               'the --shapefile, or --all of them (default). If --some, you '
@@ -226,11 +284,45 @@ def get_shapes(config_dict: dict,
               help='Name of AWS SQS to read from instead of [ids]')
 @click.option('--wofls', default=None,
               help='Name of WOfLs product; default wofs_albers')
+@click.option('--latest-state', type=click.Path(), default=None,
+              help='Directory of a table of the latest valid observation of '
+              'each waterbody, which is updated as time series are written. '
+              'Run waterbodies-compact-state on it when all jobs are done.')
+@click.option('--metrics', type=click.Path(), default=None,
+              help='File to record timings and sizes of each waterbody in, '
+              'as JSON lines, or as a Prometheus textfile if it ends in '
+              '.prom.')
+@click.option('--search-cache', type=click.Path(), default=None,
+              help='File to save the datasets found for this run in, so '
+              'that later runs over the same time range can skip searching '
+              'the datacube index. Reused for a day, or for as long as no '
+              'new datasets could be in its time range.')
+@click.option('--wofl-cache', type=click.Path(file_okay=False), default=None,
+              help='Local directory to cache loaded WOfLs in, so that '
+              'reruns (including with --no-mask-obs) don\'t load them again. '
+              'Can be shared by workers on the same node.')
+@click.option('--wofl-cache-size', type=float, default=None,
+              help='Most gigabytes to keep in --wofl-cache. Default 50.')
+@click.option('--profile', type=click.FloatRange(0, 1), default=0,
+              help='Fraction of waterbodies to profile, e.g. 0.01. The same '
+              'waterbodies are picked every run. Default 0.')
+@click.option('--profile-dir', type=click.Path(), default='profiles',
+              help='Directory to write profiles to. Default profiles.')
+@click.option('--plan', type=click.Path(), default=None,
+              help='Instead of making time series, estimate the pixels, '
+              'timesteps, memory and runtime of each waterbody from a '
+              'dataset search, write them to this CSV, and recommend a '
+              'worker count and memory request. If --metrics is an existing '
+              'JSON lines file, runtimes are fitted to it.')
+@click.option('--plan-walltime', type=float, default=6,
+              help='Hours the planned job may run for. Default 6.')
 @click.option('-v', '--verbose', count=True)
 @click.version_option(version=dea_waterbodies.__version__)
 def main(ids, config, shapefile, start, end, missing_only,
-         time_span, output, state, no_mask_obs, all,
-         from_queue, wofls, verbose):
+         time_span, output, state, no_mask_obs, extra_output, all,
+         from_queue, wofls, latest_state, metrics, search_cache, wofl_cache,
+         wofl_cache_size, profile, profile_dir, plan, plan_walltime,
+         verbose):
     """
     Make the waterbodies time series. \n
     Args: \n
@@ -289,7 +381,13 @@ def main(ids, config, shapefile, start, end, missing_only,
         'output': 'output_dir',
         'state': 'filter_state',
         'no_mask_obs': 'include_uncertainty',
+        'extra_output': 'extra_outputs',
         'wofls': 'wofls',
+        'latest_state': 'latest_state',
+        'metrics': 'metrics',
+        'search_cache': 'search_cache',
+        'wofl_cache': 'wofl_cache',
+        'wofl_cache_size': 'wofl_cache_size',
     }
     locals_ = locals()
     for cli_p, config_p in override_param_map.items():
@@ -303,6 +401,35 @@ def main(ids, config, shapefile, start, end, missing_only,
     if not config_dict['wofls']:
         config_dict['wofls'] = 'wofs_albers'
 
+    # Gigabytes, or the default if None.
+    if config_dict['wofl_cache_size'] is not None:
+        if config_dict['wofl_cache_size'] <= 0:
+            raise click.ClickException('--wofl-cache-size must be positive')
+        config_dict['wofl_cache_bytes'] = int(
+            config_dict['wofl_cache_size'] * 2 ** 30)
+    else:
+        from dea_waterbodies.wofl_cache import DEFAULT_MAX_BYTES
+        config_dict['wofl_cache_bytes'] = DEFAULT_MAX_BYTES
+
+    # Each extra output is a directory and threshold, like --extra-output
+    # checks, and every output needs its own directory.
+    output_dirs = [_normalise_dir(config_dict['output_dir'])]
+    for extra_output in config_dict['extra_outputs'] or []:
+        try:
+            output_dir, threshold = extra_output
+            threshold = float(threshold)
+        except ValueError:
+            raise click.ClickException(
+                f'Bad extra output {" ".join(map(str, extra_output))}: '
+                'expected a directory and a threshold')
+        if not 0 < threshold <= 100:
+            raise click.ClickException(
+                f'Bad extra output {output_dir} {threshold}: the threshold '
+                'must be more than 0 and at most 100')
+        output_dirs.append(_normalise_dir(output_dir))
+    if len(set(output_dirs)) != len(output_dirs):
+        raise click.ClickException('Each output needs its own directory')
+
     # Additional validation of parameters.
     # If time_span is CUSTOM, start and end should also be specified.
     if config_dict['time_span'] == 'CUSTOM':
@@ -332,6 +459,10 @@ def main(ids, config, shapefile, start, end, missing_only,
         raise click.ClickException(
             'If --from-queue then no IDs should be specified')
 
+    if plan and from_queue:
+        raise click.ClickException(
+            '--plan needs IDs or --all, not --from-queue')
+
     if ids:
         ids = ids.split(',')
         if all:
@@ -366,6 +497,58 @@ def main(ids, config, shapefile, start, end, missing_only,
     # Do the import here so that the CLI is fast,
     # because this import is sloooow.
     import dea_waterbodies.waterbody_timeseries_functions as dw_wtf
+    from dea_waterbodies.metrics import (
+        RunSummary, WaterbodyMetrics, metrics_writer)
+
+    run_summary = RunSummary()
+    writer = (metrics_writer(config_dict['metrics'])
+              if config_dict['metrics'] else None)
+
+    profiler = None
+    if profile:
+        from dea_waterbodies.profiling import Profiler
+        profiler = Profiler(profile_dir, profile)
+
+    def process(shape, attempt=1):
+        uid = shape['properties'][id_field]
+        polygon_metrics = WaterbodyMetrics(uid)
+        polygon_metrics.attempt = attempt
+        try:
+            if profiler is not None and profiler.sampled(uid):
+                with profiler.profile(uid, attempt):
+                    return dw_wtf.generate_wb_timeseries(
+                        shape, config_dict, metrics=polygon_metrics,
+                        search_cache=dataset_cache)
+            return dw_wtf.generate_wb_timeseries(
+                shape, config_dict, metrics=polygon_metrics,
+                search_cache=dataset_cache)
+        finally:
+            run_summary.add(polygon_metrics)
+            if writer:
+                writer.write(polygon_metrics)
+
+    from dea_waterbodies.retries import call_with_retries, classify_error
+    failures = []
+
+    def process_with_retry(shape):
+        # Time windows are already retried, so this is a last resort. Windows
+        # that were drilled before the failure aren't drilled again.
+        uid = shape['properties'][id_field]
+        for attempt in (1, 2):
+            try:
+                result = process(shape, attempt=attempt)
+            except Exception as e:
+                logger.warning(f'{uid} failed with a {classify_error(e)} '
+                               f'error on attempt {attempt}: {e!r}')
+                if attempt == 2:
+                    logger.exception(f'Giving up on {uid}')
+                    failures.append(uid)
+                    return None
+                continue
+            if result:
+                return result
+            logger.info(f'Retrying {uid}')
+        return result
 
     # Get the CRS from the shapefile.
     crs = get_crs(config_dict['shape_file'])
@@ -386,12 +569,34 @@ def main(ids, config, shapefile, start, end, missing_only,
     # -> Use existing IDs
 
     logger.info(f'Using WOfLs product {config_dict["wofls"]}')
+    if config_dict['latest_state']:
+        from dea_waterbodies.latest_state import flush_on_sigterm
+        flush_on_sigterm()
+
+    if plan:
+        make_plan(get_shapes(config_dict, ids, id_field), config_dict, plan,
+                  plan_walltime * 3600)
+        return 0
+
+    # Datasets are searched for once per run rather than once per polygon.
+    from dea_waterbodies.search_cache import (
+        open_search_cache, run_time_range)
+    dataset_cache = open_search_cache(config_dict['wofls'],
+                                      run_time_range(config_dict),
+                                      config_dict['search_cache'])
+
     if not from_queue:
         # Open the shapefile and get the list of polygons.
         shapes = get_shapes(config_dict, ids, id_field)
         logger.info(f'Found {len(shapes)} polygons for processing, '
                     f'out of a possible {len(ids or [])} (from ids list).')
 
+        from datacube.utils import geometry
+        geoms = [geometry.Geometry(shape['geometry'], crs=crs)
+                 for shape in shapes]
+        call_with_retries(lambda: dataset_cache.prefetch(geoms),
+                          'prefetching datasets')
+
         # Loop through the polygons and write out a CSV of wet percentage,
         # wet area, and wet pixel count.
         # Attempt each polygon 2 times.
@@ -401,14 +606,7 @@ def main(ids, config, shapefile, start, end, missing_only,
                 shape['properties'][id_field],
                 i + 1,
                 len(shapes)))
-            result = dw_wtf.generate_wb_timeseries(
-                shape, config_dict)
-            if not result:
-                logger.info('Retrying {}'.format(
-                    shape['properties'][id_field]
-                ))
-                result = dw_wtf.generate_wb_timeseries(
-                    shape, config_dict)
+            process_with_retry(shape)
 
     else:
         # From queue
@@ -451,11 +649,17 @@ def main(ids, config, shapefile, start, end, missing_only,
                     id_,
                     i + 1,
                     len(shapes)))
-                result = dw_wtf.generate_wb_timeseries(
-                    shape, config_dict)
+                result = process_with_retry(shape)
 
-                # Delete from queue.
+                # Delete from queue. Failures are left on the queue to be
+                # tried again by another worker.
                 if result:
+                    # The message is gone once deleted, so its waterbody's
+                    # latest state must be written first.
+                    if config_dict['latest_state']:
+                        from dea_waterbodies.latest_state import (
+                            flush_writers)
+                        flush_writers()
                     logger.info(f'Successful, deleting {id_}')
                     resp = queue.delete_messages(
                         QueueUrl=queue_url, Entries=[entry],
@@ -466,7 +670,20 @@ def main(ids, config, shapefile, start, end, missing_only,
                             f"Failed to delete message: {entry}"
                         )
 
+    # Shards are compacted by waterbodies-compact-state once all of the
+    # workers are done.
+    if config_dict['latest_state']:
+        from dea_waterbodies.latest_state import flush_writers
+        flush_writers()
+
+    if config_dict['search_cache']:
+        dataset_cache.save(config_dict['search_cache'])
+
     logger.info('Processing complete.')
+    click.echo(run_summary.format())
+    if failures:
+        raise click.ClickException(
+            f'{len(failures)} polygons failed: {", ".join(failures)}')
 
     return 0
 
@@ -0,0 +1,373 @@
+"""Record where the time goes when making waterbody time series.
+
+generate_wb_timeseries fills in a WaterbodyMetrics for each waterbody it
+processes: the wall time of each stage (dataset search, load, mask,
+reduction and write), the bytes and pixels loaded, the number of
+timesteps, and the resident memory of the process. ru_maxrss, the peak
+resident memory, is a high-water mark over the life of the process, so
+after the largest waterbody every later one would report the same peak.
+Each waterbody therefore records the resident memory when it finishes
+and how much that grew while it was processed. The process's peak is
+recorded separately as process_peak_rss_bytes. A MetricsWriter
+records these as they are made, either as one JSON object per line, or as
+totals in a Prometheus textfile for node_exporter's textfile collector
+(when the path ends in .prom). A RunSummary adds them up into the
+throughput of a whole run.
+
+Geoscience Australia
+2021
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Stages of generate_wb_timeseries, in order.
+STAGES = ('search', 'load', 'mask', 'reduce', 'write')
+
+# Prefix of Prometheus metric names.
+PROMETHEUS_PREFIX = 'waterbodies'
+
+# One writer per metrics file per process.
+_WRITERS = {}
+
+
+def current_rss() -> int or None:
+    """Resident memory of this process now in bytes, if known."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):  # Not Linux
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def process_peak_rss() -> int or None:
+    """Peak resident memory over the life of this process in bytes."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, and macOS bytes.
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return peak
+
+
+class WaterbodyMetrics:
+    """Timings and sizes from processing one waterbody.
+
+    Arguments
+    ---------
+    uid : str
+        Waterbody ID.
+    """
+
+    def __init__(self, uid: str = None):
+        self.uid = uid
+        self.seconds = OrderedDict((stage, 0.0) for stage in STAGES)
+        self.datasets = 0
+        self.bytes_read = 0
+        self.pixels = 0
+        self.timesteps = 0
+        self.skipped_datasets = 0
+        self.skipped_timesteps = 0
+        self.cache_hits = 0
+        self.rss = None
+        self.process_peak_rss = None
+        self.status = None
+        self.attempt = 1
+        self.retries = 0
+        self._start = time.perf_counter()
+        self._end = None
+        self._start_rss = current_rss()
+
+    def add_seconds(self, stage: str, seconds: float):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name: str):
+        """Add the time spent in a with block to a stage."""
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_seconds(name, time.perf_counter() - start)
+
+    def add_load(self, wofl):
+        """Count the size of a loaded WOfL xarray."""
+        if 'water' not in wofl:
+            return
+        self.bytes_read += int(wofl.water.nbytes)
+        self.pixels += int(wofl.water.size)
+        self.timesteps += int(wofl.sizes.get('time', 0))
+
+    def finish(self, status: str = None):
+        """Stop the clock and note how processing ended."""
+        self._end = time.perf_counter()
+        if status is not None:
+            self.status = status
+        self.rss = current_rss()
+        self.process_peak_rss = process_peak_rss()
+
+    @property
+    def rss_growth(self) -> int or None:
+        """Bytes the resident memory grew by while processing."""
+        if self.rss is None or self._start_rss is None:
+            return None
+        return self.rss - self._start_rss
+
+    @property
+    def total_seconds(self) -> float:
+        end = self._end if self._end is not None else time.perf_counter()
+        return end - self._start
+
+    def as_dict(self) -> dict:
+        return {
+            'uid': self.uid,
+            'status': self.status,
+            'attempt': self.attempt,
+            'retries': self.retries,
+            'seconds': round(self.total_seconds, 6),
+            'stage_seconds': {stage: round(seconds, 6)
+                              for stage, seconds in self.seconds.items()},
+            'datasets': self.datasets,
+            'bytes_read': self.bytes_read,
+            'pixels': self.pixels,
+            'timesteps': self.timesteps,
+            'skipped_datasets': self.skipped_datasets,
+            'skipped_timesteps': self.skipped_timesteps,
+            'cache_hits': self.cache_hits,
+            'rss_bytes': self.rss,
+            'rss_growth_bytes': self.rss_growth,
+            'process_peak_rss_bytes': self.process_peak_rss,
+        }
+
+
+class RunSummary:
+    """Totals of the WaterbodyMetrics of a run."""
+
+    def __init__(self):
+        self.polygons = 0
+        self.statuses = OrderedDict()
+        self.seconds = OrderedDict((stage, 0.0) for stage in STAGES)
+        self.polygon_seconds = 0.0
+        self.datasets = 0
+        self.bytes_read = 0
+        self.pixels = 0
+        self.timesteps = 0
+        self.skipped_datasets = 0
+        self.skipped_timesteps = 0
+        self.cache_hits = 0
+        self.retries = 0
+        self.process_peak_rss = None
+        self._start = time.perf_counter()
+
+    def add(self, metrics: WaterbodyMetrics):
+        self.polygons += 1
+        self.statuses[metrics.status] = self.statuses.get(
+            metrics.status, 0) + 1
+        for stage, seconds in metrics.seconds.items():
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.polygon_seconds += metrics.total_seconds
+        self.datasets += metrics.datasets
+        self.bytes_read += metrics.bytes_read
+        self.pixels += metrics.pixels
+        self.timesteps += metrics.timesteps
+        self.skipped_datasets += metrics.skipped_datasets
+        self.skipped_timesteps += metrics.skipped_timesteps
+        self.cache_hits += metrics.cache_hits
+        self.retries += metrics.retries
+        if metrics.process_peak_rss is not None:
+            self.process_peak_rss = max(self.process_peak_rss or 0,
+                                        metrics.process_peak_rss)
+
+    @property
+    def wall_seconds(self) -> float:
+        return time.perf_counter() - self._start
+
+    def as_dict(self) -> dict:
+        wall = self.wall_seconds
+        return {
+            'polygons': self.polygons,
+            'statuses': dict(self.statuses),
+            'wall_seconds': round(wall, 6),
+            'polygon_seconds': round(self.polygon_seconds, 6),
+            'stage_seconds': {stage: round(seconds, 6)
+                              for stage, seconds in self.seconds.items()},
+            'datasets': self.datasets,
+            'bytes_read': self.bytes_read,
+            'pixels': self.pixels,
+            'timesteps': self.timesteps,
+            'skipped_datasets': self.skipped_datasets,
+            'skipped_timesteps': self.skipped_timesteps,
+            'cache_hits': self.cache_hits,
+            'retries': self.retries,
+            'process_peak_rss_bytes': self.process_peak_rss,
+            'polygons_per_hour': (self.polygons / wall * 3600
+                                  if wall else 0.0),
+            'megapixels_per_second': (self.pixels / 1e6 / wall
+                                      if wall else 0.0),
+        }
+
+    def format(self) -> str:
+        """A human-readable summary of the run."""
+        summary = self.as_dict()
+        lines = [
+            'Processed {polygons} polygons in {wall_seconds:.1f} s: '
+            '{polygons_per_hour:.1f} polygons/hour, '
+            '{megapixels_per_second:.2f} megapixels/s'.format(**summary),
+            'Read {:.1f} MB, {} pixels, {} timesteps'.format(
+                self.bytes_read / 1e6, self.pixels, self.timesteps),
+        ]
+        if self.statuses:
+            lines.append('Outcomes: ' + ', '.join(
+                f'{status}={count}'
+                for status, count in self.statuses.items()))
+        if self.skipped_timesteps:
+            lines.append(
+                f'Skipped {self.skipped_timesteps} timesteps '
+                f'({self.skipped_datasets} datasets) that could not cover '
+                'their waterbody')
+        if self.cache_hits:
+            lines.append(
+                f'Read {self.cache_hits} time windows from the WOfL cache')
+        if self.retries:
+            lines.append(f'Retried {self.retries} time windows')
+        total = sum(self.seconds.values())
+        if total:
+            lines.append('Stage time: ' + ', '.join(
+                f'{stage} {seconds:.1f} s ({seconds / total:.0%})'
+                for stage, seconds in self.seconds.items()))
+        if self.process_peak_rss is not None:
+            lines.append('Peak memory: {:.0f} MB'.format(
+                self.process_peak_rss / 1e6))
+        return '\n'.join(lines)
+
+
+class MetricsWriter:
+    """Writes WaterbodyMetrics as JSON lines.
+
+    Each record is appended as a single write, so several processes can
+    share one file.
+
+    Arguments
+    ---------
+    path : str
+        Path to a local file.
+    """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def write(self, metrics: WaterbodyMetrics):
+        line = json.dumps(metrics.as_dict()) + '\n'
+        with open(self.path, 'a') as f:
+            f.write(line)
+
+
+def _prometheus_lines(summary: RunSummary, labels: str) -> [str]:
+    prefix = PROMETHEUS_PREFIX
+    metrics = [
+        ('polygons_total', 'counter', 'Waterbodies processed.',
+         [('', summary.polygons)]),
+        ('polygon_outcomes_total', 'counter',
+         'Waterbodies processed by outcome.',
+         [(f'status="{status}"', count)
+          for status, count in summary.statuses.items()]),
+        ('stage_seconds_total', 'counter',
+         'Wall time spent in each stage of processing.',
+         [(f'stage="{stage}"', seconds)
+          for stage, seconds in summary.seconds.items()]),
+        ('polygon_seconds_total', 'counter',
+         'Wall time spent processing waterbodies.',
+         [('', summary.polygon_seconds)]),
+        ('datasets_total', 'counter', 'Datasets found.',
+         [('', summary.datasets)]),
+        ('read_bytes_total', 'counter', 'Bytes of WOfLs loaded.',
+         [('', summary.bytes_read)]),
+        ('pixels_total', 'counter', 'WOfL pixels loaded.',
+         [('', summary.pixels)]),
+        ('timesteps_total', 'counter', 'WOfL timesteps loaded.',
+         [('', summary.timesteps)]),
+        ('skipped_datasets_total', 'counter',
+         'Datasets not loaded as they could not cover their waterbody.',
+         [('', summary.skipped_datasets)]),
+        ('skipped_timesteps_total', 'counter',
+         'Timesteps not loaded as they could not cover their waterbody.',
+         [('', summary.skipped_timesteps)]),
+        ('cache_hits_total', 'counter',
+         'Time windows read from the WOfL cache.',
+         [('', summary.cache_hits)]),
+        ('retries_total', 'counter', 'Time windows retried.',
+         [('', summary.retries)]),
+        ('process_peak_rss_bytes', 'gauge',
+         'Peak resident memory of the process.',
+         [('', summary.process_peak_rss or 0)]),
+    ]
+    lines = []
+    for name, kind, help_, samples in metrics:
+        lines.append(f'# HELP {prefix}_{name} {help_}')
+        lines.append(f'# TYPE {prefix}_{name} {kind}')
+        for sample_labels, value in samples:
+            all_labels = ','.join(filter(None, [labels, sample_labels]))
+            lines.append(f'{prefix}_{name}{{{all_labels}}} {value}')
+    return lines
+
+
+class PrometheusWriter:
+    """Writes the totals of WaterbodyMetrics to a Prometheus textfile.
+
+    The file is rewritten after each waterbody, by writing a temporary
+    file and renaming it so the collector never reads a partial file.
+    Per-waterbody metrics would have too many labels for Prometheus, so
+    only totals for this process are written, labelled by process ID. Use a
+    different file for each worker.
+
+    Arguments
+    ---------
+    path : str
+        Path to a local file ending in .prom.
+    """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.summary = RunSummary()
+        self.labels = f'pid="{os.getpid()}"'
+
+    def write(self, metrics: WaterbodyMetrics):
+        self.summary.add(metrics)
+        tmp_path = f'{self.path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(_prometheus_lines(self.summary, self.labels)))
+            f.write('\n')
+        os.replace(tmp_path, self.path)
+
+
+def metrics_writer(path: str) -> MetricsWriter or PrometheusWriter:
+    """Get this process's writer for a metrics file.
+
+    Paths ending in .prom are Prometheus textfiles, and anything else is
+    JSON lines.
+    """
+    key = (str(path), os.getpid())
+    if key not in _WRITERS:
+        if str(path).endswith('.prom'):
+            _WRITERS[key] = PrometheusWriter(path)
+        else:
+            _WRITERS[key] = MetricsWriter(path)
+    return _WRITERS[key]
@@ -0,0 +1,374 @@
+"""Estimate the cost of making waterbody time series before running.
+
+A plan uses only the waterbody polygons and dataset search results, and
+loads no pixels. For each waterbody it estimates the pixels in the
+polygon's envelope, the timesteps (solar days) that will be loaded, the
+peak memory of the largest time window, and the runtime. These are added
+up into a total and a cost per chunk, and a worker count and memory
+request that fit in a walltime are recommended:
+
+    waterbodies-ts --config config.ini --all --plan plan.csv
+
+Runtimes are estimated from a linear model of datasets, timesteps and
+pixels loaded. Its default coefficients are rough; pass the metrics file
+of an earlier run (see dea_waterbodies.metrics) to fit them to the
+machine the jobs will run on.
+
+Geoscience Australia
+2021
+"""
+
+import heapq
+import json
+import logging
+import math
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Bytes held per pixel per timestep while a time window is processed: the
+# uint8 WOfLs, and a float64 copy masked to the polygon.
+BYTES_PER_PIXEL = 9
+
+# Memory a worker uses before loading anything, in bytes. Matches the
+# intercept of the memory estimate in make_chunks.
+BASE_MEMORY = 320 * 2 ** 20
+
+# Headroom to add to memory requests.
+MEMORY_SAFETY = 1.25
+
+# Seconds per waterbody, per dataset found, per timestep loaded, and per
+# million pixels (summed over timesteps) loaded.
+DEFAULT_COEFFICIENTS = {
+    'intercept': 2.0,
+    'datasets': 0.05,
+    'timesteps': 0.02,
+    'megapixels': 0.5,
+}
+
+# Most chunks to list in a plan's summary.
+MAX_CHUNK_LINES = 20
+
+# Columns of a plan.
+COLUMNS = ['UID', 'windows', 'envelope_pixels', 'datasets', 'timesteps',
+           'pixels', 'peak_memory_bytes', 'seconds']
+
+
+def envelope_pixels(bounds: (float, float, float, float),
+                    resolution: (float, float)) -> int:
+    """Number of pixels in the grid covering some bounds."""
+    x0, y0, x1, y1 = bounds
+    rows = math.ceil((y1 - y0) / abs(resolution[0]))
+    cols = math.ceil((x1 - x0) / abs(resolution[1]))
+    return max(rows, 1) * max(cols, 1)
+
+
+def count_solar_days(times, longitude: float) -> int:
+    """Count the distinct solar days of some UTC times at a longitude.
+
+    WOfLs are grouped by solar day when loaded, so this is the number of
+    timesteps that will be loaded.
+    """
+    times = np.asarray(times, dtype='datetime64[s]')
+    offset = np.timedelta64(int(round(longitude / 15 * 3600)), 's')
+    return len(np.unique((times + offset).astype('datetime64[D]')))
+
+
+def estimate_polygon(pixels: int, window_datasets: [int],
+                     window_timesteps: [int],
+                     coefficients: dict = None) -> dict:
+    """Estimate the cost of one waterbody from its search results.
+
+    Arguments
+    ---------
+    pixels : int
+        Pixels in the waterbody's envelope.
+
+    window_datasets, window_timesteps : [int]
+        Datasets found and solar days to load in each time window.
+
+    coefficients : dict
+        Runtime model coefficients, like DEFAULT_COEFFICIENTS.
+
+    Returns
+    -------
+    dict
+        With COLUMNS other than UID.
+    """
+    coefficients = coefficients or DEFAULT_COEFFICIENTS
+    datasets = int(sum(window_datasets))
+    timesteps = int(sum(window_timesteps))
+    largest_window = max(window_timesteps, default=0)
+    seconds = (coefficients['intercept']
+               + coefficients['datasets'] * datasets
+               + coefficients['timesteps'] * timesteps
+               + coefficients['megapixels'] * pixels * timesteps / 1e6)
+    return {
+        'windows': len(window_timesteps),
+        'envelope_pixels': pixels,
+        'datasets': datasets,
+        'timesteps': timesteps,
+        'pixels': pixels * timesteps,
+        'peak_memory_bytes': (BASE_MEMORY
+                              + pixels * largest_window * BYTES_PER_PIXEL),
+        'seconds': seconds,
+    }
+
+
+def plan_polygon(shape: dict, config_dict: dict, driller,
+                 coefficients: dict = None) -> dict:
+    """Estimate the cost of one waterbody from a dataset search.
+
+    Arguments
+    ---------
+    shape : dict
+        Fiona-style waterbody feature.
+
+    config_dict : dict
+        waterbodies-ts configuration, with crs and id_field.
+
+    driller : dea_waterbodies.drill.Driller
+        Driller whose cached tile searches are used to find datasets.
+
+    coefficients : dict
+        Runtime model coefficients. Default DEFAULT_COEFFICIENTS.
+
+    Returns
+    -------
+    dict
+        With COLUMNS.
+    """
+    from datacube.utils import geometry
+    from dea_waterbodies.uids import uid_paths
+    from dea_waterbodies.waterbody_timeseries_functions import (
+        get_resolution, get_time_periods)
+
+    uid = shape['properties'][config_dict['id_field']]
+    geom = geometry.Geometry(shape['geometry'], crs=config_dict['crs'])
+    fpath = str(uid_paths(config_dict['output_dir'], [str(uid)])[0])
+    time_periods = get_time_periods(shape['geometry'], config_dict, fpath)
+    longitude = geom.to_crs('EPSG:4326').centroid.coords[0][0]
+    window_datasets = []
+    window_timesteps = []
+    for time_period in time_periods or []:
+        datasets = driller.search(config_dict['wofls'], time_period, geom)
+        window_datasets.append(len(datasets))
+        window_timesteps.append(count_solar_days(
+            [d.center_time for d in datasets], longitude))
+    pixels = envelope_pixels(geom.boundingbox,
+                             get_resolution(config_dict['wofls']))
+    estimate = estimate_polygon(pixels, window_datasets, window_timesteps,
+                                coefficients)
+    estimate['UID'] = uid
+    return estimate
+
+
+def fit_coefficients(metrics_path: str) -> dict:
+    """Fit runtime model coefficients to the metrics of an earlier run.
+
+    Arguments
+    ---------
+    metrics_path : str
+        JSON lines written by dea_waterbodies.metrics.MetricsWriter.
+
+    Returns
+    -------
+    dict
+        Coefficients like DEFAULT_COEFFICIENTS. Defaults are returned if
+        there are too few successful waterbodies to fit to.
+    """
+    rows = []
+    seconds = []
+    with open(metrics_path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get('status') != 'ok':
+                continue
+            rows.append([1, record['datasets'], record['timesteps'],
+                         record['pixels'] / 1e6])
+            seconds.append(record['seconds'])
+    names = list(DEFAULT_COEFFICIENTS)
+    if len(rows) < 2 * len(names):
+        logger.warning(f'Only {len(rows)} waterbodies in {metrics_path}, '
+                       'using default runtime coefficients')
+        return dict(DEFAULT_COEFFICIENTS)
+    fitted, *_ = np.linalg.lstsq(np.array(rows, dtype=float),
+                                 np.array(seconds), rcond=None)
+    # Negative costs make no sense, and come from collinear columns.
+    return dict(zip(names, np.maximum(fitted, 0).tolist()))
+
+
+def plan(shapes: [dict], config_dict: dict, driller=None,
+         coefficients: dict = None):
+    """Estimate the cost of making time series for some waterbodies.
+
+    Arguments
+    ---------
+    shapes : [dict]
+        Fiona-style waterbody features.
+
+    config_dict : dict
+        waterbodies-ts configuration.
+
+    driller : dea_waterbodies.drill.Driller
+        Driller to search for datasets with. A new one by default.
+
+    coefficients : dict
+        Runtime model coefficients. Default DEFAULT_COEFFICIENTS.
+
+    Returns
+    -------
+    pd.DataFrame
+        With COLUMNS, one row per waterbody.
+    """
+    import pandas as pd
+    if driller is None:
+        from dea_waterbodies.drill import Driller
+        driller = Driller()
+    rows = []
+    for i, shape in enumerate(shapes):
+        rows.append(plan_polygon(shape, config_dict, driller, coefficients))
+        if (i + 1) % 1000 == 0:
+            logger.info(f'Planned {i + 1}/{len(shapes)} waterbodies')
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+
+def allocate_chunks(seconds, n_chunks: int) -> np.ndarray:
+    """Balance waterbodies across chunks by estimated runtime.
+
+    Each waterbody, slowest first, goes to the chunk with the least work.
+
+    Returns
+    -------
+    np.ndarray
+        Chunk index of each waterbody.
+    """
+    seconds = np.asarray(seconds, dtype=float)
+    chunks = np.zeros(len(seconds), dtype=int)
+    loads = [(0.0, chunk) for chunk in range(n_chunks)]
+    for i in np.argsort(-seconds, kind='stable'):
+        load, chunk = heapq.heappop(loads)
+        chunks[i] = chunk
+        heapq.heappush(loads, (load + seconds[i], chunk))
+    return chunks
+
+
+def chunk_costs(table, n_chunks: int):
+    """Total the plan of each chunk.
+
+    Returns
+    -------
+    pd.DataFrame
+        polygons, seconds, pixels and peak_memory_bytes of each chunk.
+    """
+    chunks = allocate_chunks(table.seconds, n_chunks)
+    grouped = table.assign(chunk=chunks).groupby('chunk')
+    costs = grouped.agg(polygons=('UID', 'size'), seconds=('seconds', 'sum'),
+                        pixels=('pixels', 'sum'),
+                        peak_memory_bytes=('peak_memory_bytes', 'max'))
+    return costs.reindex(range(n_chunks), fill_value=0)
+
+
+def recommend(table, walltime: float, max_workers: int = None) -> dict:
+    """Recommend a worker count and memory request.
+
+    Uses the fewest workers whose chunks all finish within walltime, and
+    enough memory for the largest waterbodies to run at the same time. If
+    a waterbody can't finish within walltime on its own, uses the fewest
+    workers that finish when the slowest waterbody does.
+
+    Arguments
+    ---------
+    table : pd.DataFrame
+        Plan from plan.
+
+    walltime : float
+        Seconds the job may run for.
+
+    max_workers : int
+        Most workers to recommend. Default one per waterbody.
+
+    Returns
+    -------
+    dict
+        workers, memory_bytes, and the estimated seconds the slowest
+        worker takes.
+    """
+    n = len(table)
+    if not n:
+        return {'workers': 0, 'memory_bytes': 0, 'seconds': 0.0}
+    max_workers = min(max_workers or n, n)
+    slowest = table.seconds.max()
+    if slowest > walltime:
+        logger.warning(
+            f'{table.UID[table.seconds.idxmax()]} alone is estimated to '
+            f'take {_hours(slowest)}, longer than the walltime')
+        walltime = slowest
+
+    def makespan(workers):
+        return chunk_costs(table, workers).seconds.max()
+
+    # Binary search for the fewest workers that fit, as balancing chunks
+    # takes a while for many waterbodies.
+    low = min(max(math.ceil(table.seconds.sum() / walltime), 1),
+              max_workers)
+    high = max_workers
+    while low < high:
+        middle = (low + high) // 2
+        if makespan(middle) <= walltime:
+            high = middle
+        else:
+            low = middle + 1
+    workers = low
+    seconds = makespan(workers)
+    if seconds > walltime:
+        logger.warning('No number of workers fits in the walltime')
+    largest = np.sort(table.peak_memory_bytes.values)[::-1][:workers]
+    return {
+        'workers': workers,
+        'memory_bytes': int(largest.sum() * MEMORY_SAFETY),
+        'seconds': float(seconds),
+    }
+
+
+def _gb(n_bytes: float) -> str:
+    return f'{n_bytes / 2 ** 30:.1f} GB'
+
+
+def _hours(seconds: float) -> str:
+    return f'{seconds / 3600:.2f} h'
+
+
+def format_plan(table, recommendation: dict) -> str:
+    """A human-readable summary of a plan."""
+    lines = [
+        f'{len(table)} waterbodies, {table.datasets.sum()} datasets, '
+        f'{table.timesteps.sum()} timesteps, '
+        f'{table.pixels.sum() / 1e9:.2f} gigapixels',
+        f'Estimated runtime {_hours(table.seconds.sum())} on one worker',
+    ]
+    if len(table):
+        largest = table.loc[table.peak_memory_bytes.idxmax()]
+        slowest = table.loc[table.seconds.idxmax()]
+        lines += [
+            f'Largest waterbody {largest.UID}: '
+            f'{_gb(largest.peak_memory_bytes)} peak memory',
+            f'Slowest waterbody {slowest.UID}: {_hours(slowest.seconds)}',
+        ]
+    workers = recommendation['workers']
+    lines.append(
+        f'Recommended: {workers} workers and '
+        f'{_gb(recommendation["memory_bytes"])} memory, taking about '
+        f'{_hours(recommendation["seconds"])}')
+    if workers:
+        costs = chunk_costs(table, workers)
+        lines.append('chunk  polygons      hours  peak memory')
+        for cost in costs[:MAX_CHUNK_LINES].itertuples():
+            lines.append(f'{cost.Index:5d}  {cost.polygons:8d}  '
+                         f'{cost.seconds / 3600:9.2f}  '
+                         f'{_gb(cost.peak_memory_bytes):>11s}')
+        if len(costs) > MAX_CHUNK_LINES:
+            lines.append(f'... and {len(costs) - MAX_CHUNK_LINES} more '
+                         'chunks')
+    return '\n'.join(lines)
@@ -0,0 +1,186 @@
+"""Profile the processing of a sample of waterbodies.
+
+A slow waterbody is hard to find and harder to explain in a run of
+thousands. A Profiler picks a fraction of waterbodies by a hash of their
+UIDs, so the same ones are picked every run, and profiles each of them
+with cProfile and tracemalloc while sampling its call stacks. For each
+picked waterbody it writes:
+
+    <uid>.prof  cProfile stats, for pstats, snakeviz or similar.
+    <uid>.txt   The slowest functions, and the lines that allocated the
+                most memory.
+
+and it appends the stacks sampled from all of them to stacks.folded in
+the collapsed format read by flamegraph.pl and speedscope.
+
+Waterbodies that aren't picked are not profiled at all, and the only cost
+of a Profiler is hashing each UID.
+
+Geoscience Australia
+2021
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Name of the file of sampled call stacks.
+STACKS_NAME = 'stacks.folded'
+
+# Seconds between stack samples.
+SAMPLE_INTERVAL = 0.005
+
+# Number of functions and allocation sites to report.
+TOP_N = 30
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return '{} ({}:{})'.format(code.co_name,
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+
+def fold_stack(frame) -> str:
+    """Collapse a frame and its callers into 'outer;...;inner'."""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler:
+    """Samples the call stack of a thread in the background.
+
+    Arguments
+    ---------
+    thread_id : int
+        Thread to sample. Defaults to the current thread.
+
+    interval : float
+        Seconds between samples.
+    """
+
+    def __init__(self, thread_id: int = None,
+                 interval: float = SAMPLE_INTERVAL):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[fold_stack(frame)] += 1
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class Profiler:
+    """Profiles a sample of waterbodies.
+
+    Arguments
+    ---------
+    output_dir : str
+        Local directory to write profiles to.
+
+    rate : float
+        Fraction of waterbodies to profile, between 0 and 1.
+
+    interval : float
+        Seconds between stack samples.
+    """
+
+    def __init__(self, output_dir: str, rate: float,
+                 interval: float = SAMPLE_INTERVAL):
+        if not 0 <= rate <= 1:
+            raise ValueError(f'Sampling rate must be in [0, 1], not {rate}')
+        self.output_dir = str(output_dir)
+        self.rate = rate
+        self.interval = interval
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def sampled(self, uid: str) -> bool:
+        """Whether to profile a waterbody.
+
+        The same UIDs are picked every run for the same rate, and a higher
+        rate picks a superset of the UIDs a lower rate picks.
+        """
+        return zlib.crc32(str(uid).encode()) < self.rate * 2 ** 32
+
+    def _write(self, name: str, profile: cProfile.Profile,
+               snapshot: tracemalloc.Snapshot, peak: int, seconds: float,
+               stacks: Counter):
+        base = os.path.join(self.output_dir, name)
+        profile.dump_stats(base + '.prof')
+
+        report = io.StringIO()
+        report.write(f'{name}: {seconds:.3f} s, '
+                     f'peak traced memory {peak / 1e6:.1f} MB\n\n')
+        stats = pstats.Stats(profile, stream=report)
+        stats.sort_stats('cumulative').print_stats(TOP_N)
+        report.write('Top allocations:\n')
+        for stat in snapshot.statistics('lineno')[:TOP_N]:
+            report.write(f'{stat}\n')
+        with open(base + '.txt', 'w') as f:
+            f.write(report.getvalue())
+
+        # One write, so processes can share the file.
+        folded = ''.join(f'{stack} {count}\n'
+                         for stack, count in stacks.items())
+        with open(os.path.join(self.output_dir, STACKS_NAME), 'a') as f:
+            f.write(folded)
+
+    @contextmanager
+    def profile(self, uid: str, attempt: int = 1):
+        """Profile a with block as the processing of a waterbody."""
+        name = str(uid) if attempt == 1 else f'{uid}.{attempt}'
+        # Leave tracemalloc alone if someone else is already using it.
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, 'reset_peak'):  # Python 3.9+
+            tracemalloc.reset_peak()
+        sampler = StackSampler(interval=self.interval)
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        sampler.start()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            sampler.stop()
+            seconds = time.perf_counter() - start
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if started_tracing:
+                tracemalloc.stop()
+            try:
+                self._write(name, profile, snapshot, peak, seconds,
+                            sampler.stacks)
+            except OSError as e:
+                logger.warning(f'Couldn\'t write profile of {uid}: {e}')
+            else:
+                logger.info(f'Profiled {name} in {seconds:.3f} s')
@@ -0,0 +1,440 @@
+"""Query waterbody time series by location.
+
+Finds the waterbodies intersecting a bounding box or polygon with a
+spatial index of the waterbody polygons, and reads their time series from
+either the per-waterbody CSVs written by waterbodies-ts
+(timeseries/UID[:4]/UID.csv) or the Parquet store written by
+waterbodies-split (timeseries/prefix=UID[:4]/part-N.parquet). Recently
+read series are cached in memory, and series can be streamed one at a time
+so large queries don't have to fit in memory.
+
+The same queries are available over HTTP from a small local server:
+
+    waterbodies-query polygons.shp s3://bucket/timeseries --port 8080
+    curl 'localhost:8080/timeseries?bbox=149,-35.4,149.2,-35.2&end=2021'
+
+Geoscience Australia
+2021
+"""
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import os
+from socketserver import ThreadingMixIn
+import sys
+import threading
+from urllib.parse import parse_qs, urlparse
+
+import click
+import numpy as np
+
+import dea_waterbodies
+from dea_waterbodies.uids import uid_paths
+
+logger = logging.getLogger(__name__)
+
+# Columns of queried time series.
+COLUMNS = ['UID', 'Observation Date', 'Wet pixel percentage',
+           'Wet pixel count']
+
+# Time format of observation dates in CSV outputs.
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# CRS of bounding boxes and geometries given over HTTP, unless specified.
+DEFAULT_CRS = 'EPSG:4326'
+
+
+def parse_geometry(geometry):
+    """Make a shapely geometry from a bbox, GeoJSON or shapely geometry.
+
+    Arguments
+    ---------
+    geometry : (float, float, float, float) or str or dict or geometry
+        A (minx, miny, maxx, maxy) bounding box, a comma-separated
+        bounding box string, a GeoJSON geometry or Feature, or a shapely
+        geometry.
+    """
+    from shapely.geometry import box, shape
+    if hasattr(geometry, 'geom_type'):
+        return geometry
+    if isinstance(geometry, dict):
+        return shape(geometry.get('geometry', geometry))
+    if isinstance(geometry, str):
+        geometry = geometry.split(',')
+    try:
+        minx, miny, maxx, maxy = (float(x) for x in geometry)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid bounding box: {geometry}')
+    return box(minx, miny, maxx, maxy)
+
+
+class WaterbodyIndex:
+    """A spatial index of waterbody polygons.
+
+    Arguments
+    ---------
+    polygons : gp.GeoDataFrame
+        Waterbody polygons.
+
+    id_field : str
+        Column holding waterbody IDs. Guessed if not given.
+    """
+
+    def __init__(self, polygons, id_field: str = None):
+        from dea_waterbodies.make_snapshot import guess_id_field
+        self.id_field = id_field or guess_id_field(polygons.columns)
+        self.crs = polygons.crs
+        self.uids = polygons[self.id_field].values
+        self.geometries = polygons.geometry.reset_index(drop=True)
+        # Build the spatial index now rather than in a server thread.
+        self.geometries.sindex
+
+    @classmethod
+    def from_file(cls, path: str, id_field: str = None):
+        """Index a file of waterbody polygons."""
+        import geopandas as gp
+        return cls(gp.read_file(path), id_field=id_field)
+
+    def query(self, geometry, crs=None) -> np.ndarray:
+        """Find the waterbodies intersecting a geometry.
+
+        Arguments
+        ---------
+        geometry
+            Anything parse_geometry accepts.
+
+        crs : str, optional
+            CRS of geometry. Defaults to the CRS of the polygons.
+
+        Returns
+        -------
+        np.ndarray
+            IDs of intersecting waterbodies, in polygon order.
+        """
+        import geopandas as gp
+        from dea_waterbodies.waterbody_polygon_functions import query_pairs
+        geometry = parse_geometry(geometry)
+        if crs is not None and self.crs is not None:
+            geometry = gp.GeoSeries([geometry], crs=crs).to_crs(
+                self.crs).iloc[0]
+        _, matches = query_pairs(self.geometries, gp.GeoSeries([geometry]))
+        return self.uids[np.unique(matches)]
+
+
+class TimeseriesStore:
+    """Reads waterbody time series, caching recently read ones.
+
+    Arguments
+    ---------
+    path : str
+        Directory of time series CSVs or a partitioned Parquet store. May
+        be an S3 URI.
+
+    cache_size : int
+        Number of series to keep in memory.
+    """
+
+    def __init__(self, path: str, cache_size: int = 4096):
+        import fsspec
+        self.path = str(path)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        fs, _, (root,) = fsspec.get_fs_token_paths(self.path)
+        self.is_parquet = bool(fs.glob(root.rstrip('/') + '/prefix=*'))
+
+    def _cached(self, uid):
+        with self._lock:
+            if uid in self._cache:
+                self._cache.move_to_end(uid)
+                return self._cache[uid]
+        return None
+
+    def _store(self, uid, series):
+        with self._lock:
+            self._cache[uid] = series
+            self._cache.move_to_end(uid)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _read_csv(self, uid):
+        import pandas as pd
+        path = uid_paths(self.path, [uid])[0]
+        try:
+            series = pd.read_csv(path)
+        except FileNotFoundError:
+            return pd.DataFrame(columns=COLUMNS)
+        series.columns = ['Wet pixel count'
+                          if c.startswith('Wet pixel count') else c
+                          for c in series.columns]
+        series['Observation Date'] = pd.to_datetime(
+            series['Observation Date'], utc=True).dt.tz_convert(None)
+        series.insert(0, 'UID', uid)
+        return series[COLUMNS]
+
+    def _read_parquet(self, prefix, uids):
+        import pandas as pd
+        path = os.path.join(self.path, f'prefix={prefix}')
+        try:
+            table = pd.read_parquet(path, columns=COLUMNS,
+                                    filters=[('UID', 'in', list(uids))])
+        except (FileNotFoundError, OSError):
+            table = pd.DataFrame(columns=COLUMNS)
+        groups = dict(list(table.groupby('UID', sort=False)))
+        return {uid: groups.get(uid, table.iloc[:0]).reset_index(drop=True)
+                for uid in uids}
+
+    def read(self, uids) -> dict:
+        """Read time series.
+
+        Arguments
+        ---------
+        uids : [str]
+            Waterbody IDs.
+
+        Returns
+        -------
+        dict
+            Map from waterbody ID to a DataFrame with COLUMNS, sorted by
+            date, with naive UTC dates. Missing series are empty. Don't
+            modify these: they're shared with the cache.
+        """
+        found = {}
+        missing = []
+        for uid in uids:
+            series = self._cached(uid)
+            if series is None:
+                missing.append(uid)
+            else:
+                found[uid] = series
+        if self.is_parquet:
+            # Read each prefix partition once for all its waterbodies.
+            prefixes = OrderedDict()
+            for uid in missing:
+                prefixes.setdefault(str(uid)[:4], []).append(uid)
+            for prefix, prefix_uids in prefixes.items():
+                found.update(self._read_parquet(prefix, prefix_uids))
+        else:
+            for uid in missing:
+                found[uid] = self._read_csv(uid)
+        for uid in missing:
+            found[uid] = found[uid].sort_values(
+                'Observation Date', kind='stable').reset_index(drop=True)
+            self._store(uid, found[uid])
+        return {uid: found[uid] for uid in uids}
+
+
+def _between(series, start, end):
+    dates = series['Observation Date']
+    keep = np.ones(len(series), dtype=bool)
+    if start is not None:
+        keep &= dates >= start
+    if end is not None:
+        keep &= dates <= end
+    return series[keep]
+
+
+def iter_timeseries(index: WaterbodyIndex, store: TimeseriesStore,
+                    geometry, start=None, end=None, crs=None,
+                    batch_size: int = 256):
+    """Stream the time series of waterbodies intersecting a geometry.
+
+    Arguments
+    ---------
+    index : WaterbodyIndex
+
+    store : TimeseriesStore
+
+    geometry
+        Anything parse_geometry accepts.
+
+    start, end : str or datetime, optional
+        Date range to return, inclusive. Dates are UTC.
+
+    crs : str, optional
+        CRS of geometry. Defaults to the CRS of the polygons.
+
+    batch_size : int
+        Number of series to read at once.
+
+    Yields
+    ------
+    (str, pd.DataFrame)
+        Waterbody ID and its time series within the date range.
+    """
+    import pandas as pd
+    start = None if start is None else pd.Timestamp(start)
+    end = None if end is None else pd.Timestamp(end)
+    uids = index.query(geometry, crs=crs)
+    logger.info(f'Found {len(uids)} waterbodies')
+    for i in range(0, len(uids), batch_size):
+        for uid, series in store.read(uids[i:i + batch_size]).items():
+            yield uid, _between(series, start, end)
+
+
+def query_timeseries(index: WaterbodyIndex, store: TimeseriesStore,
+                     geometry, start=None, end=None, crs=None):
+    """Get the time series of waterbodies intersecting a geometry.
+
+    Arguments are as for iter_timeseries.
+
+    Returns
+    -------
+    pd.DataFrame
+        Long table with COLUMNS.
+    """
+    import pandas as pd
+    series = [s for _, s in iter_timeseries(index, store, geometry,
+                                            start=start, end=end, crs=crs)]
+    if not series:
+        return pd.DataFrame(columns=COLUMNS)
+    return pd.concat(series, ignore_index=True)
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """Serves waterbody queries over HTTP.
+
+    GET /waterbodies?bbox=minx,miny,maxx,maxy returns a JSON list of IDs.
+    GET /timeseries?bbox=... streams matching time series as CSV. Both
+    also accept POST with a GeoJSON geometry as the body instead of a
+    bbox. Optional parameters are crs (default EPSG:4326), and start and
+    end dates for time series.
+    """
+
+    index = None
+    store = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.info(format % args)
+
+    def _error(self, status, message):
+        body = (message + '\n').encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _chunk(self, data: bytes):
+        if data:
+            self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+
+    def _handle(self, geometry):
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if geometry is None:
+            geometry = params.get('bbox')
+        if geometry is None:
+            return self._error(400, 'A bbox or GeoJSON body is required')
+        crs = params.get('crs', DEFAULT_CRS)
+        try:
+            if url.path == '/waterbodies':
+                uids = self.index.query(geometry, crs=crs)
+                body = json.dumps([str(u) for u in uids]).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            if url.path != '/timeseries':
+                return self._error(404, f'Unknown path: {url.path}')
+            results = iter_timeseries(self.index, self.store, geometry,
+                                      start=params.get('start'),
+                                      end=params.get('end'), crs=crs)
+            # Find any errors in the query before starting the response.
+            first = next(results, None)
+        except ValueError as e:
+            return self._error(400, str(e))
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self._chunk((','.join(COLUMNS) + '\n').encode())
+        if first is not None:
+            self._chunk(_to_csv(first[1]))
+            for _, series in results:
+                self._chunk(_to_csv(series))
+        self.wfile.write(b'0\r\n\r\n')
+
+    def do_GET(self):
+        self._handle(None)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            geometry = json.loads(self.rfile.read(length))
+        except ValueError:
+            return self._error(400, 'Body must be a GeoJSON geometry')
+        self._handle(geometry)
+
+
+def _to_csv(series) -> bytes:
+    return series.to_csv(None, header=False, index=False,
+                         date_format=DATE_FORMAT).encode()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is new in Python 3.7.
+    daemon_threads = True
+
+
+def make_server(index: WaterbodyIndex, store: TimeseriesStore,
+                host: str = '127.0.0.1', port: int = 8080):
+    """Make an HTTP server for waterbody queries. Port 0 picks a free port.
+    """
+    handler = type('Handler', (QueryHandler,),
+                   {'index': index, 'store': store})
+    return _ThreadingHTTPServer((host, port), handler)
+
+
+@click.command()
+@click.argument('shapefile', type=click.Path())
+@click.argument('timeseries', type=click.Path())
+@click.option('--host', default='127.0.0.1',
+              help='Address to listen on. Default 127.0.0.1.')
+@click.option('--port', type=int, default=8080,
+              help='Port to listen on. Default 8080.')
+@click.option('--cache-size', type=int, default=4096,
+              help='Number of time series to cache in memory.')
+@click.option('-v', '--verbose', count=True)
+@click.version_option(version=dea_waterbodies.__version__)
+def main(shapefile, timeseries, host, port, cache_size, verbose):
+    """Serve waterbody time series queries over HTTP."""
+    # Set up logging.
+    loggers = [logging.getLogger(name)
+               for name in logging.root.manager.loggerDict
+               if not name.startswith('fiona')
+               and not name.startswith('sqlalchemy')
+               and not name.startswith('boto')]
+    stdout_hdlr = logging.StreamHandler(sys.stdout)
+    for logger_ in loggers:
+        if verbose == 0:
+            logging.basicConfig(level=logging.WARNING)
+        elif verbose == 1:
+            logging.basicConfig(level=logging.INFO)
+        elif verbose == 2:
+            logging.basicConfig(level=logging.DEBUG)
+        else:
+            raise click.ClickException('Maximum verbosity is -vv')
+        logger_.addHandler(stdout_hdlr)
+
+    index = WaterbodyIndex.from_file(shapefile)
+    store = TimeseriesStore(timeseries, cache_size=cache_size)
+    server = make_server(index, store, host=host, port=port)
+    logger.info(f'Serving {len(index.uids)} waterbodies on '
+                f'http://{host}:{server.server_port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
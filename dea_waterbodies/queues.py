@@ -8,8 +8,6 @@ Geoscience Australia
 import json
 import logging
 
-import boto3
-from botocore.config import Config
 import click
 
 
@@ -22,6 +20,7 @@ def get_queue(queue_name: str):
 
     Cribbed from odc.algo.
     """
+    import boto3
     sqs = boto3.resource("sqs")
     queue = sqs.get_queue_by_name(QueueName=queue_name)
     return queue
@@ -56,6 +55,8 @@ def make(name, timeout, deadletter, retries):
     """Make a queue."""
     verify_name(name)
 
+    import boto3
+    from botocore.config import Config
     sqs = boto3.client('sqs', config=Config(
         retries={
             'max_attempts': retries,
@@ -85,6 +86,7 @@ def make(name, timeout, deadletter, retries):
 def delete(name):
     """Delete a queue."""
     verify_name(name)
+    import boto3
     sqs = boto3.resource('sqs')
     queue = sqs.get_queue_by_name(QueueName=name)
     arn = queue.attributes['QueueArn']
@@ -0,0 +1,340 @@
+"""Resample many waterbody time series onto a regular grid at once.
+
+Waterbody observations are irregular: they depend on satellite overpasses
+and cloud. This module puts many series onto a shared daily, monthly or
+seasonal grid, either by time-weighted linear interpolation or by averaging
+the observations in each period, optionally filling gaps up to a maximum
+length.
+
+Series are stored stacked rather than one DataFrame each: all observations
+in one array sorted by series and then time, with offsets giving where
+each series starts, like a CSR sparse matrix. Every operation works on all
+series at once.
+
+Geoscience Australia
+2021
+"""
+
+import numpy as np
+
+# Grid frequencies: daily, monthly, and seasonal (DJF/MAM/JJA/SON).
+FREQUENCIES = ('D', 'M', 'S')
+
+# Roughly how many grid values to interpolate at once, which bounds the
+# size of temporary arrays.
+BLOCK_VALUES = 2 ** 22
+
+SECOND = 10 ** 9
+
+
+def _to_ns(times) -> np.ndarray:
+    return np.asarray(times).astype('datetime64[ns]').astype('int64')
+
+
+def _gap_ns(max_gap) -> int or None:
+    """Convert a gap like '90D' or np.timedelta64(90, 'D') to nanoseconds.
+    """
+    if max_gap is None:
+        return None
+    import pandas as pd
+    return pd.Timedelta(max_gap).value
+
+
+def stack(ids, times, values):
+    """Stack a long table of observations.
+
+    Arguments
+    ---------
+    ids : array_like
+        Waterbody ID of each observation.
+
+    times : array_like
+        Time of each observation, as datetime64 or int64 nanoseconds.
+
+    values : array_like
+        Value of each observation. NaNs are dropped.
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray, np.ndarray, np.ndarray)
+        Sorted unique IDs, offsets (one more than the number of IDs),
+        and int64 nanosecond times and float values sorted by ID and time.
+    """
+    import pandas as pd
+    values = np.asarray(values, dtype=float)
+    valid = ~np.isnan(values)
+    times = _to_ns(times)[valid]
+    values = values[valid]
+    codes, unique_ids = pd.factorize(np.asarray(ids)[valid], sort=True)
+    # Sorting by time and then stably by series is faster than lexsort.
+    order = np.argsort(times)
+    order = order[np.argsort(codes[order], kind='stable')]
+    offsets = np.searchsorted(codes[order], np.arange(len(unique_ids) + 1))
+    return np.asarray(unique_ids), offsets, times[order], values[order]
+
+
+def period_edges(start, end, freq: str = 'M') -> np.ndarray:
+    """Edges of the periods covering start to end.
+
+    Arguments
+    ---------
+    start, end : datetime64 or int64 nanoseconds
+        Times to cover, inclusive.
+
+    freq : str
+        'D' for days, 'M' for months, or 'S' for seasons starting in
+        December, March, June and September.
+
+    Returns
+    -------
+    np.ndarray
+        datetime64[ns] start of each period, followed by the end of the
+        last period.
+    """
+    if freq not in FREQUENCIES:
+        raise ValueError(f'freq must be one of {FREQUENCIES}, not {freq}')
+    start, end = _to_ns([start, end]).astype('datetime64[ns]')
+    if freq == 'D':
+        first = start.astype('datetime64[D]')
+        last = end.astype('datetime64[D]')
+        edges = np.arange(first, last + 2)
+    else:
+        first = start.astype('datetime64[M]').astype('int64')
+        last = end.astype('datetime64[M]').astype('int64')
+        step = 1
+        if freq == 'S':
+            # Month 0 is January 1970, and seasons start in December.
+            first -= (first + 1) % 3
+            last -= (last + 1) % 3
+            step = 3
+        edges = np.arange(first, last + 2 * step, step).astype(
+            'datetime64[M]')
+    return edges.astype('datetime64[ns]')
+
+
+def interpolate(offsets: np.ndarray, times: np.ndarray, values: np.ndarray,
+                grid, max_gap=None, dtype='float64') -> np.ndarray:
+    """Linearly interpolate stacked series in time onto a grid.
+
+    Arguments
+    ---------
+    offsets, times, values : np.ndarray
+        Stacked series, as from stack.
+
+    grid : array_like
+        Sorted times to interpolate to, as datetime64 or int64 nanoseconds.
+
+    max_gap : str or timedelta, optional
+        Don't interpolate between observations further apart than this.
+        Observations exactly on the grid are always used.
+
+    dtype : str
+        Output dtype.
+
+    Returns
+    -------
+    np.ndarray
+        (series, grid) interpolated values. NaN outside each series or
+        across gaps longer than max_gap.
+    """
+    grid = _to_ns(grid)
+    max_gap = _gap_ns(max_gap)
+    n, m = len(offsets) - 1, len(grid)
+    out = np.full((n, m), np.nan, dtype=dtype)
+    if not m:
+        return out
+    block = max(1, BLOCK_VALUES // m)
+    for a in range(0, n, block):
+        b = min(n, a + block)
+        out[a:b] = _interpolate_block(offsets[a:b + 1], times, values, grid,
+                                      max_gap)
+    return out
+
+
+def _interpolate_block(offsets, times, values, grid, max_gap):
+    """Interpolate a contiguous block of series."""
+    n, m = len(offsets) - 1, len(grid)
+    obs = slice(offsets[0], offsets[-1])
+    obs_times, obs_values = times[obs], values[obs]
+    n_obs = len(obs_times)
+    result = np.full((n, m), np.nan)
+    if not n_obs:
+        return result
+    obs_series = np.repeat(np.arange(n), np.diff(offsets))
+    q_series = np.repeat(np.arange(n), m)
+    q_times = np.tile(grid, n)
+
+    # Combine series and time into one sorted key so all grid times are
+    # found in all series with a single searchsorted. Nanoseconds would
+    # overflow, so keys are in seconds: observation times round up and
+    # grid times round down, so every observation before the found
+    # position is at or before the grid time.
+    t0 = min(obs_times[0], grid[0])
+    span = (max(obs_times.max(), grid[-1]) - t0) // SECOND + 2
+    obs_keys = obs_series * span - (t0 - obs_times) // SECOND
+    q_keys = q_series * span + (q_times - t0) // SECOND
+    right = np.searchsorted(obs_keys, q_keys, side='right')
+    # Step over any observations in the same second as, but not after, a
+    # grid time, so right is the first observation after each grid time.
+    while True:
+        step = np.minimum(right, n_obs - 1)
+        step = ((right < n_obs) & (obs_series[step] == q_series)
+                & (obs_times[step] <= q_times))
+        if not step.any():
+            break
+        right[step] += 1
+    left = right - 1
+    has_left = left >= 0
+    has_right = right < n_obs
+    left = np.where(has_left, left, 0)
+    right = np.where(has_right, right, 0)
+    has_left &= obs_series[left] == q_series
+    has_right &= obs_series[right] == q_series
+
+    t_left, t_right = obs_times[left], obs_times[right]
+    v_left, v_right = obs_values[left], obs_values[right]
+    exact = has_left & (t_left == q_times)
+    between = has_left & has_right & ~exact
+    if max_gap is not None:
+        between &= (t_right - t_left) <= max_gap
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = ((q_times - t_left).astype(float)
+                  / (t_right - t_left).astype(float))
+        interpolated = v_left + weight * (v_right - v_left)
+    result = result.reshape(-1)
+    result[exact] = v_left[exact]
+    result[between] = interpolated[between]
+    return result.reshape(n, m)
+
+
+def bin_means(offsets: np.ndarray, times: np.ndarray, values: np.ndarray,
+              edges, dtype='float64') -> np.ndarray:
+    """Average stacked series within periods.
+
+    Arguments
+    ---------
+    offsets, times, values : np.ndarray
+        Stacked series, as from stack.
+
+    edges : array_like
+        Sorted period edges, as from period_edges.
+
+    dtype : str
+        Output dtype.
+
+    Returns
+    -------
+    np.ndarray
+        (series, period) mean values. NaN for periods with no observations.
+    """
+    edges = _to_ns(edges)
+    n, m = len(offsets) - 1, len(edges) - 1
+    series = np.repeat(np.arange(n), np.diff(offsets))
+    periods = np.searchsorted(edges, times, side='right') - 1
+    inside = (periods >= 0) & (periods < m)
+    keys = series[inside] * m + periods[inside]
+    sums = np.bincount(keys, weights=values[inside], minlength=n * m)
+    counts = np.bincount(keys, minlength=n * m)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    return means.reshape(n, m).astype(dtype)
+
+
+def fill_gaps(array: np.ndarray, grid, max_gap=None) -> np.ndarray:
+    """Fill NaN gaps in regular series by time-weighted interpolation.
+
+    Arguments
+    ---------
+    array : np.ndarray
+        (series, grid) values.
+
+    grid : array_like
+        Time of each column, as datetime64 or int64 nanoseconds.
+
+    max_gap : str or timedelta, optional
+        Only fill gaps where the valid values either side are at most this
+        far apart.
+
+    Returns
+    -------
+    np.ndarray
+        A filled copy of array. Leading and trailing gaps stay NaN.
+    """
+    grid = _to_ns(grid)
+    max_gap = _gap_ns(max_gap)
+    array = np.array(array)
+    n, m = array.shape
+    if not m:
+        return array
+    columns = np.broadcast_to(np.arange(m), (n, m))
+    valid = ~np.isnan(array)
+    before = np.maximum.accumulate(np.where(valid, columns, -1), axis=1)
+    after = np.minimum.accumulate(
+        np.where(valid, columns, m)[:, ::-1], axis=1)[:, ::-1]
+    fill = ~valid & (before >= 0) & (after < m)
+    before, after = np.clip(before, 0, m - 1), np.clip(after, 0, m - 1)
+    t_before, t_after = grid[before], grid[after]
+    if max_gap is not None:
+        fill &= (t_after - t_before) <= max_gap
+    rows = np.broadcast_to(np.arange(n)[:, None], (n, m))
+    v_before, v_after = array[rows, before], array[rows, after]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = ((grid[None, :] - t_before).astype(float)
+                  / (t_after - t_before).astype(float))
+        array[fill] = (v_before + weight * (v_after - v_before))[fill]
+    return array
+
+
+def regularise(ids, times, values, freq: str = 'M', how: str = 'mean',
+               max_gap=None, start=None, end=None, dtype='float64'):
+    """Put many waterbody time series onto a regular grid.
+
+    Arguments
+    ---------
+    ids, times, values : array_like
+        Long table of observations, e.g. from
+        dea_waterbodies.exceedance.read_long_table.
+
+    freq : str
+        'D' for daily, 'M' for monthly or 'S' for seasonal
+        (DJF/MAM/JJA/SON).
+
+    how : str
+        'mean' averages the observations in each period, and then fills
+        empty periods by interpolation if max_gap is given. 'interpolate'
+        linearly interpolates to the start of each period.
+
+    max_gap : str or timedelta, optional
+        Longest gap to interpolate across, e.g. '90D'. With how='mean', no
+        gaps are filled unless this is given.
+
+    start, end : datetime64, optional
+        Grid extent. Defaults to the extent of the observations.
+
+    dtype : str
+        Output dtype. float32 halves memory for large grids.
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray, np.ndarray)
+        Sorted unique IDs, datetime64[ns] grid (period starts), and
+        (ID, grid) regularised values.
+    """
+    if how not in {'mean', 'interpolate'}:
+        raise ValueError(f'how must be mean or interpolate, not {how}')
+    unique_ids, offsets, times, values = stack(ids, times, values)
+    if start is None or end is None:
+        if not len(times):
+            raise ValueError('No valid observations to set the grid extent')
+        start = times.min() if start is None else start
+        end = times.max() if end is None else end
+    edges = period_edges(start, end, freq)
+    grid = edges[:-1]
+    if how == 'interpolate':
+        regular = interpolate(offsets, times, values, grid, max_gap=max_gap,
+                              dtype=dtype)
+    else:
+        regular = bin_means(offsets, times, values, edges, dtype=dtype)
+        if max_gap is not None:
+            regular = fill_gaps(regular, grid, max_gap=max_gap)
+    return unique_ids, grid, regular
@@ -0,0 +1,209 @@
+"""Retry failed loads one time window at a time.
+
+A waterbody's WOfLs are loaded in time windows. When a load fails, only
+that window is retried, and how depends on what went wrong:
+
+    transient  I/O errors that may not happen again, like S3 timeouts and
+               throttling. Retried with exponential backoff.
+    memory     The window didn't fit in memory. Split in half by time, and
+               each half loaded separately.
+    data       Anything else, which won't be fixed by trying again. Raised
+               straight away.
+
+Geoscience Australia
+2021
+"""
+
+import gc
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+TRANSIENT = 'transient'
+MEMORY = 'memory'
+DATA = 'data'
+
+# Times to try loading a window before giving up.
+ATTEMPTS = 4
+
+# Seconds to wait before the first retry, doubling for each retry after.
+BASE_DELAY = 2.0
+
+# Most seconds to wait between retries.
+MAX_DELAY = 60.0
+
+# S3 error codes worth retrying.
+TRANSIENT_ERROR_CODES = {
+    'InternalError', 'RequestTimeout', 'RequestTimeTooSkewed',
+    'ServiceUnavailable', 'SlowDown', 'Throttling', 'ThrottlingException',
+    '500', '502', '503', '504',
+}
+
+# OSErrors that retrying won't fix.
+_DATA_OS_ERRORS = (FileNotFoundError, IsADirectoryError, NotADirectoryError,
+                   PermissionError)
+
+
+def classify_error(error: BaseException) -> str:
+    """Classify an error as TRANSIENT, MEMORY or DATA."""
+    if isinstance(error, MemoryError):
+        return MEMORY
+    if isinstance(error, _DATA_OS_ERRORS):
+        return DATA
+    # Includes rasterio's RasterioIOError, which is what a failed read of a
+    # cloud-optimised GeoTIFF usually looks like.
+    if isinstance(error, OSError):
+        return TRANSIENT
+    try:
+        from botocore import exceptions as botocore_exceptions
+    except ImportError:
+        return DATA
+    if isinstance(error, (botocore_exceptions.ConnectionError,
+                          botocore_exceptions.HTTPClientError)):
+        return TRANSIENT
+    if isinstance(error, botocore_exceptions.ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        if code in TRANSIENT_ERROR_CODES:
+            return TRANSIENT
+    return DATA
+
+
+def backoff_delay(attempt: int, base_delay: float = BASE_DELAY,
+                  max_delay: float = MAX_DELAY) -> float:
+    """Seconds to wait after a failed attempt, with jitter.
+
+    Jitter stops workers that failed together from retrying together.
+    """
+    delay = min(base_delay * 2 ** (attempt - 1), max_delay)
+    return delay * random.uniform(0.5, 1)
+
+
+def split_time_period(time_period) -> [(str, str)] or None:
+    """Split a datacube time range in half.
+
+    Arguments
+    ---------
+    time_period : (str, str)
+        Start and end, where the end is inclusive, e.g. ('1986', '1990')
+        is all of 1986 to 1990.
+
+    Returns
+    -------
+    [(str, str)], or None if the period is a single day.
+    """
+    import pandas as pd
+    start = pd.Period(str(time_period[0])).start_time.normalize()
+    end = pd.Period(str(time_period[1])).end_time.normalize()
+    if end <= start:
+        return None
+    middle = start + (end - start) // 2
+    middle = middle.normalize()
+    return [
+        (start.strftime('%Y-%m-%d'), middle.strftime('%Y-%m-%d')),
+        ((middle + pd.Timedelta(days=1)).strftime('%Y-%m-%d'),
+         end.strftime('%Y-%m-%d')),
+    ]
+
+
+def call_with_retries(func, description: str, attempts: int = ATTEMPTS,
+                      on_retry=None, sleep=time.sleep):
+    """Call func, retrying transient errors with exponential backoff.
+
+    Arguments
+    ---------
+    func : callable
+        Function of no arguments.
+
+    description : str
+        What func does, for logging.
+
+    attempts : int
+        Times to try func before giving up.
+
+    on_retry : callable
+        Called with the error before each retry.
+
+    sleep : callable
+        Waits some seconds.
+
+    Returns
+    -------
+    Whatever func returns.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return func()
+        except Exception as e:
+            kind = classify_error(e)
+            if kind != TRANSIENT or attempt == attempts:
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning(
+                f'Transient error {description} '
+                f'(attempt {attempt}/{attempts}), retrying in {delay:.1f} s: '
+                f'{e!r}')
+            if on_retry is not None:
+                on_retry(e)
+            sleep(delay)
+
+
+def drill_with_retries(drill, time_period, description: str = '',
+                       attempts: int = ATTEMPTS, on_retry=None,
+                       sleep=time.sleep) -> list:
+    """Drill a time window, retrying or splitting it if that fails.
+
+    Arguments
+    ---------
+    drill : callable
+        Takes a (start, end) time period, and returns a result or None if
+        there's no data.
+
+    time_period : (str, str)
+        Time window to drill.
+
+    description : str
+        What is being drilled, for logging.
+
+    attempts : int
+        Times to try each window.
+
+    on_retry : callable
+        Called with the error before each retry or split.
+
+    sleep : callable
+        Waits some seconds.
+
+    Returns
+    -------
+    list
+        Results of drill, in time order, leaving out None. There is more
+        than one if the window had to be split.
+    """
+    try:
+        result = call_with_retries(
+            lambda: drill(time_period),
+            f'drilling {description} in {time_period}',
+            attempts=attempts, on_retry=on_retry, sleep=sleep)
+    except Exception as e:
+        if classify_error(e) != MEMORY:
+            raise
+        halves = split_time_period(time_period)
+        if halves is None:
+            raise
+        logger.warning(f'Out of memory drilling {description} in '
+                       f'{time_period}, splitting into {halves}')
+        if on_retry is not None:
+            on_retry(e)
+    else:
+        return [] if result is None else [result]
+
+    # Outside the except block, so that whatever the traceback refers to
+    # can be freed before trying again.
+    gc.collect()
+    return [result
+            for half in halves
+            for result in drill_with_retries(
+                drill, half, description, attempts=attempts,
+                on_retry=on_retry, sleep=sleep)]
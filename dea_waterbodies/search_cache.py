@@ -0,0 +1,300 @@
+"""Answer dataset searches from footprints fetched once per run.
+
+Every time window of every waterbody used to search the datacube index
+for the datasets under the polygon. Neighbouring waterbodies share almost
+all of their datasets, so a continental run asks the index the same
+questions many thousands of times. A SearchCache instead fetches the
+datasets of a product over the whole run's time range, one tile at a time,
+and keeps them in a grid of tiles in memory. Searches for a polygon are
+then answered from the tiles it touches, and the datasets found are passed
+straight to dc.load.
+
+Tiles are fetched the first time a polygon touches them, or all at once
+with prefetch. A SearchCache can be saved and loaded again by a later run,
+so long as it isn't stale: datasets indexed after it was made won't be
+found, so caches whose time range reaches past their creation are only
+reused for MAX_AGE.
+
+Geoscience Australia
+2021
+"""
+
+from datetime import datetime, timedelta, timezone
+import logging
+import os
+import pickle
+import threading
+import uuid
+
+import fsspec
+import numpy as np
+
+from dea_waterbodies.drill import DEFAULT_CRS, _search_tiles
+
+logger = logging.getLogger(__name__)
+
+# How long a cache can be reused for if new datasets could have been
+# indexed in its time range since it was made.
+MAX_AGE = timedelta(days=1)
+
+# Years before now that an APPEND run caches, since most waterbodies are
+# appended to from the last few months. Searches starting earlier go to
+# the datacube index.
+APPEND_YEARS = 1
+
+
+def time_bounds(time_range) -> (np.datetime64, np.datetime64):
+    """First and last instant of a datacube time range.
+
+    Each end of time_range may be a year, month or date, and the end is
+    inclusive, so ('1986', '1990') is all of 1986 to 1990.
+    """
+    import pandas as pd
+    start = pd.Period(str(time_range[0])).start_time
+    end = pd.Period(str(time_range[1])).end_time
+    return np.datetime64(start, 'ns'), np.datetime64(end, 'ns')
+
+
+def _center_time(dataset) -> np.datetime64:
+    import pandas as pd
+    time = pd.Timestamp(dataset.center_time)
+    if time.tzinfo is not None:
+        time = time.tz_convert('UTC').tz_localize(None)
+    return np.datetime64(time, 'ns')
+
+
+def run_time_range(config_dict: dict, now: datetime = None) -> (str, str):
+    """Time range covering all of the time windows of a waterbodies-ts run.
+
+    Arguments
+    ---------
+    config_dict : dict
+        waterbodies-ts configuration, with time_span and maybe start_dt
+        and end_date.
+
+    now : datetime
+        Current time. Default now.
+
+    Returns
+    -------
+    (str, str)
+    """
+    now = now or datetime.now()
+    time_span = config_dict['time_span']
+    if time_span == 'ALL':
+        return ('1986', str(now.year))
+    elif time_span == 'APPEND':
+        return (str(now.year - APPEND_YEARS), str(now.year))
+    elif time_span == 'CUSTOM':
+        return (config_dict['start_dt'], config_dict['end_date'])
+    raise ValueError(f'Unknown time span: {time_span}')
+
+
+class SearchCache:
+    """Datasets of one product in a time range, searchable by polygon.
+
+    Arguments
+    ---------
+    product : str
+        WOfL product name.
+
+    time_range : (str, str)
+        Start and end of the datasets to cache.
+
+    dc : datacube.Datacube, optional
+        Datacube to search. One is opened when first needed if not given.
+    """
+
+    def __init__(self, product: str, time_range, dc=None):
+        self.product = product
+        self.time_range = tuple(str(t) for t in time_range)
+        self.created = datetime.now(timezone.utc)
+        self.start, self.end = time_bounds(self.time_range)
+        self._dc = dc
+        self._lock = threading.Lock()
+        # Dataset IDs in each tile, datasets by ID, and their times.
+        self._tiles = {}
+        self._datasets = {}
+        self._times = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_dc'], state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._dc = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (f'SearchCache({self.product!r}, {self.time_range!r}, '
+                f'{len(self._tiles)} tiles, {len(self._datasets)} datasets)')
+
+    @property
+    def dc(self):
+        if self._dc is None:
+            from datacube import Datacube
+            self._dc = Datacube(app='Polygon drill')
+        return self._dc
+
+    @property
+    def n_tiles(self) -> int:
+        return len(self._tiles)
+
+    @property
+    def n_datasets(self) -> int:
+        return len(self._datasets)
+
+    def covers(self, time_range) -> bool:
+        """Whether a time range is within the cached time range."""
+        start, end = time_bounds(time_range)
+        return self.start <= start and end <= self.end
+
+    def is_fresh(self, now: datetime = None) -> bool:
+        """Whether no datasets could have been indexed since caching."""
+        now = now or datetime.now(timezone.utc)
+        if self.end < np.datetime64(
+                self.created.replace(tzinfo=None), 'ns'):
+            return True
+        return now - self.created < MAX_AGE
+
+    def add_tile(self, tile, datasets: list):
+        """Cache the datasets that intersect a tile."""
+        with self._lock:
+            for dataset in datasets:
+                if dataset.id not in self._datasets:
+                    self._datasets[dataset.id] = dataset
+                    self._times[dataset.id] = _center_time(dataset)
+            self._tiles[tile] = [dataset.id for dataset in datasets]
+
+    def _fetch_tile(self, tile):
+        from datacube.utils import geometry
+        from dea_waterbodies.waterbody_timeseries_functions import (
+            get_dataset_maturity)
+        query = {'product': self.product, 'time': self.time_range,
+                 'geopolygon': geometry.box(*tile, crs=DEFAULT_CRS)}
+        dataset_maturity = get_dataset_maturity(self.product)
+        if dataset_maturity:
+            query['dataset_maturity'] = dataset_maturity
+        self.add_tile(tile, self.dc.find_datasets(**query))
+
+    def prefetch(self, geoms: list):
+        """Fetch the datasets of every tile that some polygons touch.
+
+        Arguments
+        ---------
+        geoms : [datacube.utils.geometry.Geometry]
+            Polygons that will be searched.
+        """
+        tiles = set()
+        for geom in geoms:
+            tiles.update(_search_tiles(geom.to_crs(DEFAULT_CRS).boundingbox))
+        tiles -= set(self._tiles)
+        logger.info(f'Fetching {self.product} datasets in {len(tiles)} '
+                    f'tiles for {self.time_range}')
+        for tile in sorted(tiles):
+            self._fetch_tile(tile)
+        logger.info(f'Cached {self.n_datasets} datasets')
+
+    def search(self, time_range, geom) -> list or None:
+        """Find the cached datasets intersecting a polygon.
+
+        Arguments
+        ---------
+        time_range : (str, str)
+            Start and end dates.
+
+        geom : datacube.utils.geometry.Geometry
+            Polygon to search.
+
+        Returns
+        -------
+        list
+            Datasets in time order, or None if time_range isn't cached.
+        """
+        if not self.covers(time_range):
+            return None
+        start, end = time_bounds(time_range)
+        ids = set()
+        for tile in _search_tiles(geom.to_crs(DEFAULT_CRS).boundingbox):
+            if tile not in self._tiles:
+                self._fetch_tile(tile)
+            ids.update(self._tiles[tile])
+        ids = [id_ for id_ in ids if start <= self._times[id_] <= end]
+        # Tiles are bigger than the polygon, so filter to datasets that
+        # actually intersect it.
+        projected = {}
+        found = []
+        for id_ in sorted(ids, key=self._times.get):
+            dataset = self._datasets[id_]
+            crs = dataset.extent.crs
+            if crs not in projected:
+                projected[crs] = geom.to_crs(crs)
+            if dataset.extent.intersects(projected[crs]):
+                found.append(dataset)
+        return found
+
+    def save(self, path: str):
+        """Save the cache so another run can load it."""
+        fs, fs_path = fsspec.core.url_to_fs(path)
+        if 'file' in fs.protocol:
+            os.makedirs(os.path.dirname(os.path.abspath(fs_path)),
+                        exist_ok=True)
+            # Concurrent workers may save the same cache, so each writes
+            # a temporary file and the last one to finish wins.
+            tmp_path = f'{fs_path}.{uuid.uuid4().hex}.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, fs_path)
+        else:
+            with fs.open(fs_path, 'wb') as f:
+                pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        logger.info(f'Saved {self!r} to {path}')
+
+    @classmethod
+    def load(cls, path: str) -> 'SearchCache':
+        """Load a saved cache. Caches are pickles, so only load your own."""
+        with fsspec.open(path, 'rb') as f:
+            cache = pickle.load(f)
+        if not isinstance(cache, cls):
+            raise TypeError(f'{path} is not a SearchCache')
+        return cache
+
+
+def open_search_cache(product: str, time_range, path: str = None,
+                      dc=None) -> SearchCache:
+    """Load a saved SearchCache if it's usable, or make a new one.
+
+    Arguments
+    ---------
+    product : str
+        WOfL product name.
+
+    time_range : (str, str)
+        Time range the cache must cover.
+
+    path : str, optional
+        Where a cache may have been saved.
+
+    dc : datacube.Datacube, optional
+        Datacube to search.
+
+    Returns
+    -------
+    SearchCache
+    """
+    fs, fs_path = fsspec.core.url_to_fs(path) if path else (None, None)
+    if path and fs.exists(fs_path):
+        try:
+            cache = SearchCache.load(path)
+        except (OSError, EOFError, pickle.UnpicklingError, TypeError) as e:
+            logger.warning(f'Ignoring unreadable search cache {path}: {e!r}')
+        else:
+            if (cache.product == product and cache.covers(time_range)
+                    and cache.is_fresh()):
+                logger.info(f'Loaded {cache!r} from {path}')
+                cache._dc = dc
+                return cache
+            logger.info(f'Not reusing stale or different {cache!r}')
+    return SearchCache(product, time_range, dc=dc)
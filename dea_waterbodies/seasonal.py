@@ -0,0 +1,287 @@
+"""Make seasonal means of waterbody wet surface area.
+
+All time series are read into one long table, and the mean wet pixel
+percentage of every waterbody in every season is computed in a single
+grouped reduction keyed by (waterbody, season). The means are appended to
+the waterbody polygons as attributes named like 2020summer.
+
+Seasons are configurable. Each season is named for the year it ends in, so
+the summer of December 2019 to February 2020 is 2020summer.
+
+**Required inputs**
+
+a config file which contains the filename of the shapefile to append to
+(SHAPEFILE), the directory containing the waterbody time series
+(TIMESERIES_DIR) and the output directory and filename (SNAPSHOT_DIR and
+SNAPSHOT_SHAPEFILE).
+
+Geoscience Australia
+2021
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import os
+import sys
+
+import click
+import numpy as np
+
+import dea_waterbodies
+from dea_waterbodies.make_snapshot import (
+    guess_id_field, list_timeseries, process_config, read_timeseries,
+    uid_from_path)
+
+logger = logging.getLogger(__name__)
+
+# Season definitions. Each is a list of (name, months) in the order the
+# seasons occur in the year they are named for. The months of each season
+# are listed in order, and a season is named for the year of its last
+# month.
+SEASONS = {
+    # Meteorological seasons, DJF/MAM/JJA/SON.
+    'australian': [
+        ('summer', (12, 1, 2)),
+        ('autumn', (3, 4, 5)),
+        ('winter', (6, 7, 8)),
+        ('spring', (9, 10, 11)),
+    ],
+    'DJF': [
+        ('DJF', (12, 1, 2)),
+        ('MAM', (3, 4, 5)),
+        ('JJA', (6, 7, 8)),
+        ('SON', (9, 10, 11)),
+    ],
+    # Australian water years, July to June.
+    'water_year': [
+        ('wy', (7, 8, 9, 10, 11, 12, 1, 2, 3, 4, 5, 6)),
+    ],
+}
+
+# Number of time series each worker reads per job.
+CHUNK_SIZE = 256
+
+
+def season_codes(times: np.ndarray, seasons: str = 'australian'
+                 ) -> (np.ndarray, [str]):
+    """Find the season of each time.
+
+    Arguments
+    ---------
+    times : np.ndarray
+        Times as datetime64, or int64 nanoseconds since the epoch.
+
+    seasons : str
+        Name of a season definition in SEASONS.
+
+    Returns
+    -------
+    (np.ndarray, [str])
+        An integer code for the season of each time, which increases
+        chronologically, and the name of each season code from 0. Code 0
+        is the first season of year 0.
+    """
+    definition = SEASONS[seasons]
+    season_index = np.full(13, -1)
+    year_offset = np.zeros(13, dtype=int)
+    for i, (_, months) in enumerate(definition):
+        for month in months:
+            season_index[month] = i
+            # Months before the season wraps into a new year.
+            year_offset[month] = month > months[-1]
+    if np.any(season_index[1:] < 0):
+        raise ValueError(f'Seasons {seasons} do not cover every month')
+
+    months = np.asarray(times).astype('datetime64[ns]').astype(
+        'datetime64[M]').astype('int64')
+    year = months // 12 + 1970
+    month = months % 12 + 1
+    codes = ((year + year_offset[month]) * len(definition)
+             + season_index[month])
+    return codes, [name for name, _ in definition]
+
+
+def season_label(code: int, names: [str]) -> str:
+    """Name a season code, e.g. 2020summer."""
+    year, index = divmod(int(code), len(names))
+    return f'{year}{names[index]}'
+
+
+def seasonal_means(ids: np.ndarray, times: np.ndarray, values: np.ndarray,
+                   seasons: str = 'australian'):
+    """Compute the mean value of every waterbody in every season.
+
+    Arguments
+    ---------
+    ids : np.ndarray
+        Waterbody ID of each observation.
+
+    times : np.ndarray
+        Time of each observation, as datetime64 or int64 nanoseconds.
+
+    values : np.ndarray
+        Value of each observation. NaNs are ignored.
+
+    seasons : str
+        Name of a season definition in SEASONS.
+
+    Returns
+    -------
+    pd.DataFrame
+        Indexed by waterbody ID, with a column for each season from the
+        first to the last season observed, in order. Seasons without any
+        observations of a waterbody are NaN.
+    """
+    import pandas as pd
+    values = np.asarray(values, dtype=float)
+    valid = ~np.isnan(values)
+    codes, names = season_codes(np.asarray(times)[valid], seasons=seasons)
+    id_codes, unique_ids = pd.factorize(np.asarray(ids)[valid], sort=True)
+
+    # Every season between the first and the last is a column, like
+    # pandas' resample.
+    if len(codes):
+        first, last = codes.min(), codes.max()
+    else:
+        first, last = 0, -1
+    n_seasons = last - first + 1
+    keys = id_codes * n_seasons + (codes - first)
+    size = len(unique_ids) * n_seasons
+    sums = np.bincount(keys, weights=values[valid], minlength=size)
+    counts = np.bincount(keys, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    means = means.reshape(len(unique_ids), n_seasons)
+    return pd.DataFrame(
+        means, index=pd.Index(unique_ids),
+        columns=[season_label(c, names) for c in range(first, last + 1)])
+
+
+def _read_chunk(paths: [str]) -> (np.ndarray, np.ndarray, np.ndarray):
+    """Read some time series into flat arrays of lengths, times and values.
+    """
+    lengths, times, values = [], [], []
+    for path in paths:
+        try:
+            t, v = read_timeseries(path)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Could not read {path}: {e}')
+            t, v = np.zeros(0, dtype='int64'), np.zeros(0)
+        lengths.append(len(t))
+        times.append(t)
+        values.append(v)
+    return (np.array(lengths, dtype=int),
+            np.concatenate(times or [np.zeros(0, dtype='int64')]),
+            np.concatenate(values or [np.zeros(0)]))
+
+
+def read_long_timeseries(paths: [str], n_workers: int = 1
+                         ) -> (np.ndarray, np.ndarray, np.ndarray):
+    """Read many time series into one long table.
+
+    Arguments
+    ---------
+    paths : [str]
+        Paths to waterbody time series CSVs, named by waterbody ID.
+
+    n_workers : int
+        Number of processes to read time series with. Default 1.
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray, np.ndarray)
+        Waterbody ID, time (int64 nanoseconds) and wet pixel percentage
+        of each valid observation.
+    """
+    chunks = [paths[i:i + CHUNK_SIZE]
+              for i in range(0, len(paths), CHUNK_SIZE)]
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_read_chunk, chunks))
+    else:
+        results = [_read_chunk(chunk) for chunk in chunks]
+    if not results:
+        return np.zeros(0, dtype=object), np.zeros(0, dtype='int64'), \
+            np.zeros(0)
+
+    lengths, times, values = zip(*results)
+    ids = np.empty(len(paths), dtype=object)
+    ids[:] = [uid_from_path(p) for p in paths]
+    ids = np.repeat(ids, np.concatenate(lengths))
+    return ids, np.concatenate(times), np.concatenate(values)
+
+
+@click.command()
+@click.argument('config', type=click.Path())
+@click.option('--seasons', type=click.Choice(sorted(SEASONS)),
+              default='australian',
+              help='Which seasons to average over. Default australian, '
+              'which names DJF/MAM/JJA/SON summer, autumn, winter and '
+              'spring.')
+@click.option('--n-workers', type=int, default=None,
+              help='Number of processes to read time series with. Defaults '
+              'to the number of CPUs.')
+@click.option('-v', '--verbose', count=True)
+@click.version_option(version=dea_waterbodies.__version__)
+def main(config, seasons, n_workers, verbose):
+    """Append the seasonal mean wet area of waterbodies to a shapefile."""
+    import geopandas as gp
+
+    # Set up logging.
+    loggers = [logging.getLogger(name)
+               for name in logging.root.manager.loggerDict
+               if not name.startswith('fiona')
+               and not name.startswith('sqlalchemy')
+               and not name.startswith('boto')]
+    stdout_hdlr = logging.StreamHandler(sys.stdout)
+    for logger_ in loggers:
+        if verbose == 0:
+            logging.basicConfig(level=logging.WARNING)
+        elif verbose == 1:
+            logging.basicConfig(level=logging.INFO)
+        elif verbose == 2:
+            logging.basicConfig(level=logging.DEBUG)
+        else:
+            raise click.ClickException('Maximum verbosity is -vv')
+        logger_.addHandler(stdout_hdlr)
+
+    config_dict = process_config(config)
+    missing = [key for key in ['shape_file', 'snapshot_dir',
+                               'snapshot_shapefile', 'timeseries_dir']
+               if key not in config_dict]
+    if missing:
+        raise click.ClickException(
+            f'Config {config} is missing {", ".join(missing).upper()}')
+    n_workers = n_workers or os.cpu_count()
+
+    # If we've already made a snapshot, add to it.
+    output_shapefile = os.path.join(config_dict['snapshot_dir'],
+                                    config_dict['snapshot_shapefile'])
+    shape_file = config_dict['shape_file']
+    if os.path.isfile(output_shapefile):
+        logger.info(f'Appending to existing snapshot {output_shapefile}')
+        shape_file = output_shapefile
+    polygons = gp.read_file(shape_file)
+    id_field = guess_id_field(polygons.columns)
+    logger.info(f'The index we will use is {id_field}')
+
+    paths = list_timeseries(config_dict['timeseries_dir'])
+    logger.info(f'Reading {len(paths)} time series with {n_workers} '
+                'workers')
+    ids, times, values = read_long_timeseries(paths, n_workers=n_workers)
+    means = seasonal_means(ids, times, values, seasons=seasons)
+    logger.info(f'Computed {means.shape[1]} seasonal means for '
+                f'{means.shape[0]} waterbodies')
+
+    # Re-running replaces existing seasonal means.
+    polygons = polygons.drop(
+        columns=[c for c in means.columns if c in polygons.columns])
+    means.index.name = id_field
+    polygons = polygons.merge(means, left_on=id_field, right_index=True,
+                              how='left')
+    logger.info(f'Writing appended shapefile {output_shapefile}')
+    polygons.to_file(output_shapefile)
+
+
+if __name__ == "__main__":
+    main()
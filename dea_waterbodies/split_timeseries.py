@@ -0,0 +1,416 @@
+"""Split long-format waterbody time series into one series per waterbody.
+
+Conflux (via Athena) outputs one huge CSV with a row per waterbody per
+observation. This splits it up without loading it all into memory:
+
+1. The CSV is read in chunks, and each row is spilled to one of several
+   bucket files on local disk according to its waterbody's UID prefix.
+   There are enough buckets that each fits in the memory budget.
+2. Each bucket is sorted by UID and time in memory.
+3. The sorted rows are written out through a pool of writer threads,
+   either as one CSV per waterbody (output/UID[:4]/UID.csv), or as a
+   Parquet store partitioned by UID prefix
+   (output/prefix=UID[:4]/part-N.parquet).
+
+Geoscience Australia
+2021
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import math
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+
+import click
+import numpy as np
+
+import dea_waterbodies
+
+logger = logging.getLogger(__name__)
+
+# Columns in the Conflux output.
+ID_COLUMN = 'id'
+TIME_COLUMN = 'time'
+VALUE_COLUMNS = ['px_wet', 'pc_wet']
+
+# Time format in the Conflux output.
+TIME_FORMAT = '%Y%m%d-%H%M%S-%f'
+
+# Number of characters of the UID to group waterbodies by. This matches
+# the output directory structure.
+PREFIX_LENGTH = 4
+
+# Columns in the Parquet store, for consistency with the time series CSVs
+# from waterbodies-ts.
+STORE_COLUMNS = {
+    ID_COLUMN: 'UID',
+    'date': 'Observation Date',
+    'px_wet': 'Wet pixel count',
+    'pc_wet': 'Wet pixel percentage',
+}
+
+# Rough in-memory size of a row when sorting, in bytes.
+ROW_BYTES = 200
+
+
+def n_buckets_for(input_bytes: int, memory_budget: int) -> int:
+    """How many buckets to spill to so that each fits in memory.
+
+    A parsed bucket takes about as much memory as its CSV text, and
+    sorting it takes as much again.
+    """
+    return max(1, math.ceil(2 * input_bytes / memory_budget))
+
+
+def bucket_of(uids: np.ndarray, n_buckets: int) -> np.ndarray:
+    """Assign UIDs to buckets by hashing their prefixes."""
+    import pandas as pd
+    prefixes = np.asarray(uids, dtype=str).astype(f'U{PREFIX_LENGTH}')
+    hashes = pd.util.hash_array(prefixes.astype(object))
+    return (hashes % np.uint64(n_buckets)).astype(int)
+
+
+def parse_times(times, time_format: str = TIME_FORMAT) -> np.ndarray:
+    """Parse time strings and round them to the second.
+
+    The default Conflux format is fixed width, so it is rearranged into
+    ISO 8601 and parsed by numpy, which is much faster than strptime.
+
+    Returns
+    -------
+    np.ndarray
+        int64 nanoseconds since the epoch.
+    """
+    import pandas as pd
+    times = np.asarray(times, dtype=str)
+    if time_format == TIME_FORMAT and np.all(np.char.str_len(times) == 22):
+        chars = times.astype('U22').view('U1').reshape(-1, 22)
+        iso = np.full((len(times), 26), '', dtype='U1')
+        iso[:, [4, 7, 13, 16]] = ['-', '-', ':', ':']
+        iso[:, 10], iso[:, 19] = 'T', '.'
+        for src, dst in [(0, 0), (4, 5), (6, 8), (9, 11), (11, 14),
+                         (13, 17), (16, 20)]:
+            width = {0: 4, 16: 6}.get(src, 2)
+            iso[:, dst:dst + width] = chars[:, src:src + width]
+        parsed = iso.view('U26').ravel().astype('datetime64[ns]')
+    else:
+        parsed = np.asarray(pd.to_datetime(times, format=time_format),
+                            dtype='datetime64[ns]')
+    rounded = pd.DatetimeIndex(parsed).round('1s')
+    return np.asarray(rounded, dtype='datetime64[ns]').view('int64')
+
+
+def spill(input_path: str, spill_dir: str, n_buckets: int,
+          chunk_rows: int, time_format: str = TIME_FORMAT) -> [str]:
+    """Stream a long-format CSV into bucket files.
+
+    Times are parsed, rounded to the second and stored as int64
+    nanoseconds. Each bucket file is a sequence of pickled chunks.
+
+    Returns
+    -------
+    [str]
+        Path to each bucket file. Empty buckets have no file.
+    """
+    import pandas as pd
+    paths = [os.path.join(spill_dir, f'bucket-{i:05d}.pkl')
+             for i in range(n_buckets)]
+    written = np.zeros(n_buckets, dtype=bool)
+    columns = [ID_COLUMN, TIME_COLUMN] + VALUE_COLUMNS
+    n_rows = 0
+    for chunk in pd.read_csv(input_path, usecols=columns,
+                             chunksize=chunk_rows,
+                             dtype={ID_COLUMN: str, TIME_COLUMN: str}):
+        chunk = chunk.assign(**{TIME_COLUMN: parse_times(
+            chunk[TIME_COLUMN].values, time_format=time_format)})
+        buckets = bucket_of(chunk[ID_COLUMN].values, n_buckets)
+        order = np.argsort(buckets, kind='stable')
+        bounds = np.searchsorted(buckets[order], np.arange(n_buckets + 1))
+        for i in np.flatnonzero(np.diff(bounds)):
+            rows = chunk.iloc[order[bounds[i]:bounds[i + 1]]]
+            with open(paths[i], 'ab') as f:
+                pickle.dump(rows[columns], f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            written[i] = True
+        n_rows += len(chunk)
+        logger.debug(f'Spilled {n_rows} rows')
+    logger.info(f'Spilled {n_rows} rows into {written.sum()} buckets')
+    return [p for p, w in zip(paths, written) if w]
+
+
+def sort_bucket(path: str):
+    """Read a bucket and sort it by UID and time.
+
+    Raises a ValueError if any waterbody has duplicate times.
+
+    Returns
+    -------
+    (pd.DataFrame, np.ndarray)
+        The sorted rows, with a date column instead of time, and the
+        start of each waterbody's rows (with the end appended).
+    """
+    import pandas as pd
+    chunks = []
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                chunks.append(pickle.load(f))
+            except EOFError:
+                break
+    rows = pd.concat(chunks, ignore_index=True)
+    # Sorting integer codes is much faster than sorting strings.
+    codes, _ = pd.factorize(rows[ID_COLUMN], sort=True)
+    times = rows[TIME_COLUMN].values
+    order = np.lexsort((times, codes))
+    codes, times = codes[order], times[order]
+    rows = rows.iloc[order].reset_index(drop=True)
+
+    new_uid = np.ones(len(codes), dtype=bool)
+    new_uid[1:] = codes[1:] != codes[:-1]
+    duplicated = ~new_uid[1:] & (times[1:] == times[:-1])
+    if duplicated.any():
+        uid = rows[ID_COLUMN].values[1:][duplicated][0]
+        raise ValueError(f'Duplicate times for {uid}')
+    starts = np.append(np.flatnonzero(new_uid), len(codes))
+
+    rows = rows.drop(columns=[TIME_COLUMN])
+    rows.insert(1, 'date', times.astype('datetime64[ns]'))
+    return rows, starts
+
+
+def _makedirs(path: str):
+    """Make the parent directory of a local path."""
+    if '://' not in path:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+
+def _write_text(path: str, text: str):
+    import fsspec
+    _makedirs(path)
+    with fsspec.open(path, 'w') as f:
+        f.write(text)
+
+
+def write_csvs(rows, starts: np.ndarray, output_dir: str,
+               executor: ThreadPoolExecutor, overwrite: bool = False) -> int:
+    """Write one CSV per waterbody from sorted rows.
+
+    Returns
+    -------
+    int
+        Number of CSVs written.
+    """
+    import fsspec
+    from dea_waterbodies.uids import uid_paths
+    columns = ['date'] + VALUE_COLUMNS
+    # Format the whole bucket at once and slice out each waterbody.
+    lines = rows[columns].to_csv(None, header=False, index=False,
+                                 lineterminator='\n').splitlines(True)
+    header = ','.join(columns) + '\n'
+    uids = rows[ID_COLUMN].values[starts[:-1]]
+    paths = uid_paths(output_dir, uids)
+    if not overwrite:
+        fs, _ = fsspec.core.url_to_fs(str(output_dir))
+        exists = np.array(list(executor.map(fs.exists, paths)), dtype=bool)
+    else:
+        exists = np.zeros(len(paths), dtype=bool)
+
+    futures = [
+        executor.submit(_write_text, str(path),
+                        header + ''.join(lines[start:end]))
+        for path, start, end, skip in zip(paths, starts[:-1], starts[1:],
+                                          exists)
+        if not skip]
+    for future in futures:
+        future.result()
+    return len(futures)
+
+
+def prepare_store(output_dir: str, overwrite: bool = False):
+    """Clear the partitions of an existing Parquet store.
+
+    Part files are numbered from 0 on every run, so parts left over from
+    an earlier run would duplicate waterbodies.
+
+    Raises
+    ------
+    ValueError
+        If the store has partitions and overwrite is False.
+    """
+    import fsspec
+    fs, fs_path = fsspec.core.url_to_fs(str(output_dir))
+    try:
+        listing = fs.ls(fs_path, detail=False)
+    except FileNotFoundError:
+        return
+    partitions = [path for path in listing
+                  if os.path.basename(path.rstrip('/')).startswith('prefix=')]
+    if partitions and not overwrite:
+        raise ValueError(f'{output_dir} already has a Parquet store; '
+                         'overwrite it to replace it')
+    for path in partitions:
+        fs.rm(path, recursive=True)
+    if partitions:
+        logger.info(f'Removed {len(partitions)} partitions from {output_dir}')
+
+
+def write_store(rows, starts: np.ndarray, output_dir: str,
+                executor: ThreadPoolExecutor, part: int) -> int:
+    """Write sorted rows to a Parquet store partitioned by UID prefix.
+
+    Returns
+    -------
+    int
+        Number of waterbodies written.
+    """
+    store = rows.rename(columns=STORE_COLUMNS)
+    prefixes = store['UID'].values.astype(str).astype(f'U{PREFIX_LENGTH}')
+    # Rows are sorted by UID, so each prefix is contiguous.
+    bounds = np.flatnonzero(np.append(True, prefixes[1:] != prefixes[:-1]))
+    bounds = np.append(bounds, len(prefixes))
+
+    def write(prefix, start, end):
+        path = os.path.join(str(output_dir), f'prefix={prefix}',
+                            f'part-{part:05d}.parquet')
+        _makedirs(path)
+        store.iloc[start:end].to_parquet(path, index=False)
+
+    futures = [executor.submit(write, prefixes[start], start, end)
+               for start, end in zip(bounds[:-1], bounds[1:])]
+    for future in futures:
+        future.result()
+    return len(starts) - 1
+
+
+def split_timeseries(input_path: str, output_dir: str,
+                     memory_budget: int = 2 * 1024 ** 3,
+                     n_writers: int = 16, output_format: str = 'csv',
+                     overwrite: bool = False, time_format: str = TIME_FORMAT,
+                     spill_dir: str = None) -> int:
+    """Split a long-format CSV into per-waterbody outputs.
+
+    Arguments
+    ---------
+    input_path : str
+        Long-format CSV with id, time, px_wet and pc_wet columns. May be
+        an S3 URI.
+
+    output_dir : str
+        Where to write outputs. May be an S3 URI.
+
+    memory_budget : int
+        Approximate memory to use, in bytes.
+
+    n_writers : int
+        Number of writer threads.
+
+    output_format : str
+        'csv' for one CSV per waterbody, or 'parquet' for a Parquet store
+        partitioned by UID prefix.
+
+    overwrite : bool
+        Whether to overwrite existing CSVs, or replace an existing Parquet
+        store. Writing to an existing store is an error otherwise.
+
+    time_format : str
+        strptime format of the time column.
+
+    spill_dir : str
+        Local directory for temporary bucket files. Defaults to the
+        system temporary directory.
+
+    Returns
+    -------
+    int
+        Number of waterbodies written.
+    """
+    import fsspec
+    if output_format not in {'csv', 'parquet'}:
+        raise ValueError(f'Unknown output format: {output_format}')
+    if output_format == 'parquet':
+        prepare_store(output_dir, overwrite=overwrite)
+    fs, fs_path = fsspec.core.url_to_fs(str(input_path))
+    n_buckets = n_buckets_for(fs.size(fs_path), memory_budget)
+    chunk_rows = max(1000, memory_budget // (4 * ROW_BYTES))
+    logger.info(f'Splitting {input_path} into {n_buckets} buckets')
+
+    spill_dir = tempfile.mkdtemp(prefix='waterbodies-split-', dir=spill_dir)
+    try:
+        buckets = spill(input_path, spill_dir, n_buckets, chunk_rows,
+                        time_format=time_format)
+        n_written = 0
+        with ThreadPoolExecutor(max_workers=n_writers) as executor:
+            for part, bucket in enumerate(buckets):
+                rows, starts = sort_bucket(bucket)
+                if output_format == 'csv':
+                    n_written += write_csvs(rows, starts, output_dir,
+                                            executor, overwrite=overwrite)
+                else:
+                    n_written += write_store(rows, starts, output_dir,
+                                             executor, part)
+                os.remove(bucket)
+                logger.info(f'Wrote bucket {part + 1}/{len(buckets)}')
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    logger.info(f'Wrote {n_written} waterbodies to {output_dir}')
+    return n_written
+
+
+@click.command()
+@click.argument('input_path', type=click.Path())
+@click.argument('output_dir', type=click.Path())
+@click.option('--format', 'output_format',
+              type=click.Choice(['csv', 'parquet']), default='csv',
+              help='csv (default) writes one CSV per waterbody. parquet '
+              'writes a Parquet store partitioned by UID prefix.')
+@click.option('--memory', type=int, default=2048,
+              help='Approximate memory budget in MB. Default 2048.')
+@click.option('--n-writers', type=int, default=16,
+              help='Number of writer threads. Default 16.')
+@click.option('--overwrite/--skip-existing', default=False,
+              help='Whether to overwrite existing CSVs. Default is to skip '
+              'waterbodies that already have a CSV. A Parquet store is only '
+              'replaced with --overwrite.')
+@click.option('--time-format', default=TIME_FORMAT,
+              help=f'Format of the time column. Default {TIME_FORMAT}.')
+@click.option('--spill-dir', type=click.Path(), default=None,
+              help='Local directory for temporary files.')
+@click.option('-v', '--verbose', count=True)
+@click.version_option(version=dea_waterbodies.__version__)
+def main(input_path, output_dir, output_format, memory, n_writers,
+         overwrite, time_format, spill_dir, verbose):
+    """Split long-format Conflux output into per-waterbody time series."""
+    # Set up logging.
+    loggers = [logging.getLogger(name)
+               for name in logging.root.manager.loggerDict
+               if not name.startswith('fiona')
+               and not name.startswith('sqlalchemy')
+               and not name.startswith('boto')]
+    stdout_hdlr = logging.StreamHandler(sys.stdout)
+    for logger_ in loggers:
+        if verbose == 0:
+            logging.basicConfig(level=logging.WARNING)
+        elif verbose == 1:
+            logging.basicConfig(level=logging.INFO)
+        elif verbose == 2:
+            logging.basicConfig(level=logging.DEBUG)
+        else:
+            raise click.ClickException('Maximum verbosity is -vv')
+        logger_.addHandler(stdout_hdlr)
+
+    try:
+        split_timeseries(input_path, output_dir,
+                         memory_budget=memory * 1024 ** 2,
+                         n_writers=n_writers, output_format=output_format,
+                         overwrite=overwrite, time_format=time_format,
+                         spill_dir=spill_dir)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""Generate waterbody unique IDs and the paths derived from them.
+
+Waterbody UIDs are geohashes of the polygon centroids. The encoder here
+works on whole arrays of coordinates at once and gives the same results as
+python-geohash's geohash.encode.
+
+Geoscience Australia
+2021
+"""
+
+import os
+import warnings
+
+import numpy as np
+
+# Geohash base32 alphabet.
+GEOHASH_ALPHABET = np.frombuffer(b'0123456789bcdefghjkmnpqrstuvwxyz',
+                                 dtype=np.uint8)
+
+# Maximum precision we can encode with 64-bit integers (5 bits per char).
+MAX_PRECISION = 12
+
+
+def _to_fixed_point(x: np.ndarray) -> np.ndarray:
+    """Map doubles in [-1, 1) to the top 32 bits of a 64-bit fixed point.
+
+    This matches double_to_i64 in python-geohash, which truncates the
+    mantissa towards zero before offsetting by 2^63. All operations here
+    are exact in double precision as they only scale by powers of two.
+    """
+    truncated = np.trunc(np.ldexp(x, 63))
+    top = np.floor(np.ldexp(truncated, -32)).astype(np.int64) + (1 << 31)
+    return top.astype(np.uint64)
+
+
+def _spread_bits(x: np.ndarray) -> np.ndarray:
+    """Spread the low 32 bits of x so that there is a zero between each."""
+    x = x & np.uint64(0x00000000FFFFFFFF)
+    x = (x | (x << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    x = (x | (x << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    x = (x | (x << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    x = (x | (x << np.uint64(2))) & np.uint64(0x3333333333333333)
+    x = (x | (x << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return x
+
+
+def encode_geohashes(latitudes, longitudes, precision: int = 9) -> np.ndarray:
+    """Geohash arrays of coordinates.
+
+    Arguments
+    ---------
+    latitudes : array_like
+        Latitudes in degrees, in [-90, 90).
+
+    longitudes : array_like
+        Longitudes in degrees. Wrapped into [-180, 180).
+
+    precision : int
+        Number of characters in each geohash. Default 9, which is what we
+        use for waterbody UIDs.
+
+    Returns
+    -------
+    np.ndarray of str
+    """
+    if not 1 <= precision <= MAX_PRECISION:
+        raise ValueError(
+            f'precision must be between 1 and {MAX_PRECISION}')
+    latitudes = np.asarray(latitudes, dtype='float64')
+    longitudes = np.asarray(longitudes, dtype='float64')
+    if latitudes.shape != longitudes.shape:
+        raise ValueError('latitudes and longitudes must have the same shape')
+    if np.any((latitudes >= 90) | (latitudes < -90)):
+        raise ValueError('invalid latitude.')
+    if not np.all(np.isfinite(longitudes)):
+        raise ValueError('invalid longitude.')
+    longitudes = np.mod(longitudes + 180, 360) - 180
+
+    lat_bits = _to_fixed_point(latitudes.ravel() / 90.0)
+    lon_bits = _to_fixed_point(longitudes.ravel() / 180.0)
+    # Longitude takes the most significant bit of each pair.
+    interleaved = (_spread_bits(lon_bits) << np.uint64(1)) | _spread_bits(
+        lat_bits)
+
+    shifts = np.uint64(64) - np.uint64(5) * np.arange(
+        1, precision + 1, dtype=np.uint64)
+    indices = (interleaved[:, None] >> shifts[None, :]) & np.uint64(31)
+    chars = np.ascontiguousarray(GEOHASH_ALPHABET[indices])
+    hashes = chars.view(f'S{precision}').ravel().astype(f'U{precision}')
+    return hashes.reshape(latitudes.shape)
+
+
+def centroid_geohashes(polygons, precision: int = 9) -> np.ndarray:
+    """Geohash the centroids of a GeoDataFrame or GeoSeries of polygons."""
+    # We need to convert to lat/lon in order to generate the geohash.
+    # geopandas warns about centroids in a geographic CRS, but this is how
+    # UIDs have always been defined, so we keep it for consistency.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        centroids = polygons.geometry.to_crs(epsg=4326).centroid
+    return encode_geohashes(centroids.y.values, centroids.x.values,
+                            precision=precision)
+
+
+def check_unique(uids):
+    """Raise a ValueError if any UIDs are duplicated."""
+    unique, counts = np.unique(np.asarray(uids, dtype=str),
+                               return_counts=True)
+    if np.any(counts > 1):
+        raise ValueError(
+            'Duplicate UIDs: {}'.format(', '.join(unique[counts > 1])))
+
+
+def assign_uids(polygons, precision: int = 9):
+    """Add UID and WB_ID columns to a GeoDataFrame of waterbodies.
+
+    The UID is the geohash of the polygon centroid in EPSG:4326. Polygons
+    are then sorted by UID so that polygons close to each other are
+    numbered similarly, and WB_ID is the position in that order.
+
+    Arguments
+    ---------
+    polygons : gp.GeoDataFrame
+        Waterbody polygons with a CRS set.
+
+    precision : int
+        Geohash precision. Default 9.
+
+    Returns
+    -------
+    gp.GeoDataFrame
+        Polygons in the same CRS as the input, sorted by UID, with a fresh
+        index.
+    """
+    uids = centroid_geohashes(polygons, precision=precision)
+
+    # Check that our unique ID is in fact unique.
+    check_unique(uids)
+
+    polygons = polygons.copy()
+    polygons['UID'] = uids
+    sorted_polygons = polygons.sort_values(by=['UID']).reset_index(drop=True)
+    sorted_polygons['WB_ID'] = sorted_polygons.index
+    return sorted_polygons
+
+
+def uid_paths(output_dir: str, uids, suffix: str = '.csv') -> np.ndarray:
+    """Construct the output paths for many waterbody UIDs at once.
+
+    Outputs are stored as output_dir/UID[:4]/UID.csv. Must return strings,
+    not Paths, in case there's a protocol.
+
+    Arguments
+    ---------
+    output_dir : str
+        Base output directory. May be an S3 URI.
+
+    uids : array_like of str
+        Waterbody UIDs.
+
+    suffix : str
+        File suffix. Default '.csv'.
+
+    Returns
+    -------
+    np.ndarray of str
+    """
+    uids = np.asarray(uids, dtype=str)
+    prefix = os.path.join(str(output_dir), '')
+    return np.char.add(
+        np.char.add(np.char.add(prefix, uids.astype('U4')), '/'),
+        np.char.add(uids, suffix))
@@ -0,0 +1,719 @@
+"""Processing stages for making waterbody polygons.
+
+These are the pieces of make_polygons that don't need a datacube, so they
+can be reused from notebooks and run in worker processes.
+
+Geoscience Australia
+2021
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+from affine import Affine
+import geopandas as gp
+import numpy as np
+import pandas as pd
+from shapely import geometry as shapely_geom
+
+from dea_waterbodies.uids import centroid_geohashes, check_unique
+
+logger = logging.getLogger(__name__)
+
+# geopandas < 0.12 can only do bulk spatial index queries with query_bulk.
+GPD_VERSION = tuple(int(v) for v in gp.__version__.split('.')[:2])
+
+# Bump this to invalidate existing checkpoints when a stage's output changes.
+CHECKPOINT_VERSION = 1
+
+# Bump this to invalidate existing tile manifests when fingerprints change.
+MANIFEST_VERSION = 1
+
+
+def query_pairs(tree_geoms: gp.GeoSeries, query_geoms: gp.GeoSeries,
+                predicate: str = 'intersects') -> (np.ndarray, np.ndarray):
+    """Find all pairs of geometries satisfying a predicate.
+
+    Uses an STRtree over tree_geoms, so only pairs with intersecting
+    bounding boxes are tested with the predicate.
+
+    Arguments
+    ---------
+    tree_geoms : gp.GeoSeries
+        Geometries to build the spatial index on.
+
+    query_geoms : gp.GeoSeries
+        Geometries to query the spatial index with.
+
+    predicate : str
+        Shapely predicate, evaluated as query_geom.predicate(tree_geom).
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray)
+        Positional indices into query_geoms and tree_geoms respectively.
+    """
+    sindex = tree_geoms.sindex
+    if GPD_VERSION < (0, 12):
+        query = sindex.query_bulk
+    else:
+        query = sindex.query
+    query_idx, tree_idx = query(np.asarray(query_geoms.values),
+                                predicate=predicate)
+    return query_idx, tree_idx
+
+
+def parallel_map(func, args, n_workers: int = 1):
+    """Map func over an iterable of argument tuples, in order.
+
+    With more than one worker, jobs run on a process pool. Only a few jobs
+    per worker are kept in flight, so args can be a generator that loads
+    data lazily without everything ending up in memory at once.
+
+    Arguments
+    ---------
+    func : callable
+        Function to apply. Must be picklable if n_workers > 1.
+
+    args : iterable of tuples
+        Arguments for each call.
+
+    n_workers : int
+        Number of processes. Default 1, which runs in this process.
+
+    Returns
+    -------
+    generator of results, in the same order as args.
+    """
+    if n_workers <= 1:
+        for a in args:
+            yield func(*a)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        pending = deque()
+        for a in args:
+            pending.append(executor.submit(func, *a))
+            if len(pending) >= 2 * n_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def tile_windows(shape: (int, int), tile_size: int) -> [(slice, slice)]:
+    """Split a raster shape into square tiles, in row-major order."""
+    n_rows, n_cols = shape
+    return [(slice(r, min(r + tile_size, n_rows)),
+             slice(c, min(c + tile_size, n_cols)))
+            for r in range(0, n_rows, tile_size)
+            for c in range(0, n_cols, tile_size)]
+
+
+def threshold_wofs(wet_frequency: np.ndarray, count_clear: np.ndarray,
+                   threshold: float,
+                   min_valid_observations: int) -> np.ndarray:
+    """Find pixels wet more often than threshold.
+
+    If count_clear is not None, pixels must also have at least
+    min_valid_observations clear observations. Nan never passes.
+    """
+    with np.errstate(invalid='ignore'):
+        mask = wet_frequency > threshold
+        if count_clear is not None:
+            mask &= count_clear >= min_valid_observations
+    return mask
+
+
+def _union_touching(polygons: gp.GeoSeries) -> gp.GeoSeries:
+    """Union each group of touching polygons into separate polygons.
+
+    This gives the same polygons as a unary_union of everything, but only
+    unions polygons that actually touch each other.
+    """
+    if not len(polygons):
+        return polygons
+    polygons = polygons.reset_index(drop=True)
+    i, j = query_pairs(polygons, polygons)
+    components = _connected_components(len(polygons), i, j)
+    groups = np.zeros(len(polygons), dtype=int)
+    for k, component in enumerate(components):
+        groups[component] = k
+    merged = gp.GeoDataFrame({'group': groups}, geometry=polygons)
+    merged = merged.dissolve(by='group').geometry
+    return merged.explode().reset_index(drop=True)
+
+
+def vectorise_tile(wet_frequency: np.ndarray, count_clear: np.ndarray,
+                   threshold: float, min_valid_observations: int,
+                   offset: (int, int)) -> gp.GeoSeries:
+    """Threshold and vectorise one tile of the WOfS summary.
+
+    Polygons are returned in pixel coordinates of the whole raster, so that
+    edges on tile seams line up exactly when merging tiles.
+
+    Arguments
+    ---------
+    wet_frequency : np.ndarray
+        wofs_filtered_summary for this tile.
+
+    count_clear : np.ndarray or None
+        count_clear for this tile, or None to skip the valid observation
+        filter.
+
+    threshold : float
+        Wet frequency threshold.
+
+    min_valid_observations : int
+        Minimum number of clear observations.
+
+    offset : (int, int)
+        Row and column of the tile's top left pixel in the whole raster.
+
+    Returns
+    -------
+    gp.GeoSeries
+    """
+    import rasterio.features
+    mask = threshold_wofs(wet_frequency, count_clear, threshold,
+                          min_valid_observations)
+    if not mask.any():
+        return gp.GeoSeries([])
+    row_off, col_off = offset
+    shapes = rasterio.features.shapes(
+        mask.astype('uint8'), mask=mask,
+        transform=Affine.translation(col_off, row_off))
+    # Each shape is already a whole connected region, so they never need
+    # to be unioned with each other within a tile.
+    polygons = gp.GeoSeries([shapely_geom.shape(s) for s, _ in shapes])
+    return polygons.buffer(0).explode().reset_index(drop=True)
+
+
+def merge_tiles(tile_polygons: [gp.GeoSeries], windows: [(slice, slice)],
+                transform: Affine, crs: str = 'EPSG:3577'
+                ) -> gp.GeoDataFrame:
+    """Merge polygons vectorised from tiles into one set of polygons.
+
+    Only polygons touching a tile seam need to be merged with anything, so
+    the rest pass through untouched.
+
+    Arguments
+    ---------
+    tile_polygons : [gp.GeoSeries]
+        Polygons for each tile in pixel coordinates, from vectorise_tile.
+
+    windows : [(slice, slice)]
+        The tile windows, from tile_windows.
+
+    transform : Affine
+        Transform from pixel coordinates to crs.
+
+    crs : str
+        CRS of the output.
+
+    Returns
+    -------
+    gp.GeoDataFrame
+        With an area column.
+    """
+    polygons = gp.GeoSeries(pd.concat(
+        [gp.GeoSeries([])] + list(tile_polygons), ignore_index=True))
+    n_rows = max(w[0].stop for w in windows)
+    n_cols = max(w[1].stop for w in windows)
+    seams = [shapely_geom.LineString([(0, r), (n_cols, r)])
+             for r in {w[0].start for w in windows} - {0}]
+    seams += [shapely_geom.LineString([(c, 0), (c, n_rows)])
+              for c in {w[1].start for w in windows} - {0}]
+
+    if seams and len(polygons):
+        on_seam_idx, _ = query_pairs(gp.GeoSeries(seams), polygons)
+        on_seam = np.zeros(len(polygons), dtype=bool)
+        on_seam[on_seam_idx] = True
+        polygons = pd.concat([polygons[~on_seam],
+                              _union_touching(polygons[on_seam])],
+                             ignore_index=True)
+
+    # Move into the real CRS.
+    matrix = [transform.a, transform.b, transform.d, transform.e,
+              transform.c, transform.f]
+    polygons = gp.GeoDataFrame(
+        geometry=polygons.affine_transform(matrix).values, crs=crs)
+    polygons['area'] = polygons.area
+    return polygons
+
+
+def assign_fragments(parts: gp.GeoDataFrame, fragments: gp.GeoDataFrame):
+    """Attach fragments to the parts they touch.
+
+    Each fragment is merged into the first part (in order) whose exterior
+    intersects the fragment's exterior. Fragments that don't touch any part
+    are left unassigned.
+
+    Arguments
+    ---------
+    parts : gp.GeoDataFrame
+        Polygons to attach fragments to.
+
+    fragments : gp.GeoDataFrame
+        Polygons to be attached.
+
+    Returns
+    -------
+    (gp.GeoSeries, gp.GeoDataFrame)
+        The recombined parts, in the same order as parts, and the
+        unassigned fragments.
+    """
+    if not len(parts) or not len(fragments):
+        return (gp.GeoSeries(list(parts.geometry), crs=parts.crs),
+                fragments)
+
+    part_idx, fragment_idx = query_pairs(
+        fragments.exterior, parts.exterior, predicate='intersects')
+    # Each fragment goes to the first part it touches.
+    owner = np.full(len(fragments), -1)
+    if len(part_idx):
+        first = pd.Series(part_idx).groupby(fragment_idx).min()
+        owner[first.index.values] = first.values
+    assigned = owner >= 0
+
+    # Union each part with its fragments in one grouped reduction.
+    pieces = gp.GeoDataFrame(
+        {'group': np.concatenate([np.arange(len(parts)), owner[assigned]])},
+        geometry=(list(parts.geometry)
+                  + list(fragments.geometry[assigned])),
+        crs=parts.crs)
+    recombined = pieces.dissolve(by='group').geometry
+    recombined = recombined.reset_index(drop=True)
+    return recombined, fragments[~assigned]
+
+
+def _erode_dilate_split(splittable: gp.GeoDataFrame,
+                        buffered: gp.GeoSeries) -> gp.GeoDataFrame:
+    """Split polygons along the bits that vanish after erode-dilate."""
+    subtracted = gp.overlay(splittable, gp.GeoDataFrame(
+        geometry=[buffered.unary_union], crs=splittable.crs),
+        how='difference').explode().reset_index(drop=True)
+    resubtracted = gp.overlay(
+        splittable, subtracted, how='difference'
+        ).explode().reset_index(drop=True)
+
+    # Assign each chopped-off bit of the polygon to its nearest big
+    # neighbour.
+    recombined, unassigned = assign_fragments(resubtracted, subtracted)
+
+    # All remaining polygons are not part of a big polygon.
+    return pd.concat([
+        gp.GeoDataFrame(geometry=recombined, crs=splittable.crs),
+        unassigned], ignore_index=True)
+
+
+def _connected_components(n: int, i: np.ndarray, j: np.ndarray) -> [[int]]:
+    """Group n nodes connected by edges (i, j) into components."""
+    parent = np.arange(n)
+
+    def find(a):
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    for a, b in zip(i, j):
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    roots = np.array([find(a) for a in range(n)], dtype=int)
+    # Components in order of their first member.
+    _, first, labels = np.unique(roots, return_index=True,
+                                 return_inverse=True)
+    order = np.argsort(first)
+    return [np.flatnonzero(labels == k).tolist() for k in order]
+
+
+def _batch_components(components: [[int]], weights: np.ndarray,
+                      n_batches: int) -> [[int]]:
+    """Spread components over batches, balancing the total weight."""
+    totals = np.zeros(n_batches)
+    batches = [[] for _ in range(n_batches)]
+    by_weight = sorted(
+        components, key=lambda c: (-weights[c].sum(), c[0]))
+    for component in by_weight:
+        lightest = int(np.argmin(totals))
+        batches[lightest].extend(component)
+        totals[lightest] += weights[component].sum()
+    return [sorted(b) for b in batches if b]
+
+
+def split_large_polygons(polygons: gp.GeoDataFrame,
+                         pp_thresh: float = 0.005,
+                         erode: float = 100,
+                         dilate: float = 125,
+                         n_workers: int = 1) -> gp.GeoDataFrame:
+    """Split polygons with a low Polsby-Popper score by erode-dilate.
+
+    Each polygon with pp_test <= pp_thresh is eroded and then dilated, and
+    the bits that don't survive are cut out. These cut-off fragments are
+    then attached back onto the remaining parts that they touch.
+
+    Polygons only affect each other if they touch or if one's dilated
+    shape reaches the other, so these groups of polygons are independent
+    and can be split in parallel.
+
+    Arguments
+    ---------
+    polygons : gp.GeoDataFrame
+        Polygons with a pp_test column.
+
+    pp_thresh : float
+        Polsby-Popper threshold at or below which polygons are split.
+
+    erode : float
+        Erosion distance in CRS units.
+
+    dilate : float
+        Dilation distance in CRS units.
+
+    n_workers : int
+        Number of processes to split with. Default 1 (no parallelism).
+
+    Returns
+    -------
+    gp.GeoDataFrame
+    """
+    splittable = polygons[polygons.pp_test <= pp_thresh].reset_index(
+        drop=True)
+    if not len(splittable):
+        return polygons
+
+    buffered = splittable.buffer(-erode).buffer(dilate)
+
+    if n_workers <= 1:
+        batches = [list(range(len(splittable)))]
+    else:
+        # Find groups of polygons that can affect each other.
+        i, j = query_pairs(splittable.geometry, buffered)
+        touch_i, touch_j = query_pairs(splittable.geometry,
+                                       splittable.geometry)
+        components = _connected_components(
+            len(splittable),
+            np.concatenate([i, touch_i]), np.concatenate([j, touch_j]))
+        batches = _batch_components(
+            components, splittable.area.values, n_workers * 4)
+        logger.info(f'Splitting {len(splittable)} polygons in '
+                    f'{len(components)} independent groups')
+
+    jobs = ((splittable.iloc[b], buffered.iloc[b]) for b in batches)
+    results = list(parallel_map(_erode_dilate_split, jobs, n_workers))
+
+    results = pd.concat(
+        results + [polygons[polygons.pp_test > pp_thresh]],
+        ignore_index=True)
+    return results.explode().reset_index(drop=True)
+
+
+def _river_crs(rivers_path) -> str or None:
+    """CRS of a vector file, without reading its features."""
+    return gp.read_file(rivers_path, rows=0).crs
+
+
+def _intersecting_rivers(rivers_path, polygons: gp.GeoSeries,
+                         where: str = None) -> np.ndarray:
+    """Find which polygons intersect lines in a file.
+
+    Only lines whose bounding boxes intersect the bounding box of all the
+    polygons are read, and candidate pairs are found with an STRtree before
+    testing for intersection.
+
+    Returns
+    -------
+    np.ndarray
+        Sorted positional indices of polygons that intersect a line.
+    """
+    from pyproj import Transformer
+    rivers_crs = _river_crs(rivers_path)
+    bounds = polygons.total_bounds
+    if rivers_crs is not None and polygons.crs is not None:
+        bounds = Transformer.from_crs(
+            polygons.crs, rivers_crs, always_xy=True).transform_bounds(
+                *bounds, densify_pts=21)
+    kwargs = {'where': where} if where else {}
+    rivers = gp.read_file(rivers_path, bbox=tuple(bounds), **kwargs)
+    if not len(rivers):
+        return np.array([], dtype=int)
+    if polygons.crs is not None:
+        rivers = rivers.to_crs(polygons.crs)
+    polygon_idx, _ = query_pairs(rivers.geometry, polygons)
+    return np.unique(polygon_idx)
+
+
+def filter_rivers(polygons: gp.GeoDataFrame, rivers_path: Path,
+                  where: str = None, tile_size: float = 100000,
+                  n_workers: int = 1) -> gp.GeoDataFrame:
+    """Remove polygons that intersect river lines.
+
+    The river lines (e.g. the Geofabric major rivers) are read one tile at
+    a time, so the whole national network never has to be in memory, and
+    tiles are processed on n_workers processes.
+
+    Arguments
+    ---------
+    polygons : gp.GeoDataFrame
+        Waterbody polygons.
+
+    rivers_path : Path
+        Any vector file geopandas can read with a bbox filter, e.g. a
+        shapefile or GeoPackage.
+
+    where : str
+        Optional SQL WHERE clause to select rivers, e.g.
+        "Hierarchy = 'Major'". Needs pyogrio.
+
+    tile_size : float
+        Tile size in the units of the polygon CRS. Each polygon is assigned
+        to the tile containing its bottom left corner, and rivers are read
+        within the bounds of each tile's polygons.
+
+    n_workers : int
+        Number of processes.
+
+    Returns
+    -------
+    gp.GeoDataFrame
+        Polygons that don't intersect any river.
+    """
+    if not len(polygons):
+        return polygons
+    corners = polygons.bounds[['minx', 'miny']].values
+    tile_ids = np.floor(corners / tile_size).astype(np.int64)
+    _, tile_of = np.unique(tile_ids, axis=0, return_inverse=True)
+    tile_of = tile_of.ravel()
+    order = np.argsort(tile_of, kind='stable')
+    starts = np.flatnonzero(np.diff(tile_of[order], prepend=-1))
+    groups = np.split(order, starts[1:])
+    logger.info(f'Filtering {len(polygons)} polygons by rivers in '
+                f'{len(groups)} tiles')
+
+    jobs = ((rivers_path, polygons.geometry.iloc[group], where)
+            for group in groups)
+    intersecting = [group[found] for group, found in zip(
+        groups, parallel_map(_intersecting_rivers, jobs, n_workers))]
+    intersecting = np.concatenate(intersecting)
+    logger.info(f'Removing {len(intersecting)} polygons that intersect '
+                'rivers')
+    keep = np.ones(len(polygons), dtype=bool)
+    keep[intersecting] = False
+    return polygons[keep]
+
+
+def checkpoint_path(checkpoint_dir: Path, base_filename: str, stage: str,
+                    params: dict) -> Path:
+    """Path to the GeoParquet checkpoint for a stage run with params."""
+    key = json.dumps(dict(params, checkpoint_version=CHECKPOINT_VERSION),
+                     sort_keys=True, default=str)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+    return Path(checkpoint_dir) / f'{base_filename}_{stage}_{digest}.parquet'
+
+
+def run_stage(stage: str, compute, params: dict,
+              checkpoint_dir: Path = None,
+              base_filename: str = 'waterbodies') -> gp.GeoDataFrame:
+    """Run a polygon stage, or read it from a checkpoint.
+
+    Arguments
+    ---------
+    stage : str
+        Name of the stage.
+
+    compute : callable
+        Function with no arguments that computes the stage output.
+
+    params : dict
+        Everything the stage output depends on, including the parameters of
+        all upstream stages. Must be JSON-serialisable.
+
+    checkpoint_dir : Path
+        Directory to keep GeoParquet checkpoints in. Default None, which
+        disables checkpointing.
+
+    base_filename : str
+        Prefix for checkpoint filenames.
+
+    Returns
+    -------
+    gp.GeoDataFrame
+    """
+    if checkpoint_dir is None:
+        return compute()
+
+    path = checkpoint_path(checkpoint_dir, base_filename, stage, params)
+    if path.exists():
+        try:
+            polygons = gp.read_parquet(path)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Ignoring unreadable checkpoint {path}: {e}')
+        else:
+            logger.info(f'Resuming stage {stage} from {path}')
+            return polygons
+
+    polygons = compute()
+    # Write then rename so that a killed run never leaves a partial
+    # checkpoint behind.
+    tmp_path = path.with_name(path.name + '.tmp')
+    polygons.to_parquet(tmp_path)
+    os.replace(tmp_path, path)
+    logger.info(f'Wrote checkpoint for stage {stage} to {path}')
+    return polygons
+
+
+def tile_key(window: (slice, slice)) -> str:
+    """Name a tile by its top left pixel."""
+    rows, cols = window
+    return f'{rows.start},{cols.start}'
+
+
+def fingerprint_tile(wet_frequency: np.ndarray, count_clear: np.ndarray,
+                     thresholds: [float],
+                     min_valid_observations: int) -> str:
+    """Fingerprint the thresholded masks of one summary tile.
+
+    The fingerprint only changes if a pixel crosses one of the wet
+    thresholds or the valid observation threshold, so a new summary where
+    the wet frequencies only move a little doesn't change it.
+    """
+    digest = hashlib.sha1(repr(wet_frequency.shape).encode('utf-8'))
+    with np.errstate(invalid='ignore'):
+        masks = [count_clear >= min_valid_observations]
+    masks += [threshold_wofs(wet_frequency, None, t, min_valid_observations)
+              for t in thresholds]
+    for mask in masks:
+        digest.update(np.packbits(mask).tobytes())
+    return digest.hexdigest()
+
+
+def dirty_windows(old_fingerprints: dict, new_fingerprints: dict,
+                  windows: [(slice, slice)]) -> [(slice, slice)]:
+    """Find tiles that changed, and their neighbours.
+
+    Neighbours are included so that polygons on the seams of changed tiles
+    are regenerated consistently.
+    """
+    changed = [w for w in windows
+               if old_fingerprints.get(tile_key(w))
+               != new_fingerprints[tile_key(w)]]
+
+    def touches(a, b):
+        return all(x.start <= y.stop and y.start <= x.stop
+                   for x, y in zip(a, b))
+
+    return [w for w in windows if any(touches(w, c) for c in changed)]
+
+
+def windows_region(windows: [(slice, slice)], transform: Affine,
+                   crs: str = 'EPSG:3577') -> gp.GeoSeries:
+    """The area covered by some windows, as a one-element GeoSeries."""
+    boxes = gp.GeoSeries([
+        shapely_geom.box(cols.start, rows.start, cols.stop, rows.stop)
+        for rows, cols in windows])
+    matrix = [transform.a, transform.b, transform.d, transform.e,
+              transform.c, transform.f]
+    region = boxes.affine_transform(matrix).unary_union
+    return gp.GeoSeries([region], crs=crs)
+
+
+def read_manifest(path: Path) -> dict or None:
+    """Read a tile fingerprint manifest, or None if there isn't a valid one.
+    """
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def write_manifest(path: Path, fingerprints: dict, params: dict):
+    """Write a tile fingerprint manifest."""
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'params': params,
+        'tiles': fingerprints,
+    }
+    tmp_path = Path(str(path) + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, sort_keys=True, default=str)
+    os.replace(tmp_path, path)
+
+
+def splice_polygons(existing: gp.GeoDataFrame,
+                    recomputed: gp.GeoDataFrame,
+                    region: gp.GeoSeries,
+                    precision: int = 9) -> gp.GeoDataFrame:
+    """Replace the waterbodies in a region with recomputed ones.
+
+    Existing polygons intersecting the region are replaced by recomputed
+    polygons intersecting the region. Where a recomputed polygon has the
+    same geometry as an existing one, it keeps its UID and WB_ID, so its
+    time series is still valid. New polygons get a geohash UID and WB_IDs
+    counting up from the largest existing WB_ID.
+
+    Arguments
+    ---------
+    existing : gp.GeoDataFrame
+        Waterbodies with UID and WB_ID columns.
+
+    recomputed : gp.GeoDataFrame
+        Freshly generated polygons covering at least the region.
+
+    region : gp.GeoSeries
+        One-element GeoSeries of the area that was recomputed.
+
+    precision : int
+        Geohash precision for new UIDs.
+
+    Returns
+    -------
+    gp.GeoDataFrame
+        Sorted by UID.
+    """
+    recomputed = recomputed.to_crs(existing.crs)
+    region = region.to_crs(existing.crs)
+    _, replaced_idx = query_pairs(existing.geometry, region)
+    _, new_idx = query_pairs(recomputed.geometry, region)
+    replaced = existing.iloc[np.unique(replaced_idx)]
+    kept = existing.drop(index=replaced.index)
+    new = recomputed.iloc[np.unique(new_idx)].reset_index(drop=True)
+    new = new.drop(columns=['UID', 'WB_ID'], errors='ignore')
+
+    # Keep IDs for polygons that didn't change.
+    uids = np.full(len(new), '', dtype=object)
+    wb_ids = np.full(len(new), -1)
+    new_i, old_j = query_pairs(replaced.geometry, new.geometry)
+    if len(new_i):
+        same = gp.GeoSeries(new.geometry.values[new_i]).geom_equals(
+            gp.GeoSeries(replaced.geometry.values[old_j])).values
+        uids[new_i[same]] = replaced.UID.values[old_j[same]]
+        wb_ids[new_i[same]] = replaced.WB_ID.values[old_j[same]]
+
+    changed = wb_ids < 0
+    logger.info(f'Replacing {len(replaced)} polygons with {len(new)} '
+                f'({changed.sum()} changed)')
+    if changed.any():
+        uids[changed] = centroid_geohashes(new[changed], precision=precision)
+        next_wb_id = int(existing.WB_ID.max()) + 1 if len(existing) else 0
+        # Number new polygons in geohash order, like assign_uids.
+        order = np.argsort(uids[changed].astype(str), kind='stable')
+        new_wb_ids = np.empty(changed.sum(), dtype=int)
+        new_wb_ids[order] = np.arange(next_wb_id, next_wb_id + len(order))
+        wb_ids[changed] = new_wb_ids
+    new['UID'] = uids.astype(str)
+    new['WB_ID'] = wb_ids
+
+    polygons = pd.concat([kept, new], ignore_index=True)
+    check_unique(polygons.UID)
+    return polygons.sort_values(by=['UID']).reset_index(drop=True)
@@ -1,7 +1,9 @@
+from collections import namedtuple
 import csv
 from datetime import datetime, timezone
 from dateutil import relativedelta, parser
 import os
+from time import perf_counter
 import fsspec
 from datacube import Datacube
 from datacube.utils import geometry
@@ -9,10 +11,33 @@ import numpy
 import rasterio.features
 from shapely import geometry as shapely_geom
 
+from dea_waterbodies.drill import LRUCache, count_wofl_pixels
+from dea_waterbodies.footprints import filter_solar_days
+from dea_waterbodies.latest_state import state_writer
+from dea_waterbodies.metrics import WaterbodyMetrics
+from dea_waterbodies.retries import call_with_retries, drill_with_retries
+from dea_waterbodies.wofl_cache import cache_key, wofl_cache
+
 import logging
 
 logger = logging.getLogger(__name__)
 
+# The time series of one time window of a waterbody, before discarding
+# timesteps with too many invalid pixels.
+WindowResult = namedtuple(
+    'WindowResult',
+    'dates wet_percentages wet_counts invalid_counts invalid_percentages '
+    'pixel_count')
+
+# A time series to write: where, the percentage of invalid pixels at which
+# timesteps are discarded, and whether to include the invalid pixel count.
+Output = namedtuple('Output',
+                    'output_dir max_invalid_percent include_uncertainty')
+
+# Windows drilled for waterbodies that haven't been written yet, so that if
+# a waterbody fails partway through, retrying it doesn't drill them again.
+_COMPLETED_WINDOWS = LRUCache(64)
+
 
 def get_last_date(fpath, max_days=None):
     try:
@@ -31,8 +56,9 @@ def get_last_date(fpath, max_days=None):
             str_start_date = start_date.strftime('%Y-%m-%d')
             logger.debug(f'Start date is {str_start_date}')
             return str_start_date
-    except:  # noqa: E722
-        logger.debug(f'Cannot find last date for {fpath}')
+    except (FileNotFoundError, IndexError, ValueError) as e:
+        # No file, an empty file, or no date on the last line.
+        logger.debug(f'Cannot find last date for {fpath}: {e!r}')
         return None
 
 
@@ -59,8 +85,259 @@ def get_dataset_maturity(wofls):
     return None
 
 
+def get_outputs(config_dict):
+    """Get the time series to write for each waterbody.
+
+    All of the time series are made from the same loaded WOfLs.
+
+    Inputs:
+    config_dict - config settings including output_dir, include_uncertainty,
+                  and optionally extra_outputs, a list of (output_dir,
+                  max_invalid_percent) pairs
+
+    Outputs:
+    A list of Outputs, starting with the one in output_dir. Thresholds of
+        100 include the invalid pixel count, like include_uncertainty.
+    """
+    include_uncertainty = bool(config_dict['include_uncertainty'])
+    outputs = [Output(config_dict['output_dir'],
+                      100 if include_uncertainty else 10,
+                      include_uncertainty)]
+    for output_dir, threshold in config_dict.get('extra_outputs') or []:
+        threshold = float(threshold)
+        outputs.append(Output(output_dir, threshold, threshold >= 100))
+    return outputs
+
+
+def timeseries_rows(result, output, start_date=None):
+    """Get the CSV rows of an output from a waterbody's WindowResult.
+
+    Timesteps with too many invalid pixels get empty values.
+
+    Inputs:
+    result - WindowResult of all the waterbody's time windows
+    output - Output to make rows for
+    start_date - optional date string; earlier timesteps are left out
+
+    Outputs:
+    A list of rows.
+    """
+    rows = []
+    for date, pc, ct, invalid_ct, invalid_pc in zip(
+            result.dates, result.wet_percentages, result.wet_counts,
+            result.invalid_counts, result.invalid_percentages):
+        if start_date and date < start_date:
+            continue
+        row = [pc, ct, invalid_ct]
+        if invalid_pc >= output.max_invalid_percent:
+            row = ['', '', '']
+        if not output.include_uncertainty:
+            row = row[:2]
+        rows.append([date] + row)
+    return rows
+
+
+def get_time_periods(first_geometry, config_dict, fpath, start_date=None):
+    """Get the time windows to load a waterbody's WOfLs in.
+
+    Large waterbodies are loaded five years at a time when making their
+    whole time series, to limit memory use.
+
+    Inputs:
+    first_geometry - GeoJSON-like polygon
+    config_dict - config settings including time_span, start_dt, end_date
+    fpath - path to the waterbody's csv, for time_span APPEND
+    start_date - for time_span APPEND, the date to start from, if already
+                 known from the csv
+
+    Outputs:
+    A list of (start, end) tuples, or None if time_span is APPEND and there
+        is no csv to append to.
+    """
+    time_span = config_dict['time_span']
+    current_year = datetime.now().year
+    if time_span == 'ALL':
+        if shapely_geom.shape(first_geometry).envelope.area > 2000000:
+            years = range(1986, current_year + 1, 5)
+            return [(str(year), str(year + 4)) for year in years]
+        return [('1986', str(current_year))]
+    elif time_span == 'APPEND':
+        start_date = start_date or get_last_date(fpath)
+        if start_date is None:
+            return None
+        return [(start_date, str(current_year))]
+    elif time_span == 'CUSTOM':
+        return [(config_dict['start_dt'], config_dict['end_date'])]
+    raise ValueError(f'Unknown time span: {time_span}')
+
+
+def drill_window(dc, geom, time, config_dict, metrics, str_poly_name,
+                 search_cache=None):
+    """
+    Load the WOfLs for one time window of a waterbody and work out how full
+    it is at each time step.
+
+    Inputs:
+    dc - Datacube to load from
+    geom - datacube Geometry of the waterbody
+    time - (start, end) time window
+    config_dict - config settings including crs, wofls, and the outputs'
+                  validity thresholds
+    metrics - WaterbodyMetrics to record stage timings and sizes in
+    str_poly_name - waterbody ID, for logging
+    search_cache - optional SearchCache to find datasets in instead of the
+                   datacube index
+
+    Outputs:
+    A WindowResult, or None if there is no data in the window. Timesteps
+        aren't discarded, as each output has its own threshold.
+    """
+    crs = config_dict['crs']
+    wofls = config_dict['wofls']
+    # Some query parameters will be different for different WOfL products.
+    output_res = get_resolution(wofls)
+    dataset_maturity = get_dataset_maturity(wofls)
+    # Timesteps that no output will keep needn't be loaded.
+    unknown_percent_threshold = max(
+        output.max_invalid_percent for output in get_outputs(config_dict))
+
+    wb_capacity_pc = []
+    wb_capacity_ct = []
+    wb_invalid_ct = []
+    dry_observed = []
+    invalid_observations = []
+
+    # Set up the query, and load in all of the WOFS layers
+    query = {'geopolygon': geom, 'time': time,
+             'output_crs': crs, 'resolution': output_res,
+             'resampling': 'nearest'}
+    if dataset_maturity:
+        query['dataset_maturity'] = dataset_maturity
+    logger.debug('Query: {}'.format({k: v for k, v in query.items()
+                                     if k != 'geopolygon'}))
+    # Search separately from loading so each can be timed.
+    with metrics.stage('search'):
+        datasets = None
+        if search_cache is not None:
+            datasets = search_cache.search(time, geom)
+        if datasets is None:
+            search = {k: v for k, v in query.items()
+                      if k in ('geopolygon', 'time', 'dataset_maturity')}
+            datasets = dc.find_datasets(product=wofls, **search)
+        # Don't load days that would be discarded for too many invalid
+        # pixels. They still get empty rows in the time series.
+        found_ids = [dataset.id for dataset in datasets]
+        datasets, kept_times, skipped_times = filter_solar_days(
+            datasets, geom, unknown_percent_threshold, output_res)
+    metrics.datasets += len(found_ids)
+    metrics.skipped_datasets += len(found_ids) - len(datasets)
+    metrics.skipped_timesteps += len(skipped_times)
+    skipped_dates = [f'{date}Z' for date in numpy.datetime_as_string(
+        skipped_times, unit='s')]
+    with metrics.stage('load'):
+        query.pop('dataset_maturity', None)
+        # Reruns can read the pixels from a local cache. Keys include all
+        # datasets found, not just those loaded, so that a run with a
+        # lower threshold can reuse the window.
+        cache = wofl = None
+        if config_dict.get('wofl_cache') and datasets:
+            cache = wofl_cache(config_dict['wofl_cache'],
+                               config_dict['wofl_cache_bytes'])
+            key = cache_key(wofls, geometry.GeoBox.from_geopolygon(
+                geom, resolution=output_res, crs=crs), time, found_ids)
+            wofl = cache.get(key, kept_times)
+        if wofl is not None:
+            metrics.cache_hits += 1
+        else:
+            wofl = dc.load(product=wofls, datasets=datasets,
+                           group_by='solar_day', fuse_func=wofls_fuser,
+                           **query)
+            if cache is not None and len(wofl.attrs):
+                cache.put(key, wofl)
+    metrics.add_load(wofl)
+
+    if len(wofl.attrs) == 0:
+        if skipped_dates:
+            blanks = [''] * len(skipped_dates)
+            return WindowResult(skipped_dates, blanks, blanks, blanks,
+                                [100.0] * len(skipped_dates), None)
+        logger.debug(
+            f'There is no new data for {str_poly_name} in {time}')
+        return None
+    with metrics.stage('mask'):
+        # Make a mask based on the polygon (to remove extra data
+        # outside of the polygon)
+        mask = rasterio.features.geometry_mask(
+            [geom.to_crs(wofl.geobox.crs) for geoms in [geom]],
+            out_shape=wofl.geobox.shape,
+            transform=wofl.geobox.affine,
+            all_touched=False,
+            invert=True)
+        # mask the data to the shape of the polygon
+        # the geometry width and height must both be larger than one
+        # pixel to mask.
+        if not (geom.boundingbox.width > 25.3 and
+                geom.boundingbox.height > 25.3):
+            mask = None
+
+    reduce_start = perf_counter()
+    # Find all the wet/dry pixels at every time step at once, and the
+    # number of masked observations.
+    wet_counts, dry_counts, masked_all = count_wofl_pixels(
+        wofl.water.values, mask)
+    # Work out how full the waterbody is at every time step
+    for wet_pixels, dry_pixels in zip(wet_counts.tolist(),
+                                      dry_counts.tolist()):
+        # Turn our counts into percents
+        try:
+            water_percent = round((wet_pixels / masked_all * 100), 1)
+            dry_percent = round((dry_pixels / masked_all * 100), 1)
+            missing_pixels = masked_all - (wet_pixels + dry_pixels)
+            unknown_percent = missing_pixels / masked_all * 100
+
+        except ZeroDivisionError:
+            water_percent = 0.0
+            dry_percent = 0.0
+            unknown_percent = 100.0
+            missing_pixels = masked_all
+            logger.debug(f'{str_poly_name} has divide by zero error')
+
+        # Append the percentages to a list for each timestep. Timesteps
+        # with too many invalid pixels are filtered out when writing, as
+        # each output has its own threshold: < 90% valid observations by
+        # default, or 100% invalid pixels if you set 'UNCERTAINTY = True'
+        # in your config file.
+        wb_capacity_pc.append(water_percent)
+        invalid_observations.append(unknown_percent)
+        wb_invalid_ct.append(missing_pixels)
+        dry_observed.append(dry_percent)
+        wb_capacity_ct.append(wet_pixels)
+    metrics.add_seconds('reduce', perf_counter() - reduce_start)
+
+    valid_obs = wofl.time.dropna(dim='time')
+    valid_obs = valid_obs.to_dataframe()
+    if 'spatial_ref' in valid_obs.columns:
+        valid_obs = valid_obs.drop(columns=['spatial_ref'])
+    date_list = valid_obs.to_csv(None, header=False, index=False,
+                                 date_format="%Y-%m-%dT%H:%M:%SZ"
+                                 ).split('\n')
+    date_list.pop()
+    if skipped_dates:
+        rows = sorted(zip(
+            date_list + skipped_dates,
+            wb_capacity_pc + [''] * len(skipped_dates),
+            wb_capacity_ct + [''] * len(skipped_dates),
+            wb_invalid_ct + [''] * len(skipped_dates),
+            invalid_observations + [100.0] * len(skipped_dates)))
+        (date_list, wb_capacity_pc, wb_capacity_ct, wb_invalid_ct,
+         invalid_observations) = map(list, zip(*rows))
+    return WindowResult(date_list, wb_capacity_pc, wb_capacity_ct,
+                        wb_invalid_ct, invalid_observations, masked_all)
+
+
 # Define a function that does all of the work
-def generate_wb_timeseries(shapes, config_dict):
+def generate_wb_timeseries(shapes, config_dict, metrics=None,
+                           search_cache=None):
     """
     This is where the code processing is actually done. This code takes in a
     polygon, and the and a config dict which contains: shapefile's crs, output
@@ -77,27 +354,33 @@ def generate_wb_timeseries(shapes, config_dict):
     shapes - polygon to be interrogated
     config_dict - many config settings including crs, id_field, time_span,
                   shapefile
+    metrics - optional WaterbodyMetrics to record stage timings and sizes in
+    search_cache - optional SearchCache of the wofls product, shared between
+                   waterbodies, to find datasets in
 
     Outputs:
     Nothing is returned from the function, but a csv file is written out to
-        disk
+        disk. If config_dict has a latest_state directory, the latest valid
+        observation is also recorded there.
     """
-    output_dir = config_dict['output_dir']
+    if metrics is None:
+        metrics = WaterbodyMetrics()
+    try:
+        result = _generate_wb_timeseries(shapes, config_dict, metrics,
+                                         search_cache)
+    except Exception:
+        metrics.finish('error')
+        raise
+    metrics.finish()
+    return result
+
+
+def _generate_wb_timeseries(shapes, config_dict, metrics, search_cache):
     crs = config_dict['crs']
     id_field = config_dict['id_field']
     time_span = config_dict['time_span']
-    include_uncertainty = config_dict['include_uncertainty']
-    wofls = config_dict['wofls']
-    assert wofls
-
-    # Some query parameters will be different for different WOfL products.
-    output_res = get_resolution(wofls)
-    dataset_maturity = get_dataset_maturity(wofls)
-
-    if include_uncertainty:
-        unknown_percent_threshold = 100
-    else:
-        unknown_percent_threshold = 10
+    outputs = get_outputs(config_dict)
+    assert config_dict['wofls']
 
     with Datacube(app='Polygon drill') as dc:
         first_geometry = shapes['geometry']
@@ -105,155 +388,84 @@ def generate_wb_timeseries(shapes, config_dict):
         str_poly_name = shapes['properties'][id_field]
 
         try:
-            fpath = os.path.join(
-                output_dir, f'{str_poly_name[0:4]}/{str_poly_name}.csv')
+            fpaths = [os.path.join(
+                output.output_dir,
+                f'{str_poly_name[0:4]}/{str_poly_name}.csv')
+                for output in outputs]
         except TypeError:
             str_poly_name = str(int(str_poly_name)).zfill(6)
-            fpath = os.path.join(
-                output_dir, f'{str_poly_name[0:4]}/{str_poly_name}.csv')
+            fpaths = [os.path.join(
+                output.output_dir,
+                f'{str_poly_name[0:4]}/{str_poly_name}.csv')
+                for output in outputs]
+        metrics.uid = str_poly_name
         geom = geometry.Geometry(first_geometry, crs=crs)
-        current_year = datetime.now().year
 
-        if time_span == 'ALL':
-            if shapely_geom.shape(first_geometry).envelope.area > 2000000:
-                years = range(1986, current_year + 1, 5)
-                time_periods = [(str(year), str(year + 4)) for year in years]
-            else:
-                time_periods = [('1986', str(current_year))]
-        elif time_span == 'APPEND':
-            start_date = get_last_date(fpath)
-            if start_date is None:
+        # When appending, each output starts after its own last date, and
+        # outputs without a csv are left alone.
+        start_dates = [None] * len(outputs)
+        if time_span == 'APPEND':
+            start_dates = [get_last_date(fpath) for fpath in fpaths]
+            if start_dates[0] is None:
                 logger.debug(f'There is no csv for {str_poly_name}')
+                metrics.status = 'missing'
                 return 1
-            time_periods = [(start_date, str(current_year))]
-        elif time_span == 'CUSTOM':
-            time_periods = [(config_dict['start_dt'], config_dict['end_date'])]
+            for output, start_date in zip(outputs, start_dates):
+                if start_date is None:
+                    logger.debug(f'There is no csv for {str_poly_name} in '
+                                 f'{output.output_dir}')
+        time_periods = get_time_periods(
+            first_geometry, config_dict, fpaths[0],
+            start_date=min(filter(None, start_dates), default=None))
 
+        date_list = []
         valid_capacity_pc = []
         valid_capacity_ct = []
         invalid_capacity_ct = []
-        date_list = []
+        invalid_capacity_pc = []
+        masked_all = 0
+        # Windows that are drilled are kept until the waterbody is written.
+        window_keys = []
+
+        def drill(time):
+            key = (str_poly_name, config_dict['wofls'], str(crs),
+                   max(output.max_invalid_percent for output in outputs),
+                   tuple(time))
+            window_keys.append(key)
+            result = _COMPLETED_WINDOWS.get(key, _COMPLETED_WINDOWS)
+            if result is not _COMPLETED_WINDOWS:
+                logger.debug(f'Reusing {str_poly_name} in {time}')
+                return result
+            result = drill_window(dc, geom, time, config_dict, metrics,
+                                  str_poly_name, search_cache)
+            _COMPLETED_WINDOWS.put(key, result)
+            return result
+
+        def on_retry(error):
+            metrics.retries += 1
+
         for time in time_periods:
-            wb_capacity_pc = []
-            wb_capacity_ct = []
-            wb_invalid_ct = []
-            dry_observed = []
-            invalid_observations = []
-
-            # Set up the query, and load in all of the WOFS layers
-            query = {'geopolygon': geom, 'time': time,
-                     'output_crs': crs, 'resolution': output_res,
-                     'resampling': 'nearest'}
-            if dataset_maturity:
-                query['dataset_maturity'] = dataset_maturity
-            logger.debug('Query: {}'.format({k: v for k, v in query.items()
-                                             if k != 'geopolygon'}))
-            wofl = dc.load(product=wofls, group_by='solar_day',
-                           fuse_func=wofls_fuser, **query)
-
-            if len(wofl.attrs) == 0:
-                logger.debug(
-                    f'There is no new data for {str_poly_name} in {time}')
-                # TODO(MatthewJA): Confirm (with Ness?) that changing this
-                # return to a continue doesn't break things.
-                continue
-            # Make a mask based on the polygon (to remove extra data
-            # outside of the polygon)
-            mask = rasterio.features.geometry_mask(
-                [geom.to_crs(wofl.geobox.crs) for geoms in [geom]],
-                out_shape=wofl.geobox.shape,
-                transform=wofl.geobox.affine,
-                all_touched=False,
-                invert=True)
-            # mask the data to the shape of the polygon
-            # the geometry width and height must both be larger than one pixel
-            # to mask.
-            if (geom.boundingbox.width > 25.3 and
-                    geom.boundingbox.height > 25.3):
-                wofl_masked = wofl.water.where(mask)
-            else:
-                wofl_masked = wofl.water
-
-            # Work out how full the waterbody is at every time step
-            for ix, times in enumerate(wofl.time):
-
-                # Grab the data for our timestep
-                all_the_bit_flags = wofl_masked.isel(time=ix)
-
-                # Find all the wet/dry pixels for that timestep
-                lsa_wet = all_the_bit_flags.where(
-                    all_the_bit_flags == 136).count().item()
-                lsa_dry = all_the_bit_flags.where(
-                    all_the_bit_flags == 8).count().item()
-                sea_wet = all_the_bit_flags.where(
-                    all_the_bit_flags == 132).count().item()
-                sea_dry = all_the_bit_flags.where(
-                    all_the_bit_flags == 4).count().item()
-                sea_lsa_wet = all_the_bit_flags.where(
-                    all_the_bit_flags == 140).count().item()
-                sea_lsa_dry = all_the_bit_flags.where(
-                    all_the_bit_flags == 12).count().item()
-                wet_pixels = (all_the_bit_flags.where(
-                    all_the_bit_flags == 128).count().item() +
-                    lsa_wet + sea_wet + sea_lsa_wet)
-                dry_pixels = (all_the_bit_flags.where(
-                    all_the_bit_flags == 0).count().item()
-                    + lsa_dry + sea_dry + sea_lsa_dry)
-
-                # Count the number of masked observations
-                masked_all = all_the_bit_flags.count().item()
-                # Turn our counts into percents
-                try:
-                    water_percent = round((wet_pixels / masked_all * 100), 1)
-                    dry_percent = round((dry_pixels / masked_all * 100), 1)
-                    missing_pixels = masked_all - (wet_pixels + dry_pixels)
-                    unknown_percent = missing_pixels / masked_all * 100
-
-                except ZeroDivisionError:
-                    water_percent = 0.0
-                    dry_percent = 0.0
-                    unknown_percent = 100.0
-                    missing_pixels = masked_all
-                    logger.debug(f'{str_poly_name} has divide by zero error')
-
-                # Append the percentages to a list for each timestep
-                # Filter out timesteps with < 90% valid observations. Add
-                # empty values for timesteps with < 90% valid. if you set
-                # 'UNCERTAINTY = True' in your config file then you will
-                # only filter out timesteps with 100% invalid pixels.
-                # You will also record the number invalid pixels per timestep.
-
-                if unknown_percent < unknown_percent_threshold:
-                    wb_capacity_pc.append(water_percent)
-                    invalid_observations.append(unknown_percent)
-                    wb_invalid_ct.append(missing_pixels)
-                    dry_observed.append(dry_percent)
-                    wb_capacity_ct.append(wet_pixels)
-                else:
-                    wb_capacity_pc.append('')
-                    invalid_observations.append('')
-                    wb_invalid_ct.append('')
-                    dry_observed.append('')
-                    wb_capacity_ct.append('')
-
-            valid_obs = wofl.time.dropna(dim='time')
-            valid_obs = valid_obs.to_dataframe()
-            if 'spatial_ref' in valid_obs.columns:
-                valid_obs = valid_obs.drop(columns=['spatial_ref'])
-            valid_capacity_pc += wb_capacity_pc
-            valid_capacity_ct += wb_capacity_ct
-            invalid_capacity_ct += wb_invalid_ct
-            date_list += valid_obs.to_csv(None, header=False, index=False,
-                                          date_format="%Y-%m-%dT%H:%M:%SZ"
-                                          ).split('\n')
-            date_list.pop()
-
-        if date_list:
-            if include_uncertainty:
-                rows = zip(date_list, valid_capacity_pc, valid_capacity_ct,
-                           invalid_capacity_ct)
-            else:
-                rows = zip(date_list, valid_capacity_pc, valid_capacity_ct)
+            for result in drill_with_retries(drill, time, str_poly_name,
+                                             on_retry=on_retry):
+                date_list += result.dates
+                valid_capacity_pc += result.wet_percentages
+                valid_capacity_ct += result.wet_counts
+                invalid_capacity_ct += result.invalid_counts
+                invalid_capacity_pc += result.invalid_percentages
+                if result.pixel_count is not None:
+                    masked_all = result.pixel_count
+
+        if not date_list:
+            logger.info(f'{str_poly_name} has no new good valid data')
+            metrics.status = 'no_data'
+            _forget_windows(window_keys)
+            return True
+
+        series = WindowResult(date_list, valid_capacity_pc, valid_capacity_ct,
+                              invalid_capacity_ct, invalid_capacity_pc,
+                              masked_all)
+
+        def write(output, fpath, rows):
             os.makedirs(os.path.dirname
                         (fpath), exist_ok=True)
             if time_span == 'APPEND':
@@ -266,13 +478,41 @@ def generate_wb_timeseries(shapes, config_dict):
                 of = fsspec.open(fpath, 'w')
                 with of as f:
                     writer = csv.writer(f)
-                    headings = ['Observation Date', 'Wet pixel percentage',
-                                'Wet pixel count (n = {0})'.format(masked_all)]
-                    if include_uncertainty:
+                    headings = [
+                        'Observation Date', 'Wet pixel percentage',
+                        'Wet pixel count (n = {0})'.format(masked_all)]
+                    if output.include_uncertainty:
                         headings.append('Invalid pixel count')
                     writer.writerow(headings)
                     for row in rows:
                         writer.writerow(row)
-        else:
-            logger.info(f'{str_poly_name} has no new good valid data')
+
+        with metrics.stage('write'):
+            for output, fpath, start_date in zip(outputs, fpaths,
+                                                 start_dates):
+                if time_span == 'APPEND' and start_date is None:
+                    continue
+                rows = timeseries_rows(series, output, start_date)
+                call_with_retries(
+                    lambda: write(output, fpath, rows), f'writing {fpath}',
+                    on_retry=on_retry)
+
+            # The latest state is of the first output.
+            latest_state = config_dict.get('latest_state')
+            valid = [i for i, pc in enumerate(invalid_capacity_pc)
+                     if pc < outputs[0].max_invalid_percent]
+            if latest_state and valid:
+                state_writer(latest_state).update(
+                    str_poly_name, date_list[valid[-1]],
+                    valid_capacity_pc[valid[-1]],
+                    valid_capacity_ct[valid[-1]], masked_all)
+        # Written, so the windows won't be needed again. If writing failed,
+        # they are kept for the retry.
+        _forget_windows(window_keys)
+        metrics.status = 'ok'
         return True
+
+
+def _forget_windows(keys):
+    for key in keys:
+        _COMPLETED_WINDOWS.pop(key)
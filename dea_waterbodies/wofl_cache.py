@@ -0,0 +1,367 @@
+"""Cache loaded WOfLs on local disk for reruns.
+
+Rerunning waterbodies-ts, say after a bug fix or with --no-mask-obs
+instead of --mask-obs, loads exactly the same WOfL pixels as the last run.
+A WoflCache keeps each loaded time window as a NumPy array on local disk,
+keyed by product, geobox, time window and datasets, so that reruns read
+memory-mapped arrays instead of S3 or Lustre.
+
+Each entry is a JSON file of metadata pointing to a .npy file of pixels.
+Writers write a new .npy file and then replace the JSON file, so readers
+see either the old or the new entry and never half of one, and any number
+of workers on a node can share a cache directory. When the cache grows
+past its size limit, the least recently used entries are deleted, holding
+a lock file so that workers don't evict at the same time. Each worker
+keeps a running total of the cache's size and only checks the files on
+disk every SIZE_CHECK_EVERY writes, so writes don't wait on the lock.
+
+Geoscience Australia
+2021
+"""
+
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Default size limit of a cache, in bytes.
+DEFAULT_MAX_BYTES = 50 * 2 ** 30
+
+LOCK_NAME = '.lock'
+
+# Writes between checks of a cache's size on disk, which other workers
+# add to as well.
+SIZE_CHECK_EVERY = 100
+
+# Seconds between sweeps for files left by workers that died mid-write.
+SWEEP_SECONDS = 3600
+
+# One cache per directory per process.
+_CACHES = {}
+
+
+def cache_key(product: str, geobox, time_range, dataset_ids) -> str:
+    """Key of a time window loaded for a waterbody.
+
+    Arguments
+    ---------
+    product : str
+        WOfL product name.
+
+    geobox : datacube.utils.geometry.GeoBox
+        Pixel grid loaded to.
+
+    time_range : (str, str)
+        Time window.
+
+    dataset_ids : [uuid]
+        All datasets found in the time window, including any that weren't
+        loaded.
+    """
+    parts = [product, str(geobox.crs), tuple(geobox.shape),
+             tuple(geobox.affine)[:6], tuple(str(t) for t in time_range),
+             sorted(str(id_) for id_ in dataset_ids)]
+    return hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+
+
+class WoflCache:
+    """Loaded WOfLs in a local directory, with LRU eviction.
+
+    Arguments
+    ---------
+    path : str
+        Local directory to keep the cache in.
+
+    max_bytes : int
+        Most bytes of pixels to keep.
+    """
+
+    def __init__(self, path: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # Running total of the cache's size, and when it was last swept.
+        self._size = None
+        self._puts = 0
+        self._swept = None
+        os.makedirs(self.path, exist_ok=True)
+
+    def __repr__(self):
+        return f'WoflCache({self.path!r}, {self.max_bytes})'
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.path, f'{key}.json')
+
+    def get_array(self, key: str, times=None):
+        """Get the pixels of a cached time window.
+
+        Arguments
+        ---------
+        key : str
+            From cache_key.
+
+        times : array_like, optional
+            Times needed. The entry is only used if it has all of them, and
+            only they are returned. Default all cached times.
+
+        Returns
+        -------
+        (np.ndarray, dict) or None
+            (time, y, x) pixels, and the entry's metadata with times
+            (datetime64), dims, coords (arrays) and crs. None if the window
+            isn't cached.
+        """
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path) as f:
+                meta = json.load(f)
+            pixels = np.load(os.path.join(self.path, meta['file']),
+                             mmap_mode='r')
+        except (FileNotFoundError, ValueError) as e:
+            # Not cached, or evicted while we were reading it.
+            if not isinstance(e, FileNotFoundError):
+                logger.warning(f'Ignoring broken cache entry {key}: {e!r}')
+            self.misses += 1
+            return None
+        cached_times = np.array(meta['times'], dtype='datetime64[ns]')
+        if times is None:
+            index = np.arange(len(cached_times))
+        else:
+            times = np.asarray(times, dtype='datetime64[ns]')
+            if not np.isin(times, cached_times).all():
+                self.misses += 1
+                return None
+            index = np.flatnonzero(np.isin(cached_times, times))
+        # Touching the entry marks it as recently used.
+        try:
+            os.utime(entry_path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        meta['times'] = cached_times[index]
+        meta['coords'] = {name: np.array(values)
+                          for name, values in meta['coords'].items()}
+        return np.array(pixels[index]), meta
+
+    def put_array(self, key: str, pixels: np.ndarray, times, dims: [str],
+                  coords: dict, crs: str, affine=None):
+        """Cache the pixels of a time window.
+
+        Arguments
+        ---------
+        key : str
+            From cache_key.
+
+        pixels : np.ndarray
+            (time, y, x) pixels.
+
+        times : array_like
+            Time of each pixel array.
+
+        dims : [str]
+            Names of the dimensions of pixels.
+
+        coords : dict
+            Spatial coordinates of pixels, by dimension name.
+
+        crs : str
+            CRS of coords.
+
+        affine : affine.Affine, optional
+            Transform of the pixel grid, to rebuild its geobox from.
+        """
+        name = f'{key}-{uuid.uuid4().hex}.npy'
+        tmp_name = f'{name}.tmp'
+        with open(os.path.join(self.path, tmp_name), 'wb') as f:
+            np.save(f, np.ascontiguousarray(pixels))
+        os.replace(os.path.join(self.path, tmp_name),
+                   os.path.join(self.path, name))
+        meta = {
+            'file': name,
+            'nbytes': int(pixels.nbytes),
+            'times': [str(t) for t in np.asarray(
+                times, dtype='datetime64[ns]')],
+            'dims': list(dims),
+            'coords': {k: np.asarray(v).tolist() for k, v in coords.items()},
+            'crs': str(crs),
+            'affine': None if affine is None else list(affine)[:6],
+        }
+        entry_path = self._entry_path(key)
+        old_file = None
+        try:
+            with open(entry_path) as f:
+                old_file = json.load(f)['file']
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        tmp_path = f'{entry_path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, entry_path)
+        # Readers that already have the old file open can keep reading it.
+        if old_file is not None and old_file != name:
+            _remove(os.path.join(self.path, old_file))
+        self._check_size(meta['nbytes'])
+
+    def _check_size(self, nbytes: int):
+        """Evict if the cache may have grown past max_bytes."""
+        self._puts += 1
+        if self._size is None or self._puts % SIZE_CHECK_EVERY == 0:
+            self._size = self._disk_size()
+        else:
+            self._size += nbytes
+        if self._size > self.max_bytes:
+            self.evict(sweep=self._swept is None
+                       or time.time() - self._swept > SWEEP_SECONDS)
+
+    def _disk_size(self) -> int:
+        """Bytes of pixel files, including headers, without locking."""
+        size = 0
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.npy'):
+                try:
+                    size += entry.stat().st_size
+                except FileNotFoundError:
+                    pass
+        return size
+
+    @contextmanager
+    def _lock(self):
+        with open(os.path.join(self.path, LOCK_NAME), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _scan(self) -> [(float, int, str, str)]:
+        """Last use time, size, key and pixel file of every entry."""
+        entries = []
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                with open(entry.path) as f:
+                    meta = json.load(f)
+                used = entry.stat().st_mtime
+                entries.append((used, meta['nbytes'],
+                                entry.name[:-len('.json')], meta['file']))
+            except (FileNotFoundError, ValueError, KeyError):
+                continue
+        return sorted(entries)
+
+    def entries(self) -> [(float, int, str)]:
+        """Last use time, size and key of every entry, oldest first."""
+        return [(used, nbytes, key)
+                for used, nbytes, key, _ in self._scan()]
+
+    def size(self) -> int:
+        """Bytes of pixels in the cache."""
+        return sum(nbytes for _, nbytes, _ in self.entries())
+
+    def evict(self, sweep: bool = True):
+        """Delete the least recently used entries until under max_bytes.
+
+        Arguments
+        ---------
+        sweep : bool
+            Whether to also delete files left behind by workers that died
+            mid-write.
+        """
+        with self._lock():
+            entries = self._scan()
+            total = sum(nbytes for _, nbytes, _, _ in entries)
+            live = set()
+            for _, nbytes, key, name in entries:
+                if total > self.max_bytes:
+                    self.remove(key)
+                    total -= nbytes
+                else:
+                    live.add(name)
+            self._size = total
+            if sweep:
+                # Only files that haven't been touched for a while, as
+                # other workers may be writing them.
+                for entry in os.scandir(self.path):
+                    if (entry.name.endswith(('.npy', '.tmp'))
+                            and entry.name not in live
+                            and _is_stale(entry)):
+                        _remove(entry.path)
+                self._swept = time.time()
+
+    def remove(self, key: str):
+        """Delete an entry."""
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path) as f:
+                name = json.load(f)['file']
+        except (FileNotFoundError, ValueError, KeyError):
+            name = None
+        _remove(entry_path)
+        if name is not None:
+            _remove(os.path.join(self.path, name))
+
+    def get(self, key: str, times=None):
+        """Get a cached time window as an xarray.Dataset of water.
+
+        Like dc.load, the Dataset has a geobox.
+        """
+        import xarray as xr
+        cached = self.get_array(key, times)
+        if cached is None:
+            return None
+        pixels, meta = cached
+        if meta.get('affine') is not None:
+            from affine import Affine
+            from datacube.utils import geometry
+            height, width = pixels.shape[1:]
+            geobox = geometry.GeoBox(width, height,
+                                     Affine(*meta['affine']), meta['crs'])
+            coords = dict(geobox.xr_coords(with_crs=True))
+        else:
+            coords = dict(meta['coords'])
+        coords['time'] = meta['times']
+        attrs = {'crs': meta['crs']}
+        water = xr.DataArray(pixels, dims=meta['dims'], coords=coords,
+                             attrs=dict(attrs, nodata=1))
+        return xr.Dataset({'water': water}, attrs=attrs)
+
+    def put(self, key: str, wofl):
+        """Cache an xarray.Dataset of water loaded by dc.load."""
+        water = wofl.water
+        spatial_dims = water.dims[1:]
+        self.put_array(key, water.values, water.time.values, water.dims,
+                       {dim: water[dim].values for dim in spatial_dims},
+                       str(wofl.geobox.crs), wofl.geobox.affine)
+
+
+def _is_stale(entry, seconds: float = 3600) -> bool:
+    """Whether a file hasn't been touched for a while."""
+    try:
+        return time.time() - entry.stat().st_mtime > seconds
+    except FileNotFoundError:
+        return False
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def wofl_cache(path: str, max_bytes: int = DEFAULT_MAX_BYTES) -> WoflCache:
+    """Get this process's cache of a directory."""
+    key = (str(path), os.getpid())
+    if key not in _CACHES:
+        _CACHES[key] = WoflCache(path, max_bytes)
+    _CACHES[key].max_bytes = max_bytes
+    return _CACHES[key]
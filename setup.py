@@ -15,13 +15,15 @@ REQUIRES_PYTHON = '>=3.6.0'
 
 # What packages are required for this module to be executed?
 REQUIRED = [
-    'datacube', 'geopandas', 'fsspec', 'numpy', 'python-geohash',
-    'rioxarray', 'rasterstats', 'boto3', 's3fs', 'flake8',
-    'moto',
+    'datacube', 'geopandas', 'fsspec', 'numpy', 'pandas>=1.5',
+    'python-geohash', 'rioxarray', 'rasterstats', 'boto3', 's3fs',
+    'flake8', 'moto',
 ]
 
 # What packages are optional?
 EXTRAS = {
+    # GeoParquet checkpoints for make_polygons.
+    'parquet': ['pyarrow'],
 }
 
 # Where are we?
@@ -49,7 +51,15 @@ setup(
     packages=find_packages(exclude=["tests", "*.tests", "*.tests.*", "tests.*",
                                     "test", "*.test", "*.test.*", "test.*"]),
     entry_points={
-        'console_scripts': ['waterbodies-ts=dea_waterbodies.make_time_series:main'],
+        'console_scripts': [
+            'waterbodies-ts=dea_waterbodies.make_time_series:main',
+            'waterbodies-snapshot=dea_waterbodies.make_snapshot:main',
+            'waterbodies-seasonal=dea_waterbodies.seasonal:main',
+            'waterbodies-exceedance=dea_waterbodies.exceedance:main',
+            'waterbodies-split=dea_waterbodies.split_timeseries:main',
+            'waterbodies-query=dea_waterbodies.query:main',
+            'waterbodies-compact-state=dea_waterbodies.latest_state:main',
+        ],
     },
     install_requires=REQUIRED,
     extras_require=EXTRAS,
@@ -13,7 +13,5 @@
 
 module use /g/data/v10/public/modules/modulefiles/
 module load dea
-module load parallel
 
-parallel --delay 2 --retries 3 --load 100%  --colsep ',' python par_create_wb_seasonal_means_aus.py config_seasonal.ini ::: {1..16},16
-wait;
+waterbodies-seasonal config_seasonal.ini --n-workers 16 -v
@@ -13,7 +13,5 @@
 
 module use /g/data/v10/public/modules/modulefiles/
 module load dea
-module load parallel
 
-parallel --delay 2 --retries 3 --load 100%  --colsep ',' python par_create_water_snapshot_aus.py config_snapshot_nsw.ini ::: {1..16},16
-wait;
+waterbodies-snapshot config_snapshot_nsw.ini --n-workers 16 -v
@@ -0,0 +1,91 @@
+"""Tests for dea_waterbodies.drill.
+
+Geoscience Australia
+2021
+"""
+
+from types import SimpleNamespace
+
+from affine import Affine
+import numpy as np
+import pytest
+from shapely.geometry import box
+
+from dea_waterbodies import drill
+
+
+def test_count_wofl_pixels():
+    water = np.array([
+        [[128, 0], [136, 2]],
+        [[1, 64], [132, 8]],
+    ], dtype='uint8')
+    wet, dry, total = drill.count_wofl_pixels(water)
+    assert list(wet) == [2, 1]
+    assert list(dry) == [1, 1]
+    assert total == 4
+    mask = np.array([[True, False], [True, True]])
+    wet, dry, total = drill.count_wofl_pixels(water, mask)
+    assert list(wet) == [2, 1]
+    assert list(dry) == [0, 1]
+    assert total == 3
+
+
+def test_summarise_wofl_counts():
+    times = np.array(['2020-01-01', '2020-01-17', '2020-02-02'],
+                     dtype='datetime64[ns]')
+    # 10% invalid pixels is too many by default.
+    series = drill.summarise_wofl_counts(times, [3, 5, 0], [6, 5, 0], 10)
+    assert list(series.columns) == drill.COLUMNS
+    np.testing.assert_array_equal(series['Wet pixel percentage'],
+                                  [np.nan, 50.0, np.nan])
+    np.testing.assert_array_equal(series['Invalid pixel count'],
+                                  [np.nan, 0, np.nan])
+    series = drill.summarise_wofl_counts(times, [3, 5, 0], [6, 5, 0], 10,
+                                         max_invalid_percent=100)
+    np.testing.assert_array_equal(series['Wet pixel count'],
+                                  [3, 5, np.nan])
+    assert len(drill.summarise_wofl_counts(times[:0], [], [], 0)) == 0
+
+
+def test_lru_cache():
+    cache = drill.LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert len(cache) == 2
+    assert cache.pop('a') == 1
+    assert cache.pop('a', 0) == 0
+    assert len(cache) == 1
+
+
+def test_search_tiles():
+    size = drill.SEARCH_TILE_SIZE
+    assert drill._search_tiles((10, 10, 20, 20)) == [(0, 0, size, size)]
+    assert len(drill._search_tiles((-10, 10, 20, size + 1))) == 4
+
+
+def test_drill_reuses_caches(monkeypatch):
+    pytest.importorskip('datacube')
+    driller = drill.Driller(dc=object())
+    water = np.full((2, 4, 4), 128, dtype='uint8')
+    water[1, :2] = 0
+    wofl = SimpleNamespace(
+        attrs={'crs': 'EPSG:3577'}, water=SimpleNamespace(values=water),
+        time=SimpleNamespace(values=np.array(
+            ['2020-01-01', '2020-01-17'], dtype='datetime64[ns]')),
+        geobox=SimpleNamespace(shape=(4, 4),
+                               affine=Affine(25, 0, 0, 0, -25, 100),
+                               crs='EPSG:3577'))
+
+    monkeypatch.setattr(driller, 'search', lambda *args: ['dataset'])
+    monkeypatch.setattr(driller, 'load', lambda *args: wofl)
+    polygon = box(0, 0, 100, 100)
+    series = driller.drill(polygon, ('2020-01', '2020-02'))
+    assert list(series['Wet pixel percentage']) == [100.0, 50.0]
+    assert len(driller.mask_cache) == 1
+    records = driller.drill(polygon, ('2020-01', '2020-02'), as_records=True)
+    assert list(records['Wet pixel count']) == [16, 8]
+    assert len(driller.mask_cache) == 1
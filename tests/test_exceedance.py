@@ -0,0 +1,81 @@
+"""Tests for dea_waterbodies.exceedance.
+
+Geoscience Australia
+2021
+"""
+
+from click.testing import CliRunner
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from dea_waterbodies import exceedance
+from dea_waterbodies.uids import uid_paths
+
+from test_make_snapshot import TEST_SHP, write_timeseries
+from test_seasonal import random_series
+
+
+def reference_exceedance(series: pd.Series, threshold: float, index: int):
+    """The original notebook implementation."""
+    try:
+        pd.tseries.frequencies.to_offset('QE')
+        freq = 'QE'
+    except ValueError:
+        freq = 'Q'
+    quarterly = series.resample(freq, label='left').agg('max')
+    try:
+        exceeds = np.where(quarterly >= threshold)[0][index]
+    except IndexError:
+        return '-999'
+    return str(quarterly.index[exceeds]).split(' ')[0]
+
+
+def test_quarter_labels():
+    times = np.array(['2020-01-01T00:00', '2020-03-31T23:59',
+                      '2020-04-01T00:00', '2020-12-31T12:00'],
+                     dtype='datetime64[ns]')
+    assert list(exceedance.quarter_labels(times)) == [
+        '2019-12-31', '2019-12-31', '2020-03-31', '2020-09-30']
+
+
+def test_exceedance_times_matches_reference():
+    series = random_series(seed=3)
+    ids = np.concatenate([[uid] * len(s) for uid, s in series.items()])
+    times = np.concatenate([s.index.values for s in series.values()])
+    values = np.concatenate([s.values for s in series.values()])
+    order = np.random.default_rng(4).permutation(len(ids))
+    thresholds = [-5, 10, 50, 99.5, 150]
+    result = exceedance.exceedance_times(ids[order], times[order],
+                                         values[order], thresholds)
+    assert list(result.index) == sorted(series)
+    for uid, s in series.items():
+        for t in thresholds:
+            assert result.loc[uid, f'First{t:g}%'] == reference_exceedance(
+                s, t, 0)
+            assert result.loc[uid, f'Last{t:g}%'] == reference_exceedance(
+                s, t, -1)
+
+
+def test_main(tmp_path):
+    uids = gpd.read_file(TEST_SHP).UID.values[:2]
+    paths = uid_paths(tmp_path / 'timeseries', uids)
+    write_timeseries(paths[0], [
+        ('2019-12-10T00:00:00Z', 10.0, 1),
+        ('2020-02-14T23:56:09Z', 60.0, 6),
+        ('2020-08-20T00:00:00Z', '', ''),
+        ('2020-10-15T23:56:09Z', 55.0, 5),
+    ])
+    write_timeseries(paths[1], [('2020-01-01T00:00:00Z', 20.0, 2)])
+    result = CliRunner().invoke(exceedance.main, [
+        '--shapefile', str(TEST_SHP),
+        '--timeseries', str(tmp_path / 'timeseries'),
+        '--output', str(tmp_path / 'exceedance.shp'),
+        '--thresholds', '15,50'], catch_exceptions=False)
+    assert result.exit_code == 0, result.output
+    polygons = gpd.read_file(tmp_path / 'exceedance.shp').set_index('UID')
+    assert polygons.loc[uids[0], 'First50%'] == '2019-12-31'
+    assert polygons.loc[uids[0], 'Last50%'] == '2020-09-30'
+    assert polygons.loc[uids[1], 'First15%'] == '2019-12-31'
+    assert polygons.loc[uids[1], 'First50%'] == '-999'
+    assert (polygons.drop(index=uids)['Last15%'] == '-999').all()
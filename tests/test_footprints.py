@@ -0,0 +1,46 @@
+"""Tests for dea_waterbodies.footprints.
+
+Geoscience Australia
+2021
+"""
+
+from types import SimpleNamespace
+
+import pytest
+from shapely.geometry import box, mapping
+
+from dea_waterbodies import footprints
+
+
+class FakeGeometry:
+    """Just enough of a datacube Geometry to compare footprints with."""
+
+    def __init__(self, *bounds):
+        self.crs = 'EPSG:3577'
+        self.__geo_interface__ = mapping(box(*bounds))
+
+    def to_crs(self, crs):
+        return self
+
+
+def make_dataset(*bounds):
+    return SimpleNamespace(extent=FakeGeometry(*bounds))
+
+
+def test_footprint_coverage():
+    geom = FakeGeometry(0, 0, 100, 100)
+    assert footprints.footprint_coverage(
+        [make_dataset(-50, -50, 50, 150)], geom) == pytest.approx(0.5)
+    # Footprints of a solar day are unioned.
+    assert footprints.footprint_coverage(
+        [make_dataset(-50, -50, 50, 150), make_dataset(25, -50, 200, 150)],
+        geom) == pytest.approx(1)
+    assert footprints.footprint_coverage(
+        [make_dataset(200, 200, 300, 300)], geom) == 0
+    # Growing footprints by a pixel makes the coverage an upper bound.
+    assert footprints.footprint_coverage(
+        [make_dataset(-50, -50, 50, 150)], geom,
+        resolution=(-3, 4)) == pytest.approx(0.55)
+    # Datasets without footprints might cover anything.
+    assert footprints.footprint_coverage(
+        [SimpleNamespace(extent=None)], geom) == 1
@@ -0,0 +1,103 @@
+"""Tests that the command line interfaces start quickly.
+
+Thousands of short waterbodies-ts tasks run on Kubernetes and PBS, so
+importing heavy dependencies before they're needed adds up. These tests
+fail if an entry point imports a heavy dependency at startup, or if
+--help or argument validation goes over a time budget.
+
+Geoscience Australia
+2021
+"""
+
+import json
+import subprocess
+import sys
+import time
+
+import pytest
+
+# Modules that take a long time to import, and aren't needed to parse
+# arguments.
+HEAVY_MODULES = {
+    'boto3', 'datacube', 'dea_tools', 'fiona', 'geopandas', 'osgeo',
+    'pandas', 'pyarrow', 'rasterio', 'rioxarray', 'scipy', 'xarray',
+}
+
+# Command line entry points.
+CLI_MODULES = [
+    'make_chunks', 'make_time_series', 'make_snapshot', 'seasonal',
+    'exceedance', 'split_timeseries', 'query', 'queues', 'latest_state',
+]
+
+# make_polygons is used as a library of GeoDataFrame functions, so it
+# needs geopandas, but not the datacube.
+LIBRARY_MODULES = {
+    'make_polygons': {'boto3', 'datacube', 'dea_tools', 'osgeo',
+                      'rioxarray', 'xarray'},
+}
+
+# Seconds that --help and argument validation may take beyond starting
+# Python. Generous, to allow for slow CI machines: it's there to catch
+# a heavy import creeping back in.
+STARTUP_BUDGET = 1.0
+
+# Arguments that fail validation before any work is done.
+INVALID_ARGS = {
+    'make_time_series': ['--time-span', 'CUSTOM', '--shapefile', 'x.shp',
+                         '--output', 'out', '--start', '2020-01-01'],
+    'queues': ['make', 'not_a_waterbodies_queue'],
+    'make_chunks': ['config.ini', 'not_a_number'],
+}
+
+
+def imported_heavy_modules(module: str) -> [str]:
+    code = (f'import json, sys; import dea_waterbodies.{module}; '
+            f'print(json.dumps(sorted(set(sys.modules) & {HEAVY_MODULES!r})))')
+    result = subprocess.run([sys.executable, '-c', code],
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def fastest_run(args: [str], repeat: int = 3) -> (float, int):
+    """Fastest time to run a command, and its return code."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(args, capture_output=True,
+                                stdin=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times), result.returncode
+
+
+@pytest.fixture(scope='module')
+def python_startup():
+    return fastest_run([sys.executable, '-c', 'pass'])[0]
+
+
+@pytest.mark.parametrize('module', CLI_MODULES)
+def test_cli_imports_are_lazy(module):
+    assert imported_heavy_modules(module) == []
+
+
+@pytest.mark.parametrize('module', sorted(LIBRARY_MODULES))
+def test_library_imports_are_lazy(module):
+    pytest.importorskip('geopandas')
+    heavy = set(imported_heavy_modules(module))
+    assert not heavy & LIBRARY_MODULES[module]
+
+
+@pytest.mark.parametrize('module', CLI_MODULES)
+def test_help_startup_budget(module, python_startup):
+    seconds, returncode = fastest_run(
+        [sys.executable, '-m', f'dea_waterbodies.{module}', '--help'])
+    assert returncode == 0
+    assert seconds - python_startup < STARTUP_BUDGET
+
+
+@pytest.mark.parametrize('module', sorted(INVALID_ARGS))
+def test_validation_startup_budget(module, python_startup):
+    seconds, returncode = fastest_run(
+        [sys.executable, '-m', f'dea_waterbodies.{module}']
+        + INVALID_ARGS[module])
+    assert returncode != 0
+    assert seconds - python_startup < STARTUP_BUDGET
@@ -0,0 +1,179 @@
+"""Tests for dea_waterbodies.latest_state.
+
+Geoscience Australia
+2021
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import signal
+import subprocess
+import sys
+
+import pytest
+
+from dea_waterbodies import latest_state
+
+
+def write_states(path, uids, date):
+    writer = latest_state.state_writer(path)
+    for i, uid in enumerate(uids):
+        writer.update(uid, date, float(i), i, 100)
+    writer.flush()
+    return writer.shard_paths
+
+
+def test_writer_and_read(tmp_path):
+    assert len(latest_state.read_latest_state(tmp_path / 'missing')) == 0
+    writer = latest_state.LatestStateWriter(tmp_path)
+    writer.update('r3dp84s8n', '2021-04-15T23:56:09Z', 12.5, 10, 80)
+    writer.update('r3f225n9h', '2021-04-15T23:56:09Z', 50.0, 40, 80)
+    writer.update('r3dp84s8n', '2021-04-30T23:56:09Z', 25.0, 20, 80)
+    writer.flush()
+    state = latest_state.read_latest_state(tmp_path)
+    assert list(state.columns) == latest_state.COLUMNS
+    assert list(state.UID) == ['r3dp84s8n', 'r3f225n9h']
+    assert list(state['Observation Date']) == [
+        '2021-04-30T23:56:09Z', '2021-04-15T23:56:09Z']
+    assert list(state['Wet pixel percentage']) == [25.0, 50.0]
+
+
+def test_concurrent_workers(tmp_path):
+    uids = [f'r3dp{i:05d}' for i in range(40)]
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        list(executor.map(
+            write_states, [tmp_path] * 4,
+            [uids[i::4] for i in range(4)],
+            ['2021-04-15T23:56:09Z'] * 4))
+    state = latest_state.read_latest_state(tmp_path)
+    assert list(state.UID) == uids
+    # No temporary files are left behind.
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+def test_most_recent_update_wins(tmp_path):
+    old = latest_state.LatestStateWriter(tmp_path)
+    old.update('r3dp84s8n', '2021-04-30T23:56:09Z', 25.0, 20, 80)
+    old.flush()
+    # Reprocessing can move the latest observation back in time.
+    new = latest_state.LatestStateWriter(tmp_path)
+    new.update('r3dp84s8n', '2021-04-15T23:56:09Z', 12.5, 10, 80)
+    new.flush()
+    state = latest_state.read_latest_state(tmp_path)
+    assert list(state['Observation Date']) == ['2021-04-15T23:56:09Z']
+
+
+def test_compact(tmp_path):
+    write_states(tmp_path, ['r3dp84s8n', 'r3f225n9h'],
+                 '2021-04-15T23:56:09Z')
+    other = latest_state.LatestStateWriter(tmp_path)
+    other.update('r3f225n9h', '2021-04-30T23:56:09Z', 60.0, 48, 80)
+    other.flush()
+    expected = latest_state.read_latest_state(tmp_path)
+    compacted = latest_state.compact_latest_state(tmp_path)
+    assert compacted.equals(expected)
+    assert [p.name for p in tmp_path.glob('*.csv')] == [
+        latest_state.TABLE_NAME]
+    assert latest_state.read_latest_state(tmp_path).equals(expected)
+
+    # A writer whose shard was compacted away keeps all of its records.
+    other.update('r3dp84s8n', '2021-05-01T23:56:09Z', 5.0, 4, 80)
+    other.flush()
+    state = latest_state.read_latest_state(tmp_path)
+    assert list(state['Observation Date']) == [
+        '2021-05-01T23:56:09Z', '2021-04-30T23:56:09Z']
+
+
+def test_writer_buffers_updates(tmp_path, monkeypatch):
+    monkeypatch.setattr(latest_state, 'FLUSH_EVERY', 3)
+    writer = latest_state.LatestStateWriter(tmp_path)
+    for i in range(7):
+        writer.update(f'r3dp{i:05d}', '2021-04-15T23:56:09Z', 1.0, 1, 80)
+    # Each shard only has the updates since the last one.
+    assert len(writer.shard_paths) == 2
+    assert len(latest_state.read_latest_state(tmp_path)) == 6
+    writer.flush()
+    assert len(writer.shard_paths) == 3
+    assert len(latest_state.read_latest_state(tmp_path)) == 7
+    # Nothing to write.
+    writer.flush()
+    assert len(writer.shard_paths) == 3
+
+
+def test_read_skips_removed_shards(tmp_path, monkeypatch):
+    write_states(tmp_path, ['r3dp84s8n'], '2021-04-15T23:56:09Z')
+    fs, files = latest_state._list_state_files(tmp_path)
+    # Another compaction removes the shard after it was listed.
+    for name in files:
+        fs.rm(name)
+    assert latest_state._read_tables(fs, files) == []
+
+
+def test_compact_starts_again_if_table_changes(tmp_path, monkeypatch):
+    write_states(tmp_path, ['r3dp84s8n'], '2021-04-15T23:56:09Z')
+    list_state_files = latest_state._list_state_files
+    calls = []
+
+    def racing_list(path):
+        calls.append(path)
+        if len(calls) == 2:
+            # Another compaction folds in a new shard and removes it
+            # between listing and writing.
+            writer = latest_state.LatestStateWriter(tmp_path)
+            writer.update('r3f225n9h', '2021-04-30T23:56:09Z', 50.0, 40, 80)
+            writer.flush()
+            monkeypatch.setattr(latest_state, '_list_state_files',
+                                list_state_files)
+            latest_state.compact_latest_state(tmp_path)
+            monkeypatch.setattr(latest_state, '_list_state_files',
+                                racing_list)
+        return list_state_files(path)
+
+    monkeypatch.setattr(latest_state, '_list_state_files', racing_list)
+    state = latest_state.compact_latest_state(tmp_path)
+    # The other compaction's table isn't overwritten by an older merge.
+    assert list(state.UID) == ['r3dp84s8n', 'r3f225n9h']
+    assert list(latest_state.read_latest_state(tmp_path).UID) == [
+        'r3dp84s8n', 'r3f225n9h']
+
+
+def test_compact_gives_up(tmp_path, monkeypatch):
+    write_states(tmp_path, ['r3dp84s8n'], '2021-04-15T23:56:09Z')
+    list_state_files = latest_state._list_state_files
+    versions = iter(range(100))
+
+    def changing_list(path):
+        fs, files = list_state_files(path)
+        return fs, {name: dict(info, size=next(versions))
+                    for name, info in files.items()}
+
+    monkeypatch.setattr(latest_state, '_list_state_files', changing_list)
+    with pytest.raises(RuntimeError):
+        latest_state.compact_latest_state(tmp_path)
+
+
+def test_idle_writer_is_flushed(tmp_path):
+    # os._exit skips atexit, like being killed.
+    script = (
+        'import os, time\n'
+        'from dea_waterbodies import latest_state\n'
+        'latest_state.FLUSH_SECONDS = 0.1\n'
+        f'writer = latest_state.state_writer({str(tmp_path)!r})\n'
+        "writer.update('r3dp84s8n', '2021-04-15T23:56:09Z', 1.0, 1, 80)\n"
+        'time.sleep(2)\n'
+        'os._exit(0)\n')
+    subprocess.run([sys.executable, '-c', script], timeout=30, check=True)
+    assert len(latest_state.read_latest_state(tmp_path)) == 1
+
+
+def test_sigterm_flushes(tmp_path):
+    script = (
+        'import os, signal, time\n'
+        'from dea_waterbodies import latest_state\n'
+        'latest_state.flush_on_sigterm()\n'
+        f'writer = latest_state.state_writer({str(tmp_path)!r})\n'
+        "writer.update('r3dp84s8n', '2021-04-15T23:56:09Z', 1.0, 1, 80)\n"
+        'os.kill(os.getpid(), signal.SIGTERM)\n'
+        'time.sleep(10)\n')
+    result = subprocess.run([sys.executable, '-c', script], timeout=30)
+    assert result.returncode == 128 + signal.SIGTERM
+    assert len(latest_state.read_latest_state(tmp_path)) == 1
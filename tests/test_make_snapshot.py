@@ -0,0 +1,129 @@
+"""Tests for dea_waterbodies.make_snapshot.
+
+Geoscience Australia
+2021
+"""
+
+from pathlib import Path
+
+from click.testing import CliRunner
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+
+from dea_waterbodies import make_snapshot
+from dea_waterbodies.uids import uid_paths
+
+
+# Test directory.
+HERE = Path(__file__).parent.resolve()
+
+# Path to Canberra test shapefile.
+TEST_SHP = HERE / 'data' / 'waterbodies_canberra.shp'
+
+
+def write_timeseries(path, rows):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    lines = ['Observation Date,Wet pixel percentage,Wet pixel count (n = 10)']
+    lines += [f'{date},{pc},{ct}' for date, pc, ct in rows]
+    path.write_text('\n'.join(lines) + '\n')
+
+
+@pytest.fixture
+def timeseries(tmp_path):
+    uids = gpd.read_file(TEST_SHP).UID.values[:3]
+    paths = uid_paths(tmp_path / 'timeseries', uids)
+    write_timeseries(paths[0], [
+        ('2021-01-01T00:00:00Z', 10.0, 1),
+        ('2021-01-14T23:56:09Z', 20.0, 2),
+        ('2021-01-20T00:00:00Z', '', ''),
+        ('2021-04-15T23:56:09Z', 40.0, 4),
+    ])
+    # Too far from the snapshot date.
+    write_timeseries(paths[1], [('2020-06-01T00:00:00Z', 50.0, 5)])
+    # No valid observations at all.
+    write_timeseries(paths[2], [('2021-01-16T00:00:00Z', '', '')])
+    return uids, paths
+
+
+def test_parse_dates():
+    assert make_snapshot.parse_dates('20210116, 20210514,') == [
+        '20210116', '20210514']
+    with pytest.raises(ValueError):
+        make_snapshot.parse_dates('2021-01-16')
+
+
+def test_snapshot_timeseries(timeseries):
+    _, paths = timeseries
+    snapshot = make_snapshot.snapshot_timeseries(
+        paths[0], ['20210116', '20210410', '20200101'])
+    assert snapshot == {
+        '20210116': '2021-01-14 23:56:09+00:00', 'Pc20210116': 20.0,
+        '20210410': '2021-04-15 23:56:09+00:00', 'Pc20210410': 40.0,
+        '20200101': -999, 'Pc20200101': -999,
+    }
+    for path in paths[1:]:
+        assert make_snapshot.snapshot_timeseries(path, ['20210116']) == {
+            '20210116': -999, 'Pc20210116': -999}
+
+
+def test_nearest_observations_matches_pandas():
+    rng = np.random.default_rng(0)
+    day = 86400 * 10 ** 9
+    times = np.sort(rng.choice(3000, 200, replace=False)) * day // 2
+    targets = np.concatenate([
+        rng.integers(-200, 1700, 500) * day,
+        # Exact matches, ties and the ends of the series.
+        times[:5], (times[10:15] + times[11:16]) // 2,
+        [times[0] - 45 * day, times[-1] + 44 * day]])
+    index = pd.DatetimeIndex(times)
+    expected = index.get_indexer(pd.DatetimeIndex(targets), method='nearest')
+    in_range = np.abs(times[expected] - targets) < 45 * day
+    expected = np.where(in_range, expected, -1)
+    nearest = make_snapshot.nearest_observations(times, targets)
+    assert nearest.tolist() == expected.tolist()
+    assert make_snapshot.nearest_observations(
+        times[:0], targets[:3]).tolist() == [-1, -1, -1]
+
+
+def test_make_snapshot_parallel_is_identical(timeseries):
+    uids, paths = timeseries
+    serial = make_snapshot.make_snapshot(paths, ['20210116'], 'UID')
+    parallel = make_snapshot.make_snapshot(paths, ['20210116'], 'UID',
+                                           n_workers=2)
+    assert list(serial.UID) == list(uids)
+    assert serial.equals(parallel)
+
+
+def test_main(tmp_path, timeseries):
+    uids, _ = timeseries
+    config = tmp_path / 'config.ini'
+    config.write_text(
+        '[DEFAULT]\n'
+        f'SHAPEFILE = {TEST_SHP}\n'
+        f'TIMESERIES_DIR = {tmp_path / "timeseries"}\n'
+        f'SNAPSHOT_DIR = {tmp_path}/\n'
+        'SNAPSHOT_SHAPEFILE = snapshot.shp\n'
+        'DATES = 20210116\n')
+    runner = CliRunner()
+    result = runner.invoke(make_snapshot.main, [str(config)],
+                           catch_exceptions=False)
+    assert result.exit_code == 0, result.output
+
+    snapshot = gpd.read_file(tmp_path / 'snapshot.shp').set_index('UID')
+    assert len(snapshot) == len(gpd.read_file(TEST_SHP))
+    assert snapshot.loc[uids[0], 'Pc20210116'] == 20.0
+    assert snapshot.loc[uids[0], '20210116'] == '2021-01-14 23:56:09+00:00'
+    assert snapshot.loc[uids[1], 'Pc20210116'] == -999
+    assert (tmp_path / 'snapshot.shp20210116.csv').exists()
+
+    # A second date is added to the existing snapshot.
+    result = runner.invoke(make_snapshot.main,
+                           [str(config), '--dates', '20210410'],
+                           catch_exceptions=False)
+    assert result.exit_code == 0, result.output
+    snapshot = gpd.read_file(tmp_path / 'snapshot.shp').set_index('UID')
+    assert snapshot.loc[uids[0], 'Pc20210116'] == 20.0
+    assert snapshot.loc[uids[0], 'Pc20210410'] == 40.0
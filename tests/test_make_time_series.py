@@ -94,6 +94,67 @@ def test_make_one_csv(tmp_path, run_main):
     assert int(csv.iloc[0]['Wet pixel count (n = 1358)']) == 1205
 
 
+def test_make_extra_outputs(tmp_path, run_main):
+    ginninderra_id = 'r3dp84s8n'
+    run_main([
+        ginninderra_id,
+        '--shapefile', TEST_SHP,
+        '--output', tmp_path / 'masked',
+        '--extra-output', tmp_path / 'uncertainty', '100',
+        '-vv',
+    ])
+    masked = gpd.pd.read_csv(
+        tmp_path / 'masked' / ginninderra_id[:4] / f'{ginninderra_id}.csv')
+    uncertainty = gpd.pd.read_csv(
+        tmp_path / 'uncertainty' / ginninderra_id[:4]
+        / f'{ginninderra_id}.csv')
+    assert len(masked.columns) == 3
+    assert uncertainty.columns[3] == 'Invalid pixel count'
+    assert list(masked['Observation Date']) == list(
+        uncertainty['Observation Date'])
+    # The uncertainty output keeps every timestep the masked output does.
+    kept = masked['Wet pixel percentage'].notna()
+    assert uncertainty['Wet pixel percentage'][kept].notna().all()
+    assert (uncertainty['Wet pixel percentage'].notna().sum()
+            >= kept.sum())
+
+
+def test_extra_output_needs_own_directory(tmp_path, run_main):
+    result = run_main([
+        'r3dp84s8n',
+        '--shapefile', TEST_SHP,
+        '--output', tmp_path,
+        '--extra-output', tmp_path, '100',
+    ], expect_success=False)
+    assert result.exit_code != 0
+    assert 'own directory' in result.output
+
+    # However the directory is written.
+    result = run_main([
+        'r3dp84s8n',
+        '--shapefile', TEST_SHP,
+        '--output', tmp_path / 'out',
+        '--extra-output', f'{tmp_path / "out"}/', '100',
+    ], expect_success=False)
+    assert result.exit_code != 0
+    assert 'own directory' in result.output
+
+
+@pytest.mark.parametrize('threshold', ['0', '-5', '150', 'lots'])
+def test_config_extra_output_threshold(tmp_path, run_main, threshold):
+    config = tmp_path / 'config.ini'
+    config.write_text(
+        '[DEFAULT]\n'
+        f'SHAPEFILE={TEST_SHP}\n'
+        f'OUTPUTDIR={tmp_path / "out"}\n'
+        'EXTRA_OUTPUTS=\n'
+        f'    {tmp_path / "uncertainty"} {threshold}\n')
+    result = run_main(['r3dp84s8n', '--config', config],
+                      expect_success=False)
+    assert result.exit_code != 0
+    assert 'Bad extra output' in result.output
+
+
 def test_make_one_csv_stdin(tmp_path, run_main):
     ginninderra_id = 'r3dp84s8n'
     result = run_main([
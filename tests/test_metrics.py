@@ -0,0 +1,130 @@
+"""Tests for dea_waterbodies.metrics.
+
+Geoscience Australia
+2021
+"""
+
+import json
+import time
+
+import numpy as np
+import pytest
+
+from dea_waterbodies import metrics
+
+
+class FakeWofl(dict):
+    """Just enough of an xarray.Dataset of WOfLs."""
+
+    def __init__(self, water):
+        super().__init__(water=water)
+        self.water = water
+        self.sizes = {'time': water.shape[0]}
+
+
+def make_metrics(uid='r3dp84s8n', status='ok'):
+    polygon_metrics = metrics.WaterbodyMetrics(uid)
+    with polygon_metrics.stage('load'):
+        time.sleep(0.01)
+    polygon_metrics.add_seconds('reduce', 0.5)
+    polygon_metrics.add_load(FakeWofl(np.zeros((3, 10, 20), dtype='uint8')))
+    polygon_metrics.finish(status)
+    return polygon_metrics
+
+
+def test_waterbody_metrics():
+    record = make_metrics().as_dict()
+    assert record['uid'] == 'r3dp84s8n'
+    assert record['status'] == 'ok'
+    assert list(record['stage_seconds']) == list(metrics.STAGES)
+    assert record['stage_seconds']['load'] >= 0.01
+    assert record['stage_seconds']['reduce'] == 0.5
+    assert record['stage_seconds']['search'] == 0
+    assert record['seconds'] >= 0.01
+    assert record['pixels'] == 600
+    assert record['bytes_read'] == 600
+    assert record['timesteps'] == 3
+    if record['process_peak_rss_bytes'] is not None:
+        assert record['process_peak_rss_bytes'] > 1e6
+
+
+def test_rss_is_per_waterbody():
+    polygon_metrics = metrics.WaterbodyMetrics()
+    if polygon_metrics._start_rss is None:
+        pytest.skip('resident memory is only known on Linux')
+    # Touch every page so that they are resident.
+    data = np.ones(50 * 2 ** 20 // 8)
+    polygon_metrics.finish()
+    record = polygon_metrics.as_dict()
+    assert record['rss_growth_bytes'] > 40 * 2 ** 20
+    del data
+    # A later, smaller waterbody doesn't report the earlier growth.
+    record = metrics.WaterbodyMetrics()
+    record.finish()
+    assert record.as_dict()['rss_growth_bytes'] < 40 * 2 ** 20
+
+
+def test_stage_counts_time_of_errors():
+    polygon_metrics = metrics.WaterbodyMetrics()
+    with pytest.raises(ValueError):
+        with polygon_metrics.stage('write'):
+            time.sleep(0.01)
+            raise ValueError()
+    assert polygon_metrics.seconds['write'] >= 0.01
+
+
+def test_run_summary():
+    summary = metrics.RunSummary()
+    summary.add(make_metrics('a'))
+    skipping = make_metrics('b', status='no_data')
+    skipping.skipped_datasets = 4
+    skipping.skipped_timesteps = 2
+    summary.add(skipping)
+    record = summary.as_dict()
+    assert record['polygons'] == 2
+    assert record['statuses'] == {'ok': 1, 'no_data': 1}
+    assert record['pixels'] == 1200
+    assert record['stage_seconds']['reduce'] == 1.0
+    assert record['polygons_per_hour'] > 0
+    assert record['megapixels_per_second'] > 0
+    text = summary.format()
+    assert 'Processed 2 polygons' in text
+    assert 'megapixels/s' in text
+    assert 'reduce 1.0 s' in text
+    assert 'Skipped 2 timesteps (4 datasets)' in text
+
+
+def test_json_lines_writer(tmp_path):
+    path = tmp_path / 'metrics' / 'metrics.jsonl'
+    writer = metrics.metrics_writer(path)
+    assert isinstance(writer, metrics.MetricsWriter)
+    assert metrics.metrics_writer(path) is writer
+    writer.write(make_metrics('a'))
+    writer.write(make_metrics('b'))
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert [r['uid'] for r in records] == ['a', 'b']
+
+
+def test_prometheus_writer(tmp_path):
+    path = tmp_path / 'waterbodies.prom'
+    writer = metrics.metrics_writer(path)
+    assert isinstance(writer, metrics.PrometheusWriter)
+    writer.write(make_metrics('a'))
+    writer.write(make_metrics('b', status='error'))
+    samples = {}
+    with open(path) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    pid = writer.labels
+    assert samples[f'waterbodies_polygons_total{{{pid}}}'] == 2
+    assert samples[
+        f'waterbodies_polygon_outcomes_total{{{pid},status="error"}}'] == 1
+    assert samples[
+        f'waterbodies_stage_seconds_total{{{pid},stage="reduce"}}'] == 1.0
+    assert samples[f'waterbodies_pixels_total{{{pid}}}'] == 1200
+    # No temporary files are left behind.
+    assert [p.name for p in tmp_path.iterdir()] == ['waterbodies.prom']
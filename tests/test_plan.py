@@ -0,0 +1,147 @@
+"""Tests for dea_waterbodies.plan.
+
+Geoscience Australia
+2021
+"""
+
+import json
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from dea_waterbodies import plan
+
+
+def make_table(seconds, memory=None):
+    n = len(seconds)
+    memory = memory if memory is not None else [2 ** 30] * n
+    return pd.DataFrame({
+        'UID': [f'r{i:08d}' for i in range(n)], 'windows': 1,
+        'envelope_pixels': 100, 'datasets': 10, 'timesteps': 5,
+        'pixels': 500, 'peak_memory_bytes': memory, 'seconds': seconds,
+    })[plan.COLUMNS]
+
+
+def test_envelope_pixels():
+    assert plan.envelope_pixels((0, 0, 100, 50), (-25, 25)) == 8
+    assert plan.envelope_pixels((0, 0, 101, 50), (-25, 25)) == 10
+    assert plan.envelope_pixels((0, 0, 1, 1), (-25, 25)) == 1
+
+
+def test_count_solar_days():
+    # 23:00 and 01:00 UTC are different UTC days, but the same solar day
+    # in eastern Australia.
+    times = np.array(['2020-01-01T23:00', '2020-01-02T01:00',
+                      '2020-01-18T01:00'], dtype='datetime64[ns]')
+    assert plan.count_solar_days(times, 150) == 2
+    assert plan.count_solar_days(times, 0) == 3
+    assert plan.count_solar_days([], 150) == 0
+
+
+def test_estimate_polygon():
+    coefficients = {'intercept': 1, 'datasets': 0.1, 'timesteps': 0.01,
+                    'megapixels': 2}
+    estimate = plan.estimate_polygon(1000, [10, 20], [8, 16], coefficients)
+    assert estimate['windows'] == 2
+    assert estimate['timesteps'] == 24
+    assert estimate['pixels'] == 24000
+    # Only the largest window is in memory at once.
+    assert estimate['peak_memory_bytes'] == (
+        plan.BASE_MEMORY + 1000 * 16 * plan.BYTES_PER_PIXEL)
+    assert estimate['seconds'] == pytest.approx(
+        1 + 3 + 0.24 + 2 * 0.024)
+    empty = plan.estimate_polygon(1000, [], [])
+    assert empty['peak_memory_bytes'] == plan.BASE_MEMORY
+
+
+def test_fit_coefficients(tmp_path):
+    rng = np.random.default_rng(0)
+    path = tmp_path / 'metrics.jsonl'
+    with open(path, 'w') as f:
+        for _ in range(50):
+            datasets = int(rng.integers(10, 1000))
+            timesteps = int(rng.integers(10, 800))
+            pixels = int(timesteps * rng.integers(10, 100000))
+            seconds = 3 + 0.01 * datasets + 0.05 * timesteps + pixels / 1e6
+            f.write(json.dumps({
+                'status': 'ok', 'datasets': datasets,
+                'timesteps': timesteps, 'pixels': pixels,
+                'seconds': seconds}) + '\n')
+        f.write(json.dumps({'status': 'error', 'datasets': 0,
+                            'timesteps': 0, 'pixels': 0,
+                            'seconds': 1000}) + '\n')
+    coefficients = plan.fit_coefficients(path)
+    assert coefficients == pytest.approx(
+        {'intercept': 3, 'datasets': 0.01, 'timesteps': 0.05,
+         'megapixels': 1})
+
+    with open(path, 'w') as f:
+        f.write('')
+    assert plan.fit_coefficients(path) == plan.DEFAULT_COEFFICIENTS
+
+
+def test_allocate_chunks():
+    chunks = plan.allocate_chunks([5, 1, 4, 2, 3, 3], 2)
+    loads = np.bincount(chunks, weights=[5, 1, 4, 2, 3, 3])
+    assert sorted(loads) == [9, 9]
+
+
+def test_recommend():
+    table = make_table([3600] * 10 + [1800] * 4)
+    recommendation = plan.recommend(table, walltime=2 * 3600)
+    assert recommendation['workers'] == 6
+    assert recommendation['seconds'] <= 2 * 3600
+    assert recommendation['memory_bytes'] == int(
+        6 * 2 ** 30 * plan.MEMORY_SAFETY)
+    # A waterbody that can't finish in time gets its own worker, and the
+    # rest finish before it does.
+    table = make_table([10 * 3600, 60, 60])
+    recommendation = plan.recommend(table, walltime=3600)
+    assert recommendation['workers'] == 2
+    assert recommendation['seconds'] == 10 * 3600
+    assert plan.recommend(make_table([]), 3600)['workers'] == 0
+
+
+def test_recommend_many_waterbodies():
+    # One slow waterbody doesn't mean a worker for every waterbody.
+    table = make_table([5 * 3600] + [60] * 5000)
+    recommendation = plan.recommend(table, walltime=3600)
+    assert recommendation['workers'] == 18
+    assert recommendation['seconds'] == 5 * 3600
+    table = make_table([600] * 5000)
+    recommendation = plan.recommend(table, walltime=3600)
+    assert recommendation['workers'] == 834
+    assert recommendation['seconds'] <= 3600
+
+
+def test_format_plan():
+    table = make_table([3600, 1800], memory=[2 ** 30, 2 ** 31])
+    text = plan.format_plan(table, plan.recommend(table, 3600))
+    assert 'Recommended: 2 workers and 3.8 GB' in text
+    assert 'Largest waterbody r00000001: 2.0 GB' in text
+    assert len(plan.chunk_costs(table, 3)) == 3
+    # Only the first chunks are listed.
+    table = make_table([600] * 300)
+    text = plan.format_plan(table, plan.recommend(table, 3600))
+    assert text.endswith(f'... and {50 - plan.MAX_CHUNK_LINES} more chunks')
+
+
+def test_plan_polygon():
+    pytest.importorskip('datacube')
+    from shapely.geometry import box, mapping
+    times = np.array(['2020-01-01T23:00', '2020-01-02T01:00'],
+                     dtype='datetime64[ns]')
+    driller = SimpleNamespace(search=lambda product, time, geom: [
+        SimpleNamespace(center_time=t) for t in times])
+    shape = {'geometry': mapping(box(1550000, -3950000, 1551000, -3949000)),
+             'properties': {'UID': 'r3dp84s8n'}}
+    config = {'id_field': 'UID', 'crs': 'EPSG:3577', 'output_dir': 'out',
+              'time_span': 'CUSTOM', 'start_dt': '2020-01-01',
+              'end_date': '2020-01-31', 'wofls': 'ga_ls_wo_3'}
+    estimate = plan.plan_polygon(shape, config, driller)
+    assert estimate['UID'] == 'r3dp84s8n'
+    assert estimate['envelope_pixels'] == 34 * 34
+    assert estimate['datasets'] == 2
+    assert estimate['timesteps'] == 1
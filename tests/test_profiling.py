@@ -0,0 +1,68 @@
+"""Tests for dea_waterbodies.profiling.
+
+Geoscience Australia
+2021
+"""
+
+import pstats
+import sys
+import time
+
+import pytest
+
+from dea_waterbodies import profiling
+
+UIDS = [f'r{i:08d}' for i in range(2000)]
+
+
+def slow_allocation():
+    chunks = []
+    deadline = time.perf_counter() + 0.1
+    while time.perf_counter() < deadline:
+        chunks.append(bytearray(10000))
+    return chunks
+
+
+def test_sampled(tmp_path):
+    assert not any(profiling.Profiler(tmp_path, 0).sampled(u) for u in UIDS)
+    assert all(profiling.Profiler(tmp_path, 1).sampled(u) for u in UIDS)
+    few = {u for u in UIDS if profiling.Profiler(tmp_path, 0.05).sampled(u)}
+    many = {u for u in UIDS if profiling.Profiler(tmp_path, 0.2).sampled(u)}
+    assert 50 < len(few) < 150
+    assert few < many
+    with pytest.raises(ValueError):
+        profiling.Profiler(tmp_path, 2)
+
+
+def test_fold_stack():
+    stack = profiling.fold_stack(sys._getframe())
+    assert stack.split(';')[-1].startswith('test_fold_stack (test_profiling')
+
+
+def test_profile(tmp_path):
+    profiler = profiling.Profiler(tmp_path, 1, interval=0.001)
+    with profiler.profile('r3dp84s8n'):
+        slow_allocation()
+    with profiler.profile('r3dp84s8n', attempt=2):
+        slow_allocation()
+    assert (tmp_path / 'r3dp84s8n.prof').exists()
+    assert (tmp_path / 'r3dp84s8n.2.prof').exists()
+    stats = pstats.Stats(str(tmp_path / 'r3dp84s8n.prof'))
+    assert any(func[2] == 'slow_allocation' for func in stats.stats)
+    report = (tmp_path / 'r3dp84s8n.txt').read_text()
+    assert 'slow_allocation' in report
+    assert 'test_profiling.py' in report.split('Top allocations:')[1]
+    # Stacks from both profiles are appended.
+    with open(tmp_path / profiling.STACKS_NAME) as f:
+        lines = f.read().splitlines()
+    assert any('slow_allocation' in line for line in lines)
+    counts = [int(line.rsplit(' ', 1)[1]) for line in lines]
+    assert sum(counts) > 20
+
+
+def test_profile_writes_on_error(tmp_path):
+    profiler = profiling.Profiler(tmp_path, 1)
+    with pytest.raises(ValueError):
+        with profiler.profile('r3dp84s8n'):
+            raise ValueError()
+    assert (tmp_path / 'r3dp84s8n.prof').exists()
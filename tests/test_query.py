@@ -0,0 +1,137 @@
+"""Tests for dea_waterbodies.query.
+
+Geoscience Australia
+2021
+"""
+
+import io
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import box, mapping
+
+from dea_waterbodies import query
+from dea_waterbodies.uids import uid_paths
+
+from test_make_snapshot import TEST_SHP, write_timeseries
+
+# A bbox over part of the test waterbodies, in EPSG:4326.
+BBOX = (149.05, -35.30, 149.15, -35.20)
+
+
+@pytest.fixture
+def polygons():
+    return gpd.read_file(TEST_SHP)
+
+
+@pytest.fixture
+def csv_store(tmp_path, polygons):
+    paths = uid_paths(tmp_path / 'timeseries', polygons.UID)
+    for i, path in enumerate(paths):
+        write_timeseries(path, [
+            ('2020-01-01T00:00:00Z', float(i), i),
+            ('2021-01-01T00:00:00Z', float(i + 1), i + 1),
+        ])
+    return query.TimeseriesStore(tmp_path / 'timeseries')
+
+
+def test_index_query(polygons):
+    index = query.WaterbodyIndex(polygons)
+    uids = index.query(BBOX, crs='EPSG:4326')
+    bbox = gpd.GeoSeries([box(*BBOX)], crs='EPSG:4326').to_crs(polygons.crs)
+    expected = polygons.UID[polygons.intersects(bbox.iloc[0])]
+    assert 0 < len(uids) < len(polygons)
+    assert list(uids) == list(expected)
+    # GeoJSON and bbox strings work too, in the polygons' CRS by default.
+    assert list(index.query(mapping(bbox.iloc[0]))) == list(uids)
+    assert list(index.query(','.join(map(str, bbox.total_bounds)))) == \
+        list(polygons.UID[polygons.intersects(box(*bbox.total_bounds))])
+    with pytest.raises(ValueError):
+        index.query('1,2,3')
+
+
+def test_query_csv(polygons, csv_store):
+    index = query.WaterbodyIndex(polygons)
+    result = query.query_timeseries(index, csv_store, BBOX, crs='EPSG:4326',
+                                    start='2020-06-01')
+    uids = index.query(BBOX, crs='EPSG:4326')
+    assert list(result.columns) == query.COLUMNS
+    assert list(result.UID) == list(uids)
+    assert (result['Observation Date'] == pd.Timestamp('2021-01-01')).all()
+    positions = polygons.reset_index().set_index('UID').loc[uids, 'index']
+    assert list(result['Wet pixel count']) == list(positions + 1)
+
+
+def test_cache(polygons, csv_store):
+    uid = polygons.UID[0]
+    first = csv_store.read([uid])[uid]
+    write_timeseries(uid_paths(csv_store.path, [uid])[0], [])
+    assert csv_store.read([uid])[uid] is first
+    csv_store.cache_size = 1
+    csv_store.read([polygons.UID[1]])
+    assert len(csv_store.read([uid])[uid]) == 0
+    # Missing series are empty.
+    assert len(csv_store.read(['missing0'])['missing0']) == 0
+
+
+def test_query_parquet(tmp_path, polygons):
+    uids = np.sort(polygons.UID.values[:10])
+    table = pd.DataFrame({
+        'UID': np.repeat(uids, 2),
+        'Observation Date': np.tile(
+            np.array(['2020-01-01', '2021-01-01'], dtype='datetime64[ns]'),
+            len(uids)),
+        'Wet pixel count': np.arange(20),
+        'Wet pixel percentage': np.arange(20) / 2,
+    })
+    for prefix, part in table.groupby(table.UID.str[:4]):
+        path = tmp_path / 'store' / f'prefix={prefix}'
+        path.mkdir(parents=True)
+        part.to_parquet(path / 'part-00000.parquet', index=False)
+    store = query.TimeseriesStore(tmp_path / 'store')
+    assert store.is_parquet
+    index = query.WaterbodyIndex(polygons[polygons.UID.isin(uids)])
+    result = query.query_timeseries(index, store, polygons.total_bounds,
+                                    end='2020-06-01')
+    assert list(result.columns) == query.COLUMNS
+    assert set(result.UID) == set(uids)
+    assert (result['Observation Date'] == pd.Timestamp('2020-01-01')).all()
+    assert sorted(result['Wet pixel count']) == list(range(0, 20, 2))
+
+
+def test_server(polygons, csv_store):
+    index = query.WaterbodyIndex(polygons)
+    server = query.make_server(index, csv_store, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f'http://127.0.0.1:{server.server_port}'
+    try:
+        bbox = ','.join(map(str, BBOX))
+        with urllib.request.urlopen(f'{url}/waterbodies?bbox={bbox}') as r:
+            uids = json.load(r)
+        assert uids == list(index.query(BBOX, crs='EPSG:4326'))
+
+        with urllib.request.urlopen(
+                f'{url}/timeseries?bbox={bbox}&end=2020-06-01') as r:
+            result = pd.read_csv(io.BytesIO(r.read()))
+        assert list(result.columns) == query.COLUMNS
+        assert list(result.UID) == uids
+        assert (result['Observation Date'] == '2020-01-01T00:00:00Z').all()
+
+        body = json.dumps(mapping(box(*BBOX))).encode()
+        with urllib.request.urlopen(f'{url}/timeseries', data=body) as r:
+            result = pd.read_csv(io.BytesIO(r.read()))
+        assert len(result) == 2 * len(uids)
+
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(f'{url}/timeseries?bbox=1,2')
+        assert e.value.code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
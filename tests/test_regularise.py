@@ -0,0 +1,143 @@
+"""Tests for dea_waterbodies.regularise.
+
+Geoscience Australia
+2021
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from dea_waterbodies import regularise
+
+from test_seasonal import random_series
+
+
+def long_table(series, seed=0):
+    """Shuffled long (ids, times, values) arrays from a dict of series."""
+    ids = np.concatenate([[uid] * len(s) for uid, s in series.items()])
+    times = np.concatenate([s.index.values for s in series.values()])
+    values = np.concatenate([s.values for s in series.values()])
+    order = np.random.default_rng(seed).permutation(len(ids))
+    return ids[order], times[order], values[order]
+
+
+def reference_interpolate(series, grid, max_gap):
+    """Interpolate one series with pandas."""
+    series = series.dropna()
+    t = series.index.values.astype('int64')
+    g = grid.astype('int64')
+    result = pd.Series(np.interp(g, t, series.values), index=grid)
+    right = np.searchsorted(t, g, side='left')
+    exact = (right < len(t)) & (t[np.minimum(right, len(t) - 1)] == g)
+    inside = (right > 0) & (right < len(t))
+    gap = t[np.minimum(right, len(t) - 1)] - t[np.maximum(right - 1, 0)]
+    valid = exact | (inside & (gap <= pd.Timedelta(max_gap).value))
+    return result.where(valid)
+
+
+def test_stack():
+    ids = np.array(['b', 'a', 'b', 'a', 'c'])
+    times = np.array([3, 2, 1, 1, 5]).astype('datetime64[D]')
+    values = np.array([1.0, 2.0, 3.0, 4.0, np.nan])
+    unique_ids, offsets, stacked_times, stacked_values = regularise.stack(
+        ids, times, values)
+    assert list(unique_ids) == ['a', 'b']
+    assert list(offsets) == [0, 2, 4]
+    assert list(stacked_times) == list(
+        np.array([1, 2, 1, 3]).astype('datetime64[D]').astype(
+            'datetime64[ns]').astype('int64'))
+    assert list(stacked_values) == [4.0, 2.0, 3.0, 1.0]
+
+
+@pytest.mark.parametrize('freq, expected', [
+    ('D', ['2020-01-30', '2020-01-31', '2020-02-01', '2020-02-02']),
+    ('M', ['2020-01-01', '2020-02-01', '2020-03-01']),
+    ('S', ['2019-12-01', '2020-03-01']),
+])
+def test_period_edges(freq, expected):
+    edges = regularise.period_edges(np.datetime64('2020-01-30T12:00'),
+                                    np.datetime64('2020-02-01'), freq)
+    assert list(edges) == list(np.array(expected, dtype='datetime64[ns]'))
+
+
+def test_interpolate_matches_reference():
+    series = random_series(seed=5)
+    grid = regularise.period_edges(np.datetime64('2015-01-01'),
+                                   np.datetime64('2026-01-01'), 'M')
+    ids, times, values = long_table(series)
+    # Put some observations exactly on the grid.
+    times[::7] = times[::7].astype('datetime64[M]')
+    table = pd.DataFrame({'id': ids, 'time': times, 'value': values})
+    table = table.drop_duplicates(['id', 'time'])
+    unique_ids, offsets, times, values = regularise.stack(
+        table.id, table.time, table.value)
+    regularise.BLOCK_VALUES, old = 100, regularise.BLOCK_VALUES
+    try:
+        result = regularise.interpolate(offsets, times, values, grid,
+                                        max_gap='120D')
+    finally:
+        regularise.BLOCK_VALUES = old
+    for i, uid in enumerate(unique_ids):
+        s = pd.Series(values[offsets[i]:offsets[i + 1]],
+                      index=times[offsets[i]:offsets[i + 1]].astype(
+                          'datetime64[ns]'))
+        expected = reference_interpolate(s, grid, '120D')
+        np.testing.assert_allclose(result[i], expected.values)
+
+
+def test_bin_means_matches_resample():
+    series = random_series(seed=6)
+    uids, grid, result = regularise.regularise(*long_table(series), freq='M')
+    for i, uid in enumerate(uids):
+        expected = series[uid].resample('MS').mean()
+        expected = expected.reindex(grid)
+        np.testing.assert_allclose(result[i], expected.values)
+
+
+def test_fill_gaps():
+    grid = np.array(['2020-01-01', '2020-02-01', '2020-03-01', '2020-04-01',
+                     '2020-05-01', '2020-06-01'], dtype='datetime64[ns]')
+    array = np.array([
+        [np.nan, 1.0, np.nan, 3.0, np.nan, np.nan],
+        [0.0, np.nan, np.nan, np.nan, 4.0, np.nan],
+    ])
+    filled = regularise.fill_gaps(array, grid, max_gap='62D')
+    # Only the one-month gap is short enough to fill, weighted by days.
+    np.testing.assert_allclose(
+        filled[0], [np.nan, 1.0, 1.0 + 2 * 29 / 60, 3.0, np.nan, np.nan])
+    np.testing.assert_array_equal(filled[1], array[1])
+    filled = regularise.fill_gaps(array, grid)
+    np.testing.assert_allclose(filled[1, :5],
+                               4 * np.array([0, 31, 60, 91, 121]) / 121)
+    # The input is unchanged.
+    assert np.isnan(array[0, 2])
+
+
+def test_regularise_seasonal_with_gaps():
+    ids = ['a', 'a', 'a']
+    times = np.array(['2020-01-15', '2020-02-15', '2020-09-15'],
+                     dtype='datetime64[ns]')
+    uids, grid, result = regularise.regularise(
+        ids, times, [10.0, 20.0, 40.0], freq='S', max_gap='300D')
+    assert list(grid) == list(np.array(
+        ['2019-12-01', '2020-03-01', '2020-06-01', '2020-09-01'],
+        dtype='datetime64[ns]'))
+    np.testing.assert_allclose(result[0], [15.0, 15 + 25 * 91 / 275,
+                                           15 + 25 * 183 / 275, 40.0])
+    # Gaps longer than max_gap are not filled.
+    uids, grid, result = regularise.regularise(
+        ids, times, [10.0, 20.0, 40.0], freq='S', max_gap='200D')
+    assert np.isnan(result[0, 1:3]).all()
+    with pytest.raises(ValueError):
+        regularise.regularise(ids, times, [1.0, 2.0, 3.0], how='median')
+
+
+def test_interpolate_sub_second_times():
+    grid = np.array(['2020-01-01', '2020-01-02'], dtype='datetime64[ns]')
+    times = np.array(['2019-12-31T23:59:59.5', '2020-01-01T00:00:00.25',
+                      '2020-01-01T00:00:00.75'], dtype='datetime64[ns]')
+    uids, grid, result = regularise.regularise(
+        ['a', 'a', 'a'], times, [0.0, 1.0, 2.0], freq='D', how='interpolate',
+        start=grid[0], end=grid[1])
+    np.testing.assert_allclose(result[0], [2 / 3, np.nan])
@@ -0,0 +1,90 @@
+"""Tests for dea_waterbodies.retries.
+
+Geoscience Australia
+2021
+"""
+
+import pytest
+
+from dea_waterbodies import retries
+
+
+class Flaky:
+    """Raises some errors, then returns its argument."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = []
+
+    def __call__(self, time_period=None):
+        self.calls.append(time_period)
+        if self.errors:
+            raise self.errors.pop(0)
+        return time_period
+
+
+def test_classify_error():
+    assert retries.classify_error(MemoryError()) == retries.MEMORY
+    assert retries.classify_error(OSError('timed out')) == retries.TRANSIENT
+    assert retries.classify_error(TimeoutError()) == retries.TRANSIENT
+    assert retries.classify_error(FileNotFoundError()) == retries.DATA
+    assert retries.classify_error(ValueError()) == retries.DATA
+
+
+def test_classify_botocore_error():
+    exceptions = pytest.importorskip('botocore.exceptions')
+    slow_down = exceptions.ClientError(
+        {'Error': {'Code': 'SlowDown'}}, 'GetObject')
+    no_key = exceptions.ClientError(
+        {'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+    assert retries.classify_error(slow_down) == retries.TRANSIENT
+    assert retries.classify_error(no_key) == retries.DATA
+
+
+def test_split_time_period():
+    assert retries.split_time_period(('1986', '1989')) == [
+        ('1986-01-01', '1988-01-01'), ('1988-01-02', '1989-12-31')]
+    assert retries.split_time_period(('2020-01-01', '2020-01-02')) == [
+        ('2020-01-01', '2020-01-01'), ('2020-01-02', '2020-01-02')]
+    assert retries.split_time_period(('2020-01-01', '2020-01-01')) is None
+
+
+def test_call_with_retries():
+    sleeps = []
+    func = Flaky(OSError(), OSError())
+    assert retries.call_with_retries(
+        func, 'test', sleep=sleeps.append) is None
+    assert len(func.calls) == 3
+    assert len(sleeps) == 2
+    # Backoff is exponential, with jitter of up to half.
+    assert retries.BASE_DELAY / 2 <= sleeps[0] <= retries.BASE_DELAY
+    assert retries.BASE_DELAY <= sleeps[1] <= 2 * retries.BASE_DELAY
+
+    # Data errors aren't retried.
+    func = Flaky(ValueError())
+    with pytest.raises(ValueError):
+        retries.call_with_retries(func, 'test', sleep=sleeps.append)
+    assert len(func.calls) == 1
+
+    # Neither are transient errors, forever.
+    func = Flaky(*[OSError()] * 3)
+    with pytest.raises(OSError):
+        retries.call_with_retries(func, 'test', attempts=3,
+                                  sleep=sleeps.append)
+    assert len(func.calls) == 3
+
+
+def test_drill_with_retries_splits_on_memory_error():
+    drill = Flaky(MemoryError(), OSError())
+    retried = []
+    results = retries.drill_with_retries(
+        drill, ('2020-01-01', '2020-01-04'), on_retry=retried.append,
+        sleep=lambda seconds: None)
+    assert results == [('2020-01-01', '2020-01-02'),
+                       ('2020-01-03', '2020-01-04')]
+    assert len(retried) == 2
+
+    # A single day can't be split.
+    drill = Flaky(MemoryError())
+    with pytest.raises(MemoryError):
+        retries.drill_with_retries(drill, ('2020-01-01', '2020-01-01'))
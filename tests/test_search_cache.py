@@ -0,0 +1,105 @@
+"""Tests for dea_waterbodies.search_cache.
+
+Geoscience Australia
+2021
+"""
+
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import numpy as np
+from shapely.geometry import box
+
+from dea_waterbodies import search_cache
+from dea_waterbodies.drill import SEARCH_TILE_SIZE
+
+
+class FakeGeometry:
+    """Just enough of a datacube Geometry to search with."""
+
+    def __init__(self, *bounds):
+        self.shape = box(*bounds)
+        self.crs = 'EPSG:3577'
+        self.boundingbox = bounds
+
+    def to_crs(self, crs):
+        return self
+
+    def intersects(self, other):
+        return self.shape.intersects(other.shape)
+
+
+def make_dataset(id_, time, *bounds):
+    return SimpleNamespace(id=id_, center_time=datetime.fromisoformat(time),
+                           extent=FakeGeometry(*bounds))
+
+
+def make_cache(time_range=('2020', '2021')):
+    cache = search_cache.SearchCache('ga_ls_wo_3', time_range)
+    tile = (0, 0, SEARCH_TILE_SIZE, SEARCH_TILE_SIZE)
+    cache.add_tile(tile, [
+        make_dataset('b', '2020-06-01T00:00:00+00:00', 0, 0, 1000, 1000),
+        make_dataset('a', '2020-01-01T00:00:00', 0, 0, 1000, 1000),
+        make_dataset('c', '2021-06-01T00:00:00', 2000, 2000, 3000, 3000),
+    ])
+    return cache
+
+
+def test_time_bounds():
+    start, end = search_cache.time_bounds(('1986', '1990-02'))
+    assert start == np.datetime64('1986-01-01')
+    assert np.datetime64('1990-02-28T23:59') < end < np.datetime64(
+        '1990-03-01')
+
+
+def test_run_time_range():
+    now = datetime(2021, 5, 1)
+    assert search_cache.run_time_range(
+        {'time_span': 'ALL'}, now) == ('1986', '2021')
+    assert search_cache.run_time_range(
+        {'time_span': 'APPEND'}, now) == ('2020', '2021')
+    assert search_cache.run_time_range(
+        {'time_span': 'CUSTOM', 'start_dt': '2019-01-01',
+         'end_date': '2019-12-31'}, now) == ('2019-01-01', '2019-12-31')
+
+
+def test_search():
+    cache = make_cache()
+    geom = FakeGeometry(100, 100, 200, 200)
+    found = cache.search(('2020', '2021'), geom)
+    assert [dataset.id for dataset in found] == ['a', 'b']
+    found = cache.search(('2020-03', '2020-12'), geom)
+    assert [dataset.id for dataset in found] == ['b']
+    found = cache.search(('2021', '2021'), FakeGeometry(0, 0, 5000, 5000))
+    assert [dataset.id for dataset in found] == ['c']
+    # Searches outside the cached time range aren't answered.
+    assert cache.search(('2019', '2020'), geom) is None
+
+
+def test_save_and_open(tmp_path):
+    path = str(tmp_path / 'cache' / 'ga_ls_wo_3.pickle')
+    cache = make_cache()
+    cache.save(path)
+    opened = search_cache.open_search_cache('ga_ls_wo_3', ('2020', '2020'),
+                                            path)
+    assert opened.n_datasets == 3
+    assert opened.n_tiles == 1
+    # Different products and time ranges get a new cache.
+    assert search_cache.open_search_cache(
+        'wofs_albers', ('2020', '2020'), path).n_datasets == 0
+    assert search_cache.open_search_cache(
+        'ga_ls_wo_3', ('2019', '2020'), path).n_datasets == 0
+
+    with open(path, 'w') as f:
+        f.write('not a pickle')
+    assert search_cache.open_search_cache(
+        'ga_ls_wo_3', ('2020', '2020'), path).n_datasets == 0
+
+
+def test_is_fresh():
+    cache = make_cache(('2000', '2001'))
+    assert cache.is_fresh(datetime.now(timezone.utc) + timedelta(days=30))
+    cache = make_cache(('2000', str(datetime.now().year)))
+    assert cache.is_fresh()
+    assert not cache.is_fresh(
+        datetime.now(timezone.utc) + search_cache.MAX_AGE)
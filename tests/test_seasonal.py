@@ -0,0 +1,111 @@
+"""Tests for dea_waterbodies.seasonal.
+
+Geoscience Australia
+2021
+"""
+
+from click.testing import CliRunner
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+
+from dea_waterbodies import seasonal
+from dea_waterbodies.uids import uid_paths
+
+from test_make_snapshot import TEST_SHP, write_timeseries
+
+
+def reference_seasonal_means(series: dict) -> pd.DataFrame:
+    """The original per-series resample implementation."""
+    season_dict = {1: 'summer', 2: 'summer', 3: 'autumn', 4: 'autumn',
+                   5: 'autumn', 6: 'winter', 7: 'winter', 8: 'winter',
+                   9: 'spring', 10: 'spring', 11: 'spring', 12: 'summer'}
+    try:
+        pd.tseries.frequencies.to_offset('QE-NOV')
+        freq = 'QE-NOV'
+    except ValueError:
+        freq = 'Q-NOV'
+    means = []
+    for uid, s in series.items():
+        mean = s.resample(freq).mean().to_frame(uid).transpose()
+        means.append(mean)
+    means = pd.concat(means, sort=True)
+    return means.rename(columns={
+        d: str(d.year) + season_dict[d.month] for d in means.columns})
+
+
+def random_series(n=20, seed=0):
+    rng = np.random.default_rng(seed)
+    series = {}
+    for i in range(n):
+        start = rng.integers(0, 3000)
+        times = np.unique(rng.integers(start, start + 2000, 100))
+        times = (np.datetime64('2015-01-01', 'ns')
+                 + times * np.timedelta64(1, 'D')
+                 + rng.integers(0, 86400, len(times)).astype(
+                     'timedelta64[s]'))
+        values = rng.uniform(0, 100, len(times))
+        values[rng.uniform(size=len(times)) < 0.2] = np.nan
+        series[f'r3dp{i:05d}'] = pd.Series(values, index=times)
+    return series
+
+
+def test_season_codes():
+    times = np.array(['2019-11-30', '2019-12-01', '2020-02-29',
+                      '2020-03-01', '2020-06-30', '2020-07-01'],
+                     dtype='datetime64[ns]')
+    codes, names = seasonal.season_codes(times)
+    labels = [seasonal.season_label(c, names) for c in codes]
+    assert labels == ['2019spring', '2020summer', '2020summer',
+                      '2020autumn', '2020winter', '2020winter']
+    codes, names = seasonal.season_codes(times, seasons='water_year')
+    labels = [seasonal.season_label(c, names) for c in codes]
+    assert labels == ['2020wy'] * 5 + ['2021wy']
+
+
+def test_seasonal_means_matches_resample():
+    series = random_series()
+    ids = np.concatenate([[uid] * len(s) for uid, s in series.items()])
+    times = np.concatenate([s.index.values for s in series.values()])
+    values = np.concatenate([s.values for s in series.values()])
+    order = np.random.default_rng(1).permutation(len(ids))
+    means = seasonal.seasonal_means(ids[order], times[order], values[order])
+    expected = reference_seasonal_means(series)
+    assert set(expected.columns) <= set(means.columns)
+    expected = expected.reindex(columns=means.columns)
+    assert list(means.index) == list(expected.index)
+    np.testing.assert_allclose(means.values, expected.values)
+
+
+def test_seasonal_means_empty():
+    means = seasonal.seasonal_means(np.array([]), np.array([], dtype='int64'),
+                                    np.array([]))
+    assert means.shape == (0, 0)
+
+
+def test_main(tmp_path):
+    uids = gpd.read_file(TEST_SHP).UID.values[:2]
+    paths = uid_paths(tmp_path / 'timeseries', uids)
+    write_timeseries(paths[0], [
+        ('2019-12-10T00:00:00Z', 10.0, 1),
+        ('2020-02-14T23:56:09Z', 20.0, 2),
+        ('2020-03-20T00:00:00Z', '', ''),
+        ('2020-04-15T23:56:09Z', 40.0, 4),
+    ])
+    write_timeseries(paths[1], [('2020-01-01T00:00:00Z', 50.0, 5)])
+    config = tmp_path / 'config.ini'
+    config.write_text(
+        '[DEFAULT]\n'
+        f'SHAPEFILE = {TEST_SHP}\n'
+        f'TIMESERIES_DIR = {tmp_path / "timeseries"}\n'
+        f'SNAPSHOT_DIR = {tmp_path}\n'
+        'SNAPSHOT_SHAPEFILE = seasonal.shp\n')
+    result = CliRunner().invoke(seasonal.main, [str(config)],
+                                catch_exceptions=False)
+    assert result.exit_code == 0, result.output
+    means = gpd.read_file(tmp_path / 'seasonal.shp').set_index('UID')
+    assert means.loc[uids[0], '2020summer'] == pytest.approx(15)
+    assert means.loc[uids[0], '2020autumn'] == pytest.approx(40)
+    assert means.loc[uids[1], '2020summer'] == pytest.approx(50)
+    assert np.isnan(means.loc[uids[1], '2020autumn'])
@@ -0,0 +1,136 @@
+"""Tests for dea_waterbodies.split_timeseries.
+
+Geoscience Australia
+2021
+"""
+
+from click.testing import CliRunner
+import numpy as np
+import pandas as pd
+import pytest
+
+from dea_waterbodies import split_timeseries
+from dea_waterbodies.uids import uid_paths
+
+
+def make_long_csv(path, n_uids=50, n_obs=30, seed=0):
+    """Make a shuffled long-format CSV like the Conflux output."""
+    rng = np.random.default_rng(seed)
+    uids = [f'r{"3dpf"[i % 4]}{i:07d}' for i in range(n_uids)]
+    rows = []
+    for uid in uids:
+        days = rng.choice(3000, n_obs, replace=False)
+        times = (pd.Timestamp('2015-01-01')
+                 + pd.to_timedelta(days, unit='D')
+                 + pd.to_timedelta(rng.integers(0, 10 ** 9, n_obs),
+                                   unit='us'))
+        rows.append(pd.DataFrame({
+            'id': uid,
+            'time': times.strftime('%Y%m%d-%H%M%S-%f'),
+            'px_wet': rng.integers(0, 100, n_obs),
+            'pc_wet': rng.uniform(0, 1, n_obs).round(4),
+            'other': 1,
+        }))
+    long = pd.concat(rows).sample(frac=1, random_state=seed)
+    long.to_csv(path, index=False)
+    return long
+
+
+def reference_split(long):
+    """The notebook's groupby implementation."""
+    long = long.copy()
+    long['time'] = pd.to_datetime(long.time, format='%Y%m%d-%H%M%S-%f')
+    out = {}
+    for uid, rows in long.groupby('id'):
+        sorted_rows = rows.sort_values('time')[
+            ['time', 'px_wet', 'pc_wet']].rename(columns={'time': 'date'})
+        sorted_rows['date'] = sorted_rows['date'].dt.round('1s')
+        out[uid] = sorted_rows.to_csv(None, index=False)
+    return out
+
+
+@pytest.mark.parametrize('memory_budget', [10 ** 9, 20000])
+def test_split_matches_reference(tmp_path, memory_budget):
+    long = make_long_csv(tmp_path / 'long.csv')
+    n = split_timeseries.split_timeseries(
+        str(tmp_path / 'long.csv'), str(tmp_path / 'out'),
+        memory_budget=memory_budget, n_writers=4)
+    expected = reference_split(long)
+    assert n == len(expected)
+    uids = list(expected)
+    for uid, path in zip(uids, uid_paths(tmp_path / 'out', uids)):
+        with open(path) as f:
+            assert f.read() == expected[uid]
+    if memory_budget < 10 ** 6:
+        assert split_timeseries.n_buckets_for(
+            (tmp_path / 'long.csv').stat().st_size, memory_budget) > 1
+
+
+def test_split_skips_existing(tmp_path):
+    make_long_csv(tmp_path / 'long.csv', n_uids=3)
+    out = tmp_path / 'out'
+    path = uid_paths(out, ['r30000000'])[0]
+    split_timeseries.split_timeseries(str(tmp_path / 'long.csv'), str(out))
+    with open(path, 'w') as f:
+        f.write('existing')
+    assert split_timeseries.split_timeseries(
+        str(tmp_path / 'long.csv'), str(out)) == 0
+    with open(path) as f:
+        assert f.read() == 'existing'
+    assert split_timeseries.split_timeseries(
+        str(tmp_path / 'long.csv'), str(out), overwrite=True) == 3
+
+
+def test_split_duplicate_times(tmp_path):
+    long = make_long_csv(tmp_path / 'long.csv', n_uids=2)
+    pd.concat([long, long.iloc[:1]]).to_csv(tmp_path / 'long.csv',
+                                            index=False)
+    with pytest.raises(ValueError, match='Duplicate times'):
+        split_timeseries.split_timeseries(str(tmp_path / 'long.csv'),
+                                          str(tmp_path / 'out'))
+    result = CliRunner().invoke(split_timeseries.main, [
+        str(tmp_path / 'long.csv'), str(tmp_path / 'out')])
+    assert result.exit_code == 1
+
+
+def test_split_to_parquet(tmp_path):
+    pytest.importorskip('pyarrow')
+    long = make_long_csv(tmp_path / 'long.csv')
+    result = CliRunner().invoke(split_timeseries.main, [
+        str(tmp_path / 'long.csv'), str(tmp_path / 'store.parquet'),
+        '--format', 'parquet', '--memory', '1'], catch_exceptions=False)
+    assert result.exit_code == 0, result.output
+    store = pd.read_parquet(tmp_path / 'store.parquet')
+    assert len(store) == len(long)
+    assert set(store.prefix) == {uid[:4] for uid in long.id}
+    one = store[store.UID == 'r3000001']
+    assert one['Observation Date'].is_monotonic_increasing
+
+    # The store can be read for analysis.
+    from dea_waterbodies.exceedance import read_long_table
+    ids, times, values = read_long_table(str(tmp_path / 'store.parquet'))
+    assert len(ids) == len(long)
+
+    # Rerunning doesn't leave parts from the first run behind.
+    result = CliRunner().invoke(split_timeseries.main, [
+        str(tmp_path / 'long.csv'), str(tmp_path / 'store.parquet'),
+        '--format', 'parquet'])
+    assert result.exit_code == 1
+    assert 'already has a Parquet store' in result.output
+    result = CliRunner().invoke(split_timeseries.main, [
+        str(tmp_path / 'long.csv'), str(tmp_path / 'store.parquet'),
+        '--format', 'parquet', '--overwrite'], catch_exceptions=False)
+    assert result.exit_code == 0, result.output
+    assert len(pd.read_parquet(tmp_path / 'store.parquet')) == len(long)
+
+
+def test_parse_times():
+    times = ['20210415-235609-499999', '20210415-235609-500000',
+             '19991231-235959-999999']
+    expected = pd.to_datetime(times, format='%Y%m%d-%H%M%S-%f').round('1s')
+    expected = np.asarray(expected, dtype='datetime64[ns]').view('int64')
+    assert list(split_timeseries.parse_times(times)) == list(expected)
+    iso = ['2021-04-15 23:56:09.499999', '2021-04-15 23:56:09.500000',
+           '1999-12-31 23:59:59.999999']
+    assert list(split_timeseries.parse_times(
+        iso, time_format='%Y-%m-%d %H:%M:%S.%f')) == list(expected)
@@ -0,0 +1,75 @@
+"""Tests for dea_waterbodies.uids.
+
+Geoscience Australia
+2021
+"""
+
+from pathlib import Path
+import random
+
+import geohash as gh
+import geopandas as gpd
+import numpy as np
+import pytest
+
+from dea_waterbodies import uids
+
+
+# Test directory.
+HERE = Path(__file__).parent.resolve()
+
+# Path to Canberra test shapefile.
+TEST_SHP = HERE / 'data' / 'waterbodies_canberra.shp'
+
+
+def test_encode_geohashes_matches_python_geohash():
+    random.seed(0)
+    lats = [random.uniform(-90, 90) for _ in range(2000)]
+    lons = [random.uniform(-540, 540) for _ in range(2000)]
+    # Some edge cases.
+    lats += [0, -0.0, -1e-5, 1e-5, -90, 89.999999, -35.2, -45]
+    lons += [0, 0, -1e-5, 1e-5, 179.9999999, 180, 149.1, -180]
+    for precision in [1, 5, 9, 12]:
+        hashes = uids.encode_geohashes(lats, lons, precision=precision)
+        expected = [gh.encode(lat, lon, precision=precision)
+                    for lat, lon in zip(lats, lons)]
+        assert list(hashes) == expected
+
+
+def test_encode_geohashes_invalid():
+    with pytest.raises(ValueError):
+        uids.encode_geohashes([90], [0])
+    with pytest.raises(ValueError):
+        uids.encode_geohashes([0], [0], precision=13)
+    with pytest.raises(ValueError):
+        uids.encode_geohashes([0, 1], [0])
+
+
+def test_assign_uids_matches_apply():
+    """assign_uids gives the same UIDs as geohashing each centroid."""
+    polygons = gpd.read_file(TEST_SHP).drop(columns=['UID'])
+    polygons_4326 = polygons.to_crs(epsg=4326)
+    expected = [gh.encode(g.centroid.y, g.centroid.x, precision=9)
+                for g in polygons_4326.geometry]
+    shuffled = polygons.sample(frac=1, random_state=0)
+    assigned = uids.assign_uids(shuffled)
+    assert list(assigned.UID) == sorted(expected)
+    assert list(assigned.WB_ID) == list(range(len(polygons)))
+    assert assigned.crs == polygons.crs
+
+
+def test_assign_uids_duplicates():
+    polygons = gpd.read_file(TEST_SHP)
+    doubled = gpd.pd.concat([polygons, polygons.iloc[:1]], ignore_index=True)
+    with pytest.raises(ValueError):
+        uids.assign_uids(doubled)
+
+
+def test_uid_paths():
+    paths = uids.uid_paths('s3://bucket/timeseries',
+                           ['r3dp84s8n', 'r3f225n9h'])
+    assert list(paths) == [
+        's3://bucket/timeseries/r3dp/r3dp84s8n.csv',
+        's3://bucket/timeseries/r3f2/r3f225n9h.csv',
+    ]
+    assert np.asarray(uids.uid_paths('out/', [])).shape == (0,)
@@ -0,0 +1,310 @@
+"""Tests for dea_waterbodies.waterbody_polygon_functions.
+
+Geoscience Australia
+2021
+"""
+
+import math
+
+from affine import Affine
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import LineString, box
+
+from dea_waterbodies import waterbody_polygon_functions as wpf
+
+
+def dumbbell(x0, y0):
+    """Two 1 km squares joined by a thin corridor."""
+    return (box(x0, y0, x0 + 1000, y0 + 1000)
+            .union(box(x0 + 1000, y0 + 475, x0 + 1500, y0 + 525))
+            .union(box(x0 + 1500, y0, x0 + 2500, y0 + 1000)))
+
+
+def make_polygons(geometries):
+    polygons = gpd.GeoDataFrame(geometry=geometries, crs='EPSG:3577')
+    polygons['area'] = polygons.area
+    polygons['perimeter'] = polygons.length
+    polygons['pp_test'] = polygons.area * 4 * math.pi / polygons.perimeter ** 2
+    return polygons
+
+
+def reference_split(polygons, pp_thresh):
+    """The original iterrows implementation of erode-dilate-v2."""
+    splittable = polygons[polygons.pp_test <= pp_thresh]
+    buffered = splittable.buffer(-100).buffer(125)
+    subtracted = gpd.overlay(splittable, gpd.GeoDataFrame(
+        geometry=[buffered.unary_union], crs=splittable.crs),
+        how='difference').explode().reset_index(drop=True)
+    resubtracted = gpd.overlay(
+        splittable, subtracted, how='difference'
+        ).explode().reset_index(drop=True)
+    unassigned = np.ones(len(subtracted), dtype=bool)
+    recombined = []
+    for i, poly in resubtracted.iterrows():
+        mask = (subtracted.exterior.intersects(poly.geometry.exterior)
+                & unassigned)
+        neighbours = subtracted[mask]
+        unassigned[mask] = False
+        recombined.append(poly.geometry.union(neighbours.unary_union))
+    results = pd.concat([gpd.GeoDataFrame(geometry=recombined,
+                                          crs=polygons.crs),
+                         subtracted[unassigned],
+                         polygons[polygons.pp_test > pp_thresh]],
+                        ignore_index=True)
+    return results.explode().reset_index(drop=True)
+
+
+def same_geometries(a, b):
+    """Check two sets of polygons match, ignoring order."""
+    assert len(a) == len(b)
+    a = sorted(a.geometry, key=lambda g: (g.centroid.x, g.centroid.y))
+    b = sorted(b.geometry, key=lambda g: (g.centroid.x, g.centroid.y))
+    for g, h in zip(a, b):
+        assert g.symmetric_difference(h).area < 1e-6
+
+
+def test_assign_fragments():
+    parts = gpd.GeoDataFrame(
+        geometry=[box(0, 0, 10, 10), box(20, 0, 30, 10)])
+    fragments = gpd.GeoDataFrame(
+        geometry=[box(10, 0, 20, 10), box(30, 0, 35, 5), box(50, 0, 55, 5)])
+    recombined, unassigned = wpf.assign_fragments(parts, fragments)
+    assert len(recombined) == 2
+    # The fragment between both parts goes to the first one.
+    assert recombined.iloc[0].equals(box(0, 0, 20, 10))
+    assert recombined.iloc[1].area == 125
+    assert list(unassigned.geometry) == [box(50, 0, 55, 5)]
+
+
+def test_split_large_polygons_matches_reference():
+    polygons = make_polygons(
+        [dumbbell(0, 0), dumbbell(0, 1600), dumbbell(10000, 0),
+         box(20000, 0, 20500, 500)])
+    pp_thresh = 0.5
+    expected = reference_split(polygons, pp_thresh)
+    result = wpf.split_large_polygons(polygons, pp_thresh=pp_thresh)
+    # Each dumbbell splits into two, and the square is left alone.
+    assert len(result) == 7
+    same_geometries(result, expected)
+
+
+def test_split_large_polygons_parallel():
+    polygons = make_polygons(
+        [dumbbell(0, 0), dumbbell(0, 1010), dumbbell(10000, 0),
+         dumbbell(20000, 0), box(30000, 0, 30500, 500)])
+    serial = wpf.split_large_polygons(polygons, pp_thresh=0.5)
+    parallel = wpf.split_large_polygons(polygons, pp_thresh=0.5,
+                                        n_workers=2)
+    same_geometries(serial, parallel)
+    same_geometries(serial, reference_split(polygons, 0.5))
+
+
+def test_split_large_polygons_nothing_to_split():
+    polygons = make_polygons([box(0, 0, 10, 10)])
+    result = wpf.split_large_polygons(polygons, pp_thresh=0.005)
+    assert result is polygons
+
+
+def write_rivers(path, seed=0):
+    """Random river lines over a 20 km square, in EPSG:4326."""
+    rng = np.random.default_rng(seed)
+    lines = [LineString(np.cumsum(rng.normal(0, 500, (20, 2)), axis=0)
+                        + rng.uniform(0, 20000, 2)) for _ in range(40)]
+    rivers = gpd.GeoDataFrame(
+        {'Hierarchy': rng.choice(['Major', 'Minor'], len(lines))},
+        geometry=lines, crs='EPSG:3577').to_crs('EPSG:4326')
+    rivers.to_file(path, driver='GPKG')
+    return rivers.to_crs('EPSG:3577')
+
+
+def test_filter_rivers_matches_sjoin(tmp_path):
+    rivers = write_rivers(tmp_path / 'rivers.gpkg')
+    rng = np.random.default_rng(1)
+    corners = rng.uniform(0, 20000, (300, 2))
+    polygons = make_polygons([box(x, y, x + 300, y + 200)
+                              for x, y in corners])
+    for where, selected in [(None, rivers),
+                            ("Hierarchy = 'Major'",
+                             rivers[rivers.Hierarchy == 'Major'])]:
+        intersects = gpd.sjoin(polygons, selected, predicate='intersects')
+        expected = polygons.drop(index=intersects.index.unique())
+        assert 0 < len(expected) < len(polygons)
+        for tile_size, n_workers in [(1e6, 1), (3000, 1), (3000, 2)]:
+            filtered = wpf.filter_rivers(
+                polygons, tmp_path / 'rivers.gpkg', where=where,
+                tile_size=tile_size, n_workers=n_workers)
+            assert list(filtered.index) == list(expected.index)
+
+
+def test_run_stage_without_checkpoints(tmp_path):
+    polygons = make_polygons([box(0, 0, 10, 10)])
+    result = wpf.run_stage('raw', lambda: polygons, {'a': 1})
+    assert result is polygons
+    assert not list(tmp_path.iterdir())
+
+
+def test_run_stage_resumes_from_checkpoint(tmp_path):
+    polygons = make_polygons([box(0, 0, 10, 10), box(20, 0, 30, 10)])
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return polygons
+
+    first = wpf.run_stage('merged', compute, {'a': 1},
+                          checkpoint_dir=tmp_path)
+    second = wpf.run_stage('merged', compute, {'a': 1},
+                           checkpoint_dir=tmp_path)
+    assert len(calls) == 1
+    assert second.crs == polygons.crs
+    assert second.geom_equals(first).all()
+    # Changing the parameters invalidates the checkpoint.
+    wpf.run_stage('merged', compute, {'a': 2}, checkpoint_dir=tmp_path)
+    assert len(calls) == 2
+
+
+def test_run_stage_ignores_corrupt_checkpoint(tmp_path):
+    polygons = make_polygons([box(0, 0, 10, 10)])
+    path = wpf.checkpoint_path(tmp_path, 'waterbodies', 'split', {'a': 1})
+    path.write_bytes(b'not a parquet file')
+    result = wpf.run_stage('split', lambda: polygons, {'a': 1},
+                           checkpoint_dir=tmp_path)
+    assert result is polygons
+    assert len(gpd.read_parquet(path)) == 1
+
+
+def make_summary(shape=(120, 150), seed=0):
+    """Make a small noisy wet frequency raster."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    wet_frequency = np.zeros(shape)
+    for _ in range(20):
+        cy, cx = rng.uniform(0, shape[0]), rng.uniform(0, shape[1])
+        radius = rng.uniform(2, 20)
+        wet_frequency = np.maximum(wet_frequency, np.exp(
+            -((yy - cy) ** 2 + (xx - cx) ** 2) / radius ** 2))
+    wet_frequency += rng.normal(0, 0.05, shape)
+    count_clear = rng.uniform(100, 200, shape)
+    count_clear[:, :5] = np.nan
+    return wet_frequency, count_clear
+
+
+def vectorise(wet_frequency, count_clear, tile_size, n_workers=1):
+    windows = wpf.tile_windows(wet_frequency.shape, tile_size)
+    tiles = ((wet_frequency[r, c], count_clear[r, c], 0.1, 128,
+              (r.start, c.start)) for r, c in windows)
+    return wpf.merge_tiles(
+        list(wpf.parallel_map(wpf.vectorise_tile, tiles, n_workers)),
+        windows, Affine(25, 0, 1500000, 0, -25, -3900000))
+
+
+def test_tile_windows():
+    windows = wpf.tile_windows((5, 7), 3)
+    assert windows == [
+        (slice(0, 3), slice(0, 3)), (slice(0, 3), slice(3, 6)),
+        (slice(0, 3), slice(6, 7)), (slice(3, 5), slice(0, 3)),
+        (slice(3, 5), slice(3, 6)), (slice(3, 5), slice(6, 7))]
+
+
+def test_threshold_wofs():
+    wet_frequency = np.array([[0.05, 0.2, np.nan], [0.2, 0.2, 0.2]])
+    count_clear = np.array([[200, 200, 200], [100, np.nan, 200]])
+    mask = wpf.threshold_wofs(wet_frequency, count_clear, 0.1, 128)
+    assert mask.tolist() == [[False, True, False], [False, False, True]]
+    mask = wpf.threshold_wofs(wet_frequency, None, 0.1, 128)
+    assert mask.tolist() == [[False, True, False], [True, True, True]]
+
+
+def test_merge_tiles_matches_untiled():
+    wet_frequency, count_clear = make_summary()
+    untiled = vectorise(wet_frequency, count_clear, 1000)
+    tiled = vectorise(wet_frequency, count_clear, 32)
+    same_geometries(tiled, untiled)
+    assert untiled.crs == 'EPSG:3577'
+    assert np.allclose(untiled['area'], untiled.area)
+    # Every polygon is made of whole 25 m pixels.
+    assert np.allclose(untiled.area % 625, 0)
+
+
+def test_merge_tiles_parallel_is_identical():
+    wet_frequency, count_clear = make_summary(seed=1)
+    serial = vectorise(wet_frequency, count_clear, 40)
+    parallel = vectorise(wet_frequency, count_clear, 40, n_workers=2)
+    assert len(serial) == len(parallel)
+    assert serial.geom_equals_exact(parallel, 0).all()
+
+
+def test_merge_tiles_empty():
+    wet_frequency = np.zeros((50, 50))
+    polygons = vectorise(wet_frequency, wet_frequency + 200, 20)
+    assert len(polygons) == 0
+
+
+def test_fingerprint_tile_ignores_small_changes():
+    wet_frequency, count_clear = make_summary()
+    fingerprint = wpf.fingerprint_tile(wet_frequency, count_clear,
+                                       [0.05, 0.1], 128)
+    # Nudge pixels that aren't near a threshold.
+    near = (np.abs(wet_frequency - 0.05) < 0.01) | (
+        np.abs(wet_frequency - 0.1) < 0.01)
+    nudged = np.where(near, wet_frequency, wet_frequency + 0.005)
+    assert wpf.fingerprint_tile(nudged, count_clear, [0.05, 0.1],
+                                128) == fingerprint
+    wet_frequency[60, 60] = 0 if wet_frequency[60, 60] > 0.1 else 0.5
+    assert wpf.fingerprint_tile(wet_frequency, count_clear, [0.05, 0.1],
+                                128) != fingerprint
+
+
+def test_dirty_windows_includes_neighbours():
+    windows = wpf.tile_windows((9, 9), 3)
+    old = {wpf.tile_key(w): 'a' for w in windows}
+    assert wpf.dirty_windows(old, old, windows) == []
+    new = dict(old, **{'0,0': 'b'})
+    assert wpf.dirty_windows(old, new, windows) == [
+        w for w in windows if w[0].start < 6 and w[1].start < 6]
+
+
+def test_manifest_round_trip(tmp_path):
+    path = tmp_path / 'waterbodies_tiles.json'
+    assert wpf.read_manifest(path) is None
+    wpf.write_manifest(path, {'0,0': 'abc'}, {'threshold': 0.1})
+    manifest = wpf.read_manifest(path)
+    assert manifest['tiles'] == {'0,0': 'abc'}
+    assert manifest['params'] == {'threshold': 0.1}
+    path.write_text('{"version": 0}')
+    assert wpf.read_manifest(path) is None
+
+
+def test_splice_polygons_matches_full_regeneration():
+    from dea_waterbodies.uids import assign_uids
+
+    wet_frequency, count_clear = make_summary(seed=2)
+    existing = assign_uids(vectorise(wet_frequency, count_clear, 40))
+
+    # Add a new waterbody and remove one in the bottom right.
+    changed = wet_frequency.copy()
+    changed[10:20, 100:110] = 0.5
+    changed[80:, 110:] = 0
+    windows = wpf.tile_windows(changed.shape, 40)
+    transform = Affine(25, 0, 1500000, 0, -25, -3900000)
+    old, new = [{
+        wpf.tile_key((r, c)): wpf.fingerprint_tile(
+            summary[r, c], count_clear[r, c], [0.1], 128)
+        for r, c in windows} for summary in (wet_frequency, changed)]
+    dirty = wpf.dirty_windows(old, new, windows)
+    assert 0 < len(dirty) < len(windows)
+    region = wpf.windows_region(dirty, transform)
+
+    full = vectorise(changed, count_clear, 40)
+    spliced = wpf.splice_polygons(existing, full, region)
+    same_geometries(spliced, full)
+    assert spliced.UID.is_unique and spliced.WB_ID.is_unique
+    # Untouched polygons keep their IDs.
+    merged = spliced.merge(existing, on='UID', suffixes=('', '_old'))
+    assert len(merged)
+    assert (merged.WB_ID == merged.WB_ID_old).all()
+    assert merged.geometry.geom_equals(
+        gpd.GeoSeries(merged.geometry_old)).all()
+    assert spliced.WB_ID.max() > existing.WB_ID.max()
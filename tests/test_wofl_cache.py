@@ -0,0 +1,140 @@
+"""Tests for dea_waterbodies.wofl_cache.
+
+Geoscience Australia
+2021
+"""
+
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from dea_waterbodies import wofl_cache
+
+TIMES = np.array(['2020-01-01T00:01', '2020-01-17T00:02', '2020-02-02T00:03'],
+                 dtype='datetime64[ns]')
+
+
+def put(cache, key, n_times=3, value=128):
+    pixels = np.full((n_times, 4, 5), value, dtype='uint8')
+    cache.put_array(key, pixels, TIMES[:n_times], ['time', 'y', 'x'],
+                    {'y': np.arange(4) * -30.0, 'x': np.arange(5) * 30.0},
+                    'EPSG:3577')
+    return pixels
+
+
+def test_cache_key():
+    geobox = SimpleNamespace(crs='EPSG:3577', shape=(4, 5),
+                             affine=(30, 0, 0, 0, -30, 0, 0, 0, 1))
+    key = wofl_cache.cache_key('ga_ls_wo_3', geobox, ('2020', '2020'),
+                               ['b', 'a'])
+    assert key == wofl_cache.cache_key('ga_ls_wo_3', geobox,
+                                       ('2020', '2020'), ['a', 'b'])
+    assert key != wofl_cache.cache_key('ga_ls_wo_3', geobox,
+                                       ('2020', '2021'), ['a', 'b'])
+
+
+def test_get_and_put(tmp_path):
+    cache = wofl_cache.WoflCache(tmp_path)
+    assert cache.get_array('a') is None
+    pixels = put(cache, 'a')
+    cached, meta = cache.get_array('a')
+    np.testing.assert_array_equal(cached, pixels)
+    np.testing.assert_array_equal(meta['times'], TIMES)
+    assert meta['dims'] == ['time', 'y', 'x']
+    assert meta['crs'] == 'EPSG:3577'
+    np.testing.assert_array_equal(meta['coords']['x'], [0, 30, 60, 90, 120])
+
+    # Some of the cached times can be got.
+    cached, meta = cache.get_array('a', TIMES[[0, 2]])
+    assert cached.shape == (2, 4, 5)
+    np.testing.assert_array_equal(meta['times'], TIMES[[0, 2]])
+
+    # But not times that aren't cached.
+    put(cache, 'b', n_times=2)
+    assert cache.get_array('b', TIMES) is None
+    assert cache.hits == 2
+    assert cache.misses == 2
+
+    # Rewriting an entry replaces its pixels.
+    put(cache, 'b', value=0)
+    cached, _ = cache.get_array('b', TIMES)
+    assert not cached.any()
+    assert len([name for name in os.listdir(tmp_path)
+                if name.endswith('.npy')]) == 2
+
+
+def test_evict(tmp_path):
+    entry_bytes = 3 * 4 * 5
+    cache = wofl_cache.WoflCache(tmp_path, max_bytes=2 * entry_bytes)
+    put(cache, 'a')
+    put(cache, 'b')
+    # b was used longest ago.
+    os.utime(tmp_path / 'b.json', (0, 0))
+    cache.get_array('a')
+    put(cache, 'c')
+    assert cache.get_array('b') is None
+    assert cache.get_array('a') is not None
+    assert cache.get_array('c') is not None
+    assert cache.size() == 2 * entry_bytes
+    assert len([name for name in os.listdir(tmp_path)
+                if name.endswith('.npy')]) == 2
+
+    # Files from workers that died mid-write are cleaned up eventually.
+    orphan = tmp_path / 'd-0.npy.tmp'
+    orphan.write_bytes(b'')
+    os.utime(orphan, (0, 0))
+    cache.evict(sweep=False)
+    assert orphan.exists()
+    cache.evict()
+    assert not orphan.exists()
+
+
+def test_put_only_scans_sometimes(tmp_path, monkeypatch):
+    entry_bytes = 3 * 4 * 5
+    cache = wofl_cache.WoflCache(tmp_path, max_bytes=100 * entry_bytes)
+    scans = []
+    scan = cache._scan
+    monkeypatch.setattr(cache, '_scan', lambda: scans.append(1) or scan())
+    for i in range(10):
+        put(cache, str(i))
+    # Under max_bytes, entries aren't read at all.
+    assert not scans
+    cache.max_bytes = 5 * entry_bytes
+    put(cache, 'a')
+    assert len(scans) == 1
+    assert cache.size() <= 5 * entry_bytes
+
+
+def test_one_cache_per_process(tmp_path):
+    cache = wofl_cache.wofl_cache(tmp_path, 100)
+    assert wofl_cache.wofl_cache(tmp_path, 200) is cache
+    assert cache.max_bytes == 200
+
+
+def test_get_and_put_dataset(tmp_path):
+    # A time window as loaded by dc.load, with a geobox for the mask.
+    pytest.importorskip('datacube')
+    import xarray as xr
+    from datacube.utils import geometry
+    polygon = geometry.box(1500000, -3900000, 1500025, -3899900,
+                           crs='EPSG:3577')
+    geobox = geometry.GeoBox.from_geopolygon(
+        polygon, resolution=(-25, 25), crs='EPSG:3577')
+    # One pixel wide, so x has a single coordinate.
+    assert geobox.shape == (4, 1)
+    coords = dict(geobox.xr_coords(with_crs=True), time=TIMES)
+    water = xr.DataArray(
+        np.full((3,) + geobox.shape, 128, dtype='uint8'),
+        dims=('time',) + geobox.dims, coords=coords,
+        attrs={'nodata': 1, 'crs': geobox.crs})
+    wofl = xr.Dataset({'water': water}, attrs={'crs': geobox.crs})
+
+    cache = wofl_cache.WoflCache(tmp_path)
+    cache.put('a', wofl)
+    cached = cache.get('a', TIMES[1:])
+    assert cached.geobox == wofl.geobox
+    np.testing.assert_array_equal(cached.water.values,
+                                  wofl.water.values[1:])
+    np.testing.assert_array_equal(cached.time.values, TIMES[1:])